@@ -29,177 +29,278 @@ from __future__ import division
 from __future__ import print_function
 
 import glob
-import tqdm
 import os
 import json
 import logging
+import sys
+import zlib
 models_logger = logging.getLogger(__name__)
 
 import numpy as np
 import tifffile
-import cv2 as cv
-from skimage.measure import label
-from skimage import io
-from collections import OrderedDict
-from metrics import Metrics
+from manifest import DatasetManifest, parse_shard, shard_of
+from metrics import MetricAccumulator, Metrics
+from results_store import KEY_COLUMNS, ResultStore
 import argparse
-import pandas as pd
-import subprocess
-
-# Constants
-work_path = os.path.abspath('.')
-cellmorphology_PY = os.path.join(work_path, 'src/eval/cellmorphology/maskanalysis.py')
-
-def sub_run(cmd):
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    while p.poll() is None:
-        line = p.stdout.readline()
-        line = line.strip()
-        line = str(line, encoding='utf-8')
-        if line:
-            print('Subprogram output: [{}]'.format(line))
-    if p.returncode == 0:
-        print('Subprogram success')
-    else:
-        print('Subprogram failed')
-    return
 
-def cellmorphology(input, output):
-    cmd = f"python {cellmorphology_PY} -g {input} -o {output}"
-    sub_run(cmd)
-    return
+# bar colors and order of the known methods, other methods are drawn after them
+METHOD_COLORS = {
+    'cellprofiler': '#ff7f0e',
+    'MEDIAR': '#d62728',
+    'cellpose': '#1f77b4',
+    'cellpose3': '#2ca02c',
+    'sam': '#8c564b',
+    'stardist': '#9467bd',
+    'deepcell': '#17becf',
+    'cellbin2': '#bcbd22',
+    'hovernet': '#e377c2',
+    'cyto3_train_at_cellbinDB': '#7f7f7f'
+}
+METHOD_ORDER = list(METHOD_COLORS)
+
+# per-image metrics of ObjectMetrics kept in the results, only their stages run
+IMAGE_METRICS = ('gained_detections', 'precision', 'recall', 'f1', 'dice', 'PQ')
+
+def draw_barplot(dataset_dct, output_path, dataset_name, threshold):
+    from matplotlib.figure import Figure
+
+    index = ('Precision', 'Recall', "F1",  'dice', 'PQ')
+    fig = Figure(figsize=(16, 12))
+    axs = fig.subplots()
+    x = np.arange(len(index))  # 标签位置
+    width = 0.1  # 每个条形图宽度
 
-def draw_boxplot(directory, output_path):
-    import matplotlib.pyplot as plt
+    # 对结果按照指定顺序排序
+    order = [m for m in METHOD_ORDER if m in dataset_dct]
+    order += [m for m in dataset_dct if m not in METHOD_COLORS]
+    for multiplier, attribute in enumerate(order):
+        measurement = [v for k, v in dataset_dct[attribute].items() if k != 'gained_detections']
+        offset = width * multiplier
+        rects = axs.bar(x + offset, [round(val, 2) for val in measurement], width, label=attribute,
+                        color=METHOD_COLORS.get(attribute, None), alpha=0.62)
+        axs.bar_label(rects, padding=3)
+
+    axs.set_ylabel('Evaluation Index')
+    axs.set_title(f'dataset - {dataset_name} (IoU threshold={threshold})')
+    axs.set_xticks(x + width, index)
+    axs.legend(loc='upper left', ncols=3)
+    axs.set_ylim(0, 1)
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_path, f'{dataset_name}_benchmark.png'))
+
+def draw_boxplot(results, output_path):
     import seaborn as sns
-  
-    file_paths = [os.path.join(directory, file) for file in os.listdir(directory) if file.endswith('.xlsx')]
-    
-    # initialize
-    data = {}
-    methods = []
-    # Read each Excel file and extract metrics data
-    for i, file_path in enumerate(file_paths):
-        df = pd.read_excel(file_path)
-        methods.append(os.path.basename(file_paths[i]).split('_')[0])
-        data[os.path.basename(file_paths[i]).split('_')[0]] = df
-        
-    eval_indexs = [index for index in data[methods[0]].columns[1:]]  # get evaluation index
-    
-    eval_pd = dict([(eval_index, pd.DataFrame()) for eval_index in eval_indexs])
-    for eval_index in eval_indexs:
-        for method in methods:
-            eval_pd[eval_index][method] = pd.DataFrame(data[method][eval_index])
-    
+    from matplotlib.figure import Figure
+
+    # per-image results of all methods, one row per method and image
+    eval_indexs = [column for column in results.columns if column not in KEY_COLUMNS]  # get evaluation index
+
     # Draw boxplot
-    fig, axes = plt.subplots(1, len(eval_indexs), figsize=(5*len(eval_indexs), 6))
-    
-    for i, key in enumerate(eval_pd):
-        sns.boxplot(data=eval_pd[key], ax=axes[i])
+    fig = Figure(figsize=(5*len(eval_indexs), 6))
+    axes = fig.subplots(1, len(eval_indexs), squeeze=False)[0]
+
+    for i, key in enumerate(eval_indexs):
+        sns.boxplot(data=results, x='method', y=key, ax=axes[i])
         axes[i].set_title(key + ' Comparison')
         axes[i].set_xlabel('Algorithm')
         axes[i].set_ylabel(key)
-    
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_path, 'benchmark-boxplot.png'))
-
-def search_files(file_path, exts):
-    file_path = file_path.replace('.ipynb_checkpoints', '')
-    files_ = list()
-    for root, dirs, files in os.walk(file_path):
-        if '.ipynb_checkpoints' in root: 
-            continue
-        if len(files) == 0:
-            continue
-        for f in files:
-            if '.ipynb_checkpoints' in f: 
-                continue
-            fn, ext = os.path.splitext(f)
-            if ext in exts: 
-                files_.append(os.path.join(root, f))
-    return files_
+
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_path, 'benchmark-boxplot.png'))
+
+def render_report(reports, dataset_name):
+    """Draw the charts of all given thresholds from in-memory results and
+    test the significance of the differences between the methods.
+
+    Args:
+        reports (list): tuples of (output directory, IoU threshold, mean
+            metrics of each method, per-image results of all methods).
+        dataset_name (str): name of the evaluated dataset.
+
+    Returns:
+        list: paths of the output directories that were rendered.
+    """
+    from significance import compare_methods
+
+    rendered = []
+    for out_dir, threshold, dataset_dct, results in reports:
+        draw_barplot(dataset_dct, out_dir, dataset_name, threshold)
+        try:
+            draw_boxplot(results, out_dir)
+        except Exception as e:
+            print("no module named seaborn or error in boxplot:", e)
+        if results['method'].nunique() > 1:
+            comparison = compare_methods(results, seed=0)
+            comparison.to_csv(os.path.join(out_dir, 'significance.csv'), index=False)
+        rendered.append(out_dir)
+    return rendered
+
+def load_mask(image_path, shape=None):
+    """Read the first page of a mask, pad it to shape and label its objects."""
+    from skimage.measure import label
+
+    # 使用 tifffile 读取第一帧，避免 deepcell 返回 (1,512,512,1) 的 shape
+    arr = tifffile.imread(image_path, key=0)
+    h, w = arr.shape
+    arr_ = np.zeros(shape or (h, w), dtype=np.uint8)
+    arr_[:h, :w] = arr
+    arr_ = label(arr_, connectivity=2)
+    return arr_
+
+def dataset_metrics(accumulator):
+    """Micro-averaged metrics of a dataset, as drawn in the bar chart."""
+    summary = accumulator.result(average='micro')
+    metrics = {'gained_detections': accumulator.counts['gained_detections']}
+    metrics.update((k, summary[k]) for k in ('precision', 'recall', 'f1', 'dice', 'PQ'))
+    return metrics
+
+def write_summary(path, accumulator, **info):
+    """Write the accumulated counts with micro and macro averages as JSON."""
+    summary = dict(info)
+    summary.update(accumulator.to_dict())
+    summary['micro'] = accumulator.result(average='micro')
+    summary['macro'] = accumulator.result(average='macro')
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    return path
+
+def shard_name(run, shard):
+    """Name of the partial results of a shard (index, count) of a run."""
+    return '{}-shard{}of{}'.format(run, *shard)
+
+def gt_files(gt_path, manifest, shard=None):
+    """Paths of all GT masks of a dataset, or of one shard (index, count) of it.
+
+    Sharding follows ``DatasetManifest.pair``, so every GT mask belongs to the
+    same shard as the images paired with it.
+    """
+    gt_path = os.path.abspath(gt_path)
+    if os.path.isfile(gt_path):
+        return [gt_path]
+    files = manifest.scan(gt_path)
+    if shard is not None:
+        files = [f for f in files if shard_of(f, shard[1]) == shard[0]]
+    return [gt_path + os.sep + f for f in files]
 
 class CellSegEval(object):
     def __init__(self, method: str = None):
         self._method = method
         self._gt_list = list()
         self._dt_list = list()
+        self._object_records = None
         self._object_metrics = None
         self._suitable_shape = None
+        self._gt_masks = None
+        self._gt_names = None
+        self._accumulator = None
 
     def set_method(self, method: str):
         self._method = method
 
+    def object_metrics(self):
+        """Per-image metrics of the last evaluation as a DataFrame indexed by
+        the DT file names, pandas is only imported when they are needed."""
+        if self._object_metrics is None and self._object_records is not None:
+            import pandas as pd
+
+            pd.set_option('expand_frame_repr', False)
+            self._object_metrics = pd.DataFrame.from_records(self._object_records)
+            self._object_metrics.index = [os.path.basename(d) for d in self._dt_list]
+        return self._object_metrics
+
     def _load_image(self, image_path: str):
-        arr_ = np.zeros(self._suitable_shape, dtype=np.uint8)
-        # 使用 tifffile 读取第一帧，避免 deepcell 返回 (1,512,512,1) 的 shape
-        arr = tifffile.imread(image_path, key=0)
-        h, w = arr.shape
-        arr_[:h, :w] = arr
-        arr_ = label(arr_, connectivity=2)
-        return arr_
-
-    def evaluation(self, gt_path: str, dt_path: str, cutoff: float = 0.55):
+        return load_mask(image_path, self._suitable_shape)
+
+    def evaluation(self, gt_path: str, dt_path: str, cutoff: float = 0.55,
+                   manifest: DatasetManifest = None, shard: tuple = None):
         dt_path = dt_path.replace('.ipynb_checkpoints', '')
         gt_path = gt_path.replace('.ipynb_checkpoints', '')
         for i in [gt_path, dt_path]:
             assert os.path.exists(i), '{} is not exists'.format(i)
         
         print(f'gt:{gt_path}\ndt:{dt_path}')
-        if os.path.isfile(gt_path):
-            self._gt_list = [gt_path]
+        if manifest is None:
+            manifest = DatasetManifest()
+        if os.path.isfile(gt_path) and os.path.isfile(dt_path):
+            pairs = [(gt_path, dt_path)]
         else:
-            img_lst = search_files(gt_path, ['.tif', '.png', '.jpg'])
-            self._gt_list = [i for i in img_lst if 'mask' in i]
-        if os.path.isfile(dt_path):
-            self._dt_list = [dt_path]
-        else:
-            self._dt_list = search_files(dt_path, ['.tif', '.png', '.jpg'])
-        self._gt_list = [imgpath for imgpath in self._dt_list if imgpath.replace('mask', 'img').replace(gt_path, dt_path) in self._dt_list]  # 只读取 DT 中有的 GT 对应的图片
-        assert len(self._gt_list) == len(self._dt_list), 'Length of list GT {} are not equal to DT {}'.format(len(self._gt_list), len(self._dt_list))
+            pairs = manifest.pair(gt_path, dt_path, shard=shard)  # 只读取 DT 中有的 GT 对应的图片
+        if not pairs and shard is not None:
+            models_logger.warning('No images of {} in shard {}/{}'.format(dt_path, *shard))
+            return None
+        assert len(pairs), 'No GT found for the DT in {}'.format(dt_path)
+        self._gt_list = [gt for gt, _ in pairs]
+        self._dt_list = [dt for _, dt in pairs]
 
         gt_arr = list()
         dt_arr = list()
-        shape_list = list()
-        for i in self._dt_list:
-            dt = tifffile.imread(i, key=0)
-            shape_list.append(dt.shape)
+        shape_list = [manifest.shape(i)[:2] for i in self._dt_list]
+        manifest.save()
         w = np.max(np.array(shape_list)[:, 1])
         h = np.max(np.array(shape_list)[:, 0])
         self._suitable_shape = (h, w)
         models_logger.info('Uniform size {} into {}'.format(list(set(shape_list)), self._suitable_shape))
-        for i in tqdm.tqdm(self._dt_list, desc='Load data {}'.format(self._method)):
-            gt = self._load_image(image_path=i.replace('img', 'mask').replace(dt_path, gt_path))
+        import tqdm
+
+        for g, i in tqdm.tqdm(pairs, desc='Load data {}'.format(self._method)):
+            gt = self._load_image(image_path=g)
             dt = self._load_image(image_path=i)
             assert gt.shape == dt.shape, 'Shape of GT are not equal to DT'
             gt_arr.append(gt)
             dt_arr.append(dt)
         gt_arr = np.array(gt_arr)
         dt_arr = np.array(dt_arr)
+        # keep the loaded GT masks, e.g. for the cell morphology
+        self._gt_masks = gt_arr
+        self._gt_names = [os.path.basename(i) for i in self._gt_list]
         # 使用传入的 cutoff 参数
         pm = Metrics(self._method, cutoff1=cutoff)
         models_logger.info('Start evaluating the test set, which will take some time.')
-        object_metrics = pm.calc_object_stats(gt_arr, dt_arr)
-        self._object_metrics = object_metrics.drop(
-            labels=['jaccard','missed_det_from_merge', 'gained_det_from_split', 
-                    'true_det_in_catastrophe', 'pred_det_in_catastrophe', 'merge', 'split', 
-                    'catastrophe', 'seg', 'n_pred', 'n_true', 'correct_detections', 'missed_detections'], 
-            axis=1)
-        self._object_metrics.index = [os.path.basename(d) for d in self._dt_list]
+        self._accumulator = MetricAccumulator()
+        # only compute the per-image metrics that are kept
+        self._object_metrics = None
+        self._object_records = pm.calc_object_stats(
+            gt_arr, dt_arr, accumulator=self._accumulator, metrics=IMAGE_METRICS,
+            as_dataframe=False)
         models_logger.info('For each piece of data in the test set, the evaluation results are as follows:')
-        pd.set_option('expand_frame_repr', False)
         models_logger.info('The statistical indicators for the entire data set are as follows:')
-        return self._object_metrics.mean().to_dict()
+        # micro averages of the counts of all images, not the mean of per-image ratios
+        return dataset_metrics(self._accumulator)
+
+    def dump_info(self, save_path: str, store: ResultStore = None, threshold: float = None,
+                  dataset: str = None, excel: bool = False, shard: tuple = None):
+        # append the per-image results to the columnar result store
+        if store is None:
+            store = ResultStore(os.path.join(save_path, 'results'))
+        part_name = None
+        if shard is not None:
+            # evaluating a shard again replaces its earlier part
+            part_name = 'shard{}of{}-{}-{}'.format(*shard, self._method, threshold)
+        part = store.append(self.object_metrics(), self._method, threshold=threshold,
+                            dataset=dataset, name=part_name)
+        models_logger.info('The evaluation results is stored under {}'.format(part))
+        name = store.run if shard is None else shard_name(store.run, shard)
 
-    def dump_info(self, save_path: str):
-        import time
-        t = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-        save_path_ = os.path.join(save_path, '{}_cell_segmenatation_{}.xlsx'.format(self._method, t))
-        self._object_metrics.to_excel(save_path_)
-        models_logger.info('The evaluation results is stored under {}'.format(save_path_))
+        # dataset level counts with micro and macro averages
+        if self._accumulator is not None:
+            write_summary(os.path.join(save_path, '{}_summary_{}.json'.format(self._method, name)),
+                          self._accumulator, method=self._method, threshold=threshold,
+                          dataset=dataset, run=store.run, shard=shard)
+
+        # optional Excel export of this method
+        if excel:
+            save_path_ = os.path.join(save_path, '{}_cell_segmenatation_{}.xlsx'.format(self._method, name))
+            self.object_metrics().to_excel(save_path_)
+            models_logger.info('The evaluation results is exported to {}'.format(save_path_))
 
 def main(args, para):
-    from decimal import Decimal
+    import concurrent.futures
+    import pandas as pd
+    from cellmorphology import dump_morphology, extract_morphology
+
+    # 分片运行：每个节点只评估 crc32(图片) % N == i 的图片，之后用 merge 子命令合并
+    shard = parse_shard(args.shard) if args.shard else None
+
     # 示例中方法列表可以为：['lt', 'stereocell', 'deepcell', 'sam', 'cellpose'] 
     # 数据集名称例如：['HE', 'FB', 'ssDNA', 'mIF']
     dataset_name = os.path.basename(os.path.dirname(args.gt_path))
@@ -216,6 +317,24 @@ def main(args, para):
         thresholds = [0.55]
     
     gt_path = os.path.join(args.gt_path)
+
+    run = args.run
+    if run is None and shard is not None:
+        # all shards derive the same run id without any coordination
+        key = '\n'.join([os.path.abspath(args.gt_path), os.path.abspath(args.dt_path)] +
+                        [str(t) for t in thresholds])
+        run = 'shards{}-{:08x}'.format(shard[1], zlib.crc32(key.encode('utf-8')))
+
+    # per-image results of all thresholds and methods of this run
+    store = ResultStore(os.path.join(args.output_path, 'results'), run=run)
+    # GT/DT pairing and image shapes, persisted to rescan only changed directories
+    manifest = DatasetManifest(os.path.join(args.output_path, 'manifest.json'))
+
+    # charts are rendered by a background process from the in-memory results
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    reports = []
+    # GT masks loaded by the evaluations, reused for the cell morphology
+    gt_masks = {}
     
     # 对每个阈值进行循环评估
     for cutoff in thresholds:
@@ -229,76 +348,123 @@ def main(args, para):
             os.makedirs(out_dir)
         
         dataset_dct = {}
+        tables = {}
         for m in methods:
             dt_path = os.path.join(args.dt_path, m)
             cse = CellSegEval(m)
-            v = cse.evaluation(gt_path=gt_path, dt_path=dt_path, cutoff=cutoff)
+            v = cse.evaluation(gt_path=gt_path, dt_path=dt_path, cutoff=cutoff,
+                               manifest=manifest, shard=shard)
+            if v is None:
+                continue
             dataset_dct[m] = v
+            tables[m] = cse.object_metrics()
+            # copies, so the stacked masks of each method are not kept alive
+            gt_masks.update((g, mask.copy()) for g, mask in zip(cse._gt_list, cse._gt_masks)
+                            if g not in gt_masks)
             if os.path.exists(out_dir):
-                cse.dump_info(out_dir)
+                cse.dump_info(out_dir, store=store, threshold=round(1-cutoff,2),
+                              dataset=dataset_name, excel=args.excel, shard=shard)
             else:
                 models_logger.warn('Output path not exists, will not dump result')
         
-        # 绘制柱状图
+        # 在后台进程中绘制图表，不阻塞后续阈值的评估
         print(dataset_dct)
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot as plt
-        import numpy as np
-        index = ('Precision', 'Recall', "F1",  'dice', 'PQ')
-        fig, axs = plt.subplots(figsize=(16, 12))
-        x = np.arange(len(index))  # 标签位置
-        width = 0.1  # 每个条形图宽度
-        multiplier = 0
-        
-        colors = {
-            'cellprofiler': '#ff7f0e', 
-            'MEDIAR': '#d62728',
-            'cellpose': '#1f77b4', 
-            'cellpose3': '#2ca02c',
-            'sam': '#8c564b',
-            'stardist': '#9467bd',
-            'deepcell': '#17becf',
-            'cellbin2': '#bcbd22',
-            'hovernet': '#e377c2',
-            'cyto3_train_at_cellbinDB': '#7f7f7f'
-        }
-        order = [
-            'cellprofiler', 
-            'MEDIAR', 
-            'cellpose', 
-            'cellpose3', 
-            'sam', 
-            'stardist', 
-            'deepcell', 
-            'cellbin2', 
-            'hovernet', 
-            'cyto3_train_at_cellbinDB'
-        ]
-        # 对结果按照指定顺序排序
-        order_means = OrderedDict((key, dataset_dct[key]) for key in order if key in dataset_dct)
-        for key in dataset_dct:
-            if 'gained_detections' in dataset_dct[key]:
-                del dataset_dct[key]['gained_detections']
-        for attribute, measurement in order_means.items():
-            offset = width * multiplier
-            rects = axs.bar(x + offset, [round(val, 2) for val in measurement.values()], width, label=attribute, color=colors.get(attribute, None), alpha=0.62)
-            axs.bar_label(rects, padding=3)
-            multiplier += 1
-        
-        axs.set_ylabel('Evaluation Index')
-        axs.set_title(f'dataset - {dataset_name} (IoU threshold={round(1-cutoff,2)})')
-        axs.set_xticks(x + width, index)
-        axs.legend(loc='upper left', ncols=3)
-        axs.set_ylim(0, 1)
-        plt.tight_layout()
-        plt.savefig(os.path.join(out_dir, f'{dataset_name}_benchmark.png'))
-        
-        # 绘制箱线图
-        try:
-            draw_boxplot(out_dir, out_dir)
-        except Exception as e:
-            print("no module named seaborn or error in boxplot:", e)
+        if shard is not None or not tables:
+            continue  # charts of sharded runs are drawn by merge
+        results = pd.concat(
+            [tables[m].rename_axis('image').reset_index().assign(method=m) for m in tables],
+            ignore_index=True)
+        reports.append(executor.submit(
+            render_report, [(out_dir, round(1-cutoff,2), dataset_dct, results)], dataset_name))
+
+    # 计算 GT 的细胞形态学特征，复用评估时已加载的 mask
+    gt_list = gt_files(gt_path, manifest, shard=shard)
+    if gt_list:
+        masks = [gt_masks[g] if g in gt_masks else load_mask(g) for g in gt_list]
+        morphology = extract_morphology(masks, names=[os.path.basename(g) for g in gt_list])
+        suffix = '' if shard is None else '-' + shard_name(store.run, shard)
+        paths = dump_morphology(morphology, args.output_path, suffix=suffix)
+        models_logger.info('The cell morphology is stored under {}'.format(paths))
+
+    executor.shutdown(wait=True)
+    for report in reports:
+        report.result()
+
+    if shard is not None:
+        # marks the shard as complete for merge
+        with open(os.path.join(args.output_path, shard_name(store.run, shard) + '.done'), 'w') as f:
+            json.dump({'run': store.run, 'shard': shard, 'dataset': dataset_name,
+                       'methods': methods, 'thresholds': [round(1-c,2) for c in thresholds]}, f)
+        print(f'shard {shard[0]}/{shard[1]} of run {store.run} done')
+
+def merge(args, para):
+    """Combine the partial results of all shards of a run into the tables,
+    charts and aggregate metrics of a single-node run."""
+    import pandas as pd
+    from cellmorphology import dump_morphology
+
+    store = ResultStore(os.path.join(args.output_path, 'results'))
+    markers = glob.glob(os.path.join(args.output_path, '*-shard*of*.done'))
+    infos = []
+    for path in markers:
+        with open(path) as f:
+            infos.append(json.load(f))
+    runs = sorted({i['run'] for i in infos})
+    run = args.run
+    if run is None:
+        if len(runs) != 1:
+            raise ValueError('Found the sharded runs {} in {}, select one with --run'.format(
+                runs, args.output_path))
+        run = runs[0]
+
+    infos = [i for i in infos if i['run'] == run]
+    if not infos:
+        raise ValueError('No shards of run {} in {}'.format(run, args.output_path))
+    count = infos[0]['shard'][1]
+    missing = sorted(set(range(count)) - {i['shard'][0] for i in infos})
+    if missing:
+        raise ValueError('Shards {} of {} of run {} are missing'.format(missing, count, run))
+    dataset_name, methods = infos[0]['dataset'], infos[0]['methods']
+
+    # merge the accumulators of each output directory and method
+    summaries = {}
+    pattern = os.path.join(args.output_path, '**', '*_summary_{}-shard*of{}.json'.format(run, count))
+    for path in glob.glob(pattern, recursive=True):
+        with open(path) as f:
+            data = json.load(f)
+        accumulator = MetricAccumulator.from_dict(data)
+        out_dir = summaries.setdefault(os.path.dirname(path), {})
+        if data['method'] in out_dir:
+            out_dir[data['method']][1].merge(accumulator)
+        else:
+            out_dir[data['method']] = (data['threshold'], accumulator)
+
+    # parts are read in the order they were written, keep the latest
+    # results of images evaluated more than once
+    results = store.read(run=run).drop_duplicates(
+        subset=['method', 'threshold', 'image'], keep='last')
+    for out_dir, accumulators in sorted(summaries.items()):
+        dataset_dct = {}
+        for m in [m for m in methods if m in accumulators]:
+            threshold, accumulator = accumulators[m]
+            dataset_dct[m] = dataset_metrics(accumulator)
+            write_summary(os.path.join(out_dir, '{}_summary_{}.json'.format(m, run)), accumulator,
+                          method=m, threshold=threshold, dataset=dataset_name, run=run, shard=None)
+        threshold_results = results[np.isclose(results['threshold'], threshold)]
+        threshold_results = threshold_results.drop(columns=['run', 'dataset', 'threshold'])
+        if args.excel:
+            for m, table in threshold_results.groupby('method'):
+                table.drop(columns='method').set_index('image').to_excel(
+                    os.path.join(out_dir, '{}_cell_segmenatation_{}.xlsx'.format(m, run)))
+        print(f"IoU threshold {threshold}: {dataset_dct}")
+        render_report([(out_dir, threshold, dataset_dct, threshold_results)], dataset_name)
+
+    # 合并各分片的细胞形态学特征
+    parts = sorted(glob.glob(os.path.join(args.output_path, 'cellmorphology-{}-shard*.csv'.format(run))))
+    if parts:
+        dump_morphology(pd.concat([pd.read_csv(p) for p in parts], ignore_index=True),
+                        args.output_path)
+    print(f'merged {count} shards of run {run}')
 
 usage = """ Evaluate cell segmentation """
 PROG_VERSION = 'v0.0.1'
@@ -307,6 +473,9 @@ PROG_VERSION = 'v0.0.1'
 示例：
 python cell_eval_multi.py --gt_path /home/share/gt --dt_path /home/share/dt --output_path /home/share/output --multi_threshold
 如果不需要多阈值评估，则不传入 --multi_threshold 参数（默认使用阈值 0.55）
+多节点分片运行（共享文件系统），每个节点运行一个分片，最后合并：
+python cell_eval_multi.py -g ... -d ... -o /home/share/output --multi_threshold --shard 0/20
+python cell_eval_multi.py merge -o /home/share/output
 """
 
 if __name__ == '__main__':
@@ -320,10 +489,28 @@ if __name__ == '__main__':
                         help="Output result path.")
     parser.add_argument("--multi_threshold", action="store_true", 
                         help="开启多阈值评估功能，依次使用0.2、0.6、0.8进行评估并分别保存结果。")
+    parser.add_argument("--excel", action="store_true",
+                        help="Also export the per-image results of each method to Excel.")
+    parser.add_argument("--shard", action="store", dest="shard", type=str, default=None,
+                        help="Only evaluate shard i/N (0 <= i < N) of the images, "
+                             "combine all shards with the merge subcommand.")
+    parser.add_argument("--run", action="store", dest="run", type=str, default=None,
+                        help="Run id of the results, shards of a run derive the same id by default.")
     parser.set_defaults(func=main)
 
-    (para, args) = parser.parse_known_args()
+    merge_parser = argparse.ArgumentParser(prog='{} merge'.format(sys.argv[0]),
+                                           description='Merge the results of all shards of a run.')
+    merge_parser.add_argument("-o", "--output_path", action="store", dest="output_path", type=str,
+                              required=True, help="Output result path shared by the shards.")
+    merge_parser.add_argument("--run", action="store", dest="run", type=str, default=None,
+                              help="Run id to merge, required if there are several sharded runs.")
+    merge_parser.add_argument("--excel", action="store_true",
+                              help="Also export the per-image results of each method to Excel.")
+    merge_parser.set_defaults(func=merge)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        (para, args) = merge_parser.parse_known_args(sys.argv[2:])
+    else:
+        (para, args) = parser.parse_known_args()
     print(para, args)
     para.func(para, args)
-    # 对 cellmorphology 的调用，这里保持不变
-    cellmorphology(para.gt_path, para.output_path)
@@ -0,0 +1,136 @@
+"""Per-cell morphology features of labeled masks.
+
+The shape features of every cell are computed in-process with
+``skimage.measure.regionprops_table``, one table per image, and the images
+are processed in parallel worker processes. The masks are passed in as
+arrays, so masks already loaded for the evaluation are not read again.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# region properties computed for every cell, see skimage.measure.regionprops
+DEFAULT_PROPERTIES = (
+    'label',
+    'area',
+    'perimeter',
+    'eccentricity',
+    'solidity',
+    'extent',
+    'axis_major_length',
+    'axis_minor_length',
+    'orientation',
+    'equivalent_diameter_area',
+    'centroid',
+)
+
+
+def cell_morphology(mask, properties=DEFAULT_PROPERTIES):
+    """Compute the morphology features of all cells of a single mask.
+
+    Args:
+        mask (numpy.array): labeled 2D mask, 0 being the background.
+        properties (tuple): region properties to compute, see
+            ``skimage.measure.regionprops_table``.
+
+    Returns:
+        pandas.DataFrame: one row per cell. If both ``area`` and
+            ``perimeter`` are computed, the ``circularity``
+            4 * pi * area / perimeter ** 2 is added.
+    """
+    from skimage.measure import regionprops_table
+
+    mask = np.squeeze(mask)
+    if mask.ndim != 2:
+        raise ValueError('Expected a 2D mask. Got shape: {}'.format(mask.shape))
+
+    features = pd.DataFrame(regionprops_table(mask, properties=properties))
+    if 'area' in features.columns and 'perimeter' in features.columns:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            circularity = 4 * np.pi * features['area'] / features['perimeter'] ** 2
+        features['circularity'] = circularity.replace(np.inf, np.nan)
+    return features
+
+
+def _image_morphology(mask, name, properties):
+    features = cell_morphology(mask, properties=properties)
+    features.insert(0, 'image', name)
+    return features
+
+
+def extract_morphology(masks, names=None, properties=DEFAULT_PROPERTIES, num_workers=None):
+    """Compute the morphology features of all cells of a stack of masks.
+
+    Args:
+        masks (numpy.array): labeled masks, (batch, x, y) or (batch, x, y, 1),
+            or a list of 2D masks.
+        names (list): name of each mask, defaults to the mask index.
+        properties (tuple): region properties to compute.
+        num_workers (int): maximum number of worker processes,
+            defaults to the number of CPUs.
+
+    Returns:
+        pandas.DataFrame: one row per cell, with the ``image`` it belongs to.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    masks = list(masks)
+    if names is None:
+        names = ['{:05d}'.format(i) for i in range(len(masks))]
+    if len(names) != len(masks):
+        raise ValueError('Got {} names for {} masks'.format(len(names), len(masks)))
+
+    args = (masks, names, [properties] * len(masks))
+
+    if num_workers == 1 or len(masks) < 2:
+        frames = list(map(_image_morphology, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            frames = list(executor.map(_image_morphology, *args))
+
+    if not frames:
+        return pd.DataFrame(columns=['image'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def summarize_morphology(features):
+    """Number of cells and mean of every feature, per image.
+
+    Args:
+        features (pandas.DataFrame): output of ``extract_morphology``.
+
+    Returns:
+        pandas.DataFrame: one row per image, indexed by the image name.
+    """
+    columns = [c for c in features.columns if c not in {'image', 'label'}]
+    grouped = features.groupby('image', sort=False)
+    summary = grouped[columns].mean()
+    summary.insert(0, 'n_cells', grouped.size())
+    return summary
+
+
+def dump_morphology(features, output_path, suffix=''):
+    """Write the per-cell features and their per-image summary as CSV.
+
+    Args:
+        features (pandas.DataFrame): output of ``extract_morphology``.
+        output_path (str): directory to write the tables to.
+        suffix (str): appended to the file names, e.g. to tell shards apart.
+
+    Returns:
+        tuple(str, str): paths of the per-cell table and of the summary.
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    cells_path = os.path.join(output_path, 'cellmorphology{}.csv'.format(suffix))
+    summary_path = os.path.join(output_path, 'cellmorphology_summary{}.csv'.format(suffix))
+    features.to_csv(cells_path, index=False)
+    summarize_morphology(features).to_csv(summary_path)
+    return cells_path, summary_path
@@ -1,33 +1,35 @@
 import numpy as np
 
-def compute_overlap(boxes, query_boxes):
+# number of box pairs per chunk, bounds the size of the temporary arrays
+CHUNK_SIZE = 1 << 22
+
+def _box_overlap(boxes, query_boxes, ndim):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 2 * ndim)
+    query_boxes = np.asarray(query_boxes, dtype=np.float64).reshape(-1, 2 * ndim)
     N = boxes.shape[0]
     K = query_boxes.shape[0]
     overlaps = np.zeros((N, K), dtype=np.float64)
-    for k in range(K):
-        box_area = ((query_boxes[k, 2] - query_boxes[k, 0] + 1) * (query_boxes[k, 3] - query_boxes[k, 1] + 1))
-        for n in range(N):
-            iw = min(boxes[n, 2], query_boxes[k, 2]) - max(boxes[n, 0], query_boxes[k, 0]) + 1
-            if iw > 0:
-                ih = min(boxes[n, 3], query_boxes[k, 3]) - max(boxes[n, 1], query_boxes[k, 1]) + 1
-                if ih > 0:
-                    ua = (boxes[n, 2] - boxes[n, 0] + 1) * (boxes[n, 3] - boxes[n, 1] + 1) + box_area - iw * ih
-                    overlaps[n, k] = iw * ih / ua
+    if not N or not K:
+        return overlaps
+
+    box_sizes = np.prod(boxes[:, ndim:] - boxes[:, :ndim] + 1, axis=1)
+    query_sizes = np.prod(query_boxes[:, ndim:] - query_boxes[:, :ndim] + 1, axis=1)
+
+    step = max(1, CHUNK_SIZE // K)
+    for start in range(0, N, step):
+        chunk = boxes[start:start + step]
+        intersection = np.ones((chunk.shape[0], K), dtype=np.float64)
+        for d in range(ndim):
+            side = (np.minimum(chunk[:, ndim + d, None], query_boxes[None, :, ndim + d]) -
+                    np.maximum(chunk[:, d, None], query_boxes[None, :, d]) + 1)
+            np.maximum(side, 0, out=side)
+            intersection *= side
+        union = box_sizes[start:start + step, None] + query_sizes[None, :] - intersection
+        overlaps[start:start + step] = intersection / union
     return overlaps
 
+def compute_overlap(boxes, query_boxes):
+    return _box_overlap(boxes, query_boxes, 2)
+
 def compute_overlap_3D(boxes, query_boxes):
-    N = boxes.shape[0]
-    K = query_boxes.shape[0]
-    overlaps = np.zeros((N, K), dtype=np.float64)
-    for k in range(K):
-        box_volume = ((query_boxes[k, 3] - query_boxes[k, 0] + 1) * (query_boxes[k, 4] - query_boxes[k, 1] + 1) * (query_boxes[k, 5] - query_boxes[k, 2] + 1))
-        for n in range(N):
-            id = min(boxes[n, 3], query_boxes[k, 3]) - max(boxes[n, 0], query_boxes[k, 0]) + 1
-            if id > 0:
-                iw = min(boxes[n, 4], query_boxes[k, 4]) - max(boxes[n, 1], query_boxes[k, 1]) + 1
-                if iw > 0:
-                    ih = min(boxes[n, 5], query_boxes[k, 5]) - max(boxes[n, 2], query_boxes[k, 2]) + 1
-                    if ih > 0:
-                        ua = (boxes[n, 3] - boxes[n, 0] + 1) * (boxes[n, 4] - boxes[n, 1] + 1) * (boxes[n, 5] - boxes[n, 2] + 1) + box_volume - iw * ih * id
-                        overlaps[n, k] = iw * ih * id / ua
-    return overlaps
+    return _box_overlap(boxes, query_boxes, 3)
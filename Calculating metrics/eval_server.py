@@ -0,0 +1,325 @@
+"""Local evaluation server that keeps ground truth datasets resident.
+
+The GT masks of every dataset are loaded and labeled once at startup. Clients
+then only send their predictions, either as paths of mask files or as raw
+label arrays, and get the ``ObjectMetrics`` of every image back together with
+the micro and macro averages of the request. The images of a request are split
+into batches that are evaluated by a pool of worker processes, which inherit
+the resident GT masks when they are forked.
+
+Start the server:
+    python eval_server.py --dataset HE=/data/HE/gt --port 8765
+
+Endpoints:
+    GET  /datasets   names and number of images of the resident datasets
+    POST /evaluate   JSON ``{"dataset": "HE", "cutoff": 0.55,
+                     "predictions": {"<image key>": "<mask path>", ...}}``,
+                     or an ``.npz`` body of label arrays named by their image
+                     key, with ``?dataset=HE&cutoff=0.55`` in the URL
+
+Image keys are paths relative to the dataset root, either of the GT file
+(``a/x_mask.tif``) or of the matching DT file (``a/x_img.tif``).
+
+Example client:
+    >>> from eval_server import evaluate
+    >>> result = evaluate('http://127.0.0.1:8765', 'HE', {'x_img.tif': '/pred/x_img.tif'})
+    >>> result['micro']['f1']
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import tqdm
+
+from cell_eval_multi import load_mask
+from manifest import DatasetManifest, pair_key
+from metrics import MetricAccumulator, ObjectMetrics
+
+models_logger = logging.getLogger(__name__)
+
+# resident GT masks of every dataset, name -> {image key: labeled mask}
+_DATASETS = {}
+
+
+def _json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(o)))
+
+
+def load_dataset(gt_root):
+    """Load and label all GT masks below gt_root.
+
+    Returns:
+        dict: maps the path of each mask relative to gt_root to its labels.
+    """
+    files = DatasetManifest().scan(gt_root)
+    return {f: load_mask('{}/{}'.format(gt_root, f))
+            for f in tqdm.tqdm(files, desc='Load GT {}'.format(gt_root))}
+
+
+def _set_datasets(datasets):
+    _DATASETS.update(datasets)
+
+
+def _pad_to(arr, shape):
+    if arr.shape == shape:
+        return arr
+    padded = np.zeros(shape, dtype=arr.dtype)
+    padded[tuple(slice(0, s) for s in arr.shape)] = arr
+    return padded
+
+
+def _evaluate_batch(dataset, items, cutoff):
+    """Evaluate a batch of (image key, prediction) items of a dataset.
+
+    Returns:
+        tuple(dict, dict): the metrics of each image and the serialized
+            ``MetricAccumulator`` of the batch.
+    """
+    from skimage.measure import label
+
+    gt_masks = _DATASETS[dataset]
+    accumulator = MetricAccumulator()
+    results = {}
+    for key, prediction in items:
+        gt = gt_masks[key]
+        if isinstance(prediction, str):
+            pred = load_mask(prediction)
+        else:
+            pred = label(np.asarray(prediction), connectivity=2)
+        shape = tuple(np.maximum(gt.shape, pred.shape))
+        o = ObjectMetrics(_pad_to(gt, shape), _pad_to(pred, shape), cutoff1=cutoff)
+        results[key] = o.to_dict()
+        accumulator.update(o)
+    return results, accumulator.to_dict()
+
+
+class EvaluationServer(ThreadingHTTPServer):
+    """HTTP server evaluating predictions against resident GT datasets.
+
+    The datasets have to be loaded into the module before the server is
+    created, so the forked worker processes share them.
+
+    Args:
+        address (tuple): (host, port) to listen on.
+        num_workers (int): maximum number of worker processes,
+            defaults to the number of CPUs.
+        batch_size (int): number of images evaluated per worker task.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, num_workers=None, batch_size=8):
+        self.batch_size = batch_size
+        # created before binding, server_close also runs if binding fails
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # forked workers share the resident GT masks copy-on-write
+            self.executor = ProcessPoolExecutor(
+                max_workers=num_workers, mp_context=multiprocessing.get_context('fork'))
+        else:
+            self.executor = ProcessPoolExecutor(
+                max_workers=num_workers, initializer=_set_datasets, initargs=(dict(_DATASETS),))
+        super(EvaluationServer, self).__init__(address, _EvaluationHandler)
+
+    def server_close(self):
+        super(EvaluationServer, self).server_close()
+        self.executor.shutdown(wait=False)
+
+    def datasets(self):
+        return {name: len(masks) for name, masks in _DATASETS.items()}
+
+    def _resolve(self, dataset, keys):
+        """Map image keys, of GT or DT files, to the keys of the GT masks."""
+        if dataset not in _DATASETS:
+            raise ValueError('Unknown dataset: {}'.format(dataset))
+        gt_masks = _DATASETS[dataset]
+        resolved, unknown = {}, []
+        for key in keys:
+            for candidate in (key, pair_key(key, is_dt=True)):
+                if candidate in gt_masks:
+                    resolved[key] = candidate
+                    break
+            else:
+                unknown.append(key)
+        if unknown:
+            raise ValueError('No GT in {} for: {}'.format(dataset, unknown[:10]))
+        return resolved
+
+    def evaluate(self, dataset, predictions, cutoff=0.55):
+        """Evaluate the predictions of some images of a dataset.
+
+        Args:
+            dataset (str): name of a resident dataset.
+            predictions (dict): maps image keys to mask paths or label arrays.
+            cutoff (float): ``cutoff1`` of ``ObjectMetrics``.
+
+        Returns:
+            dict: metrics of each image, summed counts and micro and macro
+                averages.
+
+        Raises:
+            ValueError: Unknown dataset or images
+            OSError: If a prediction can not be read
+        """
+        resolved = self._resolve(dataset, predictions)
+        items = [(resolved[k], v) for k, v in predictions.items()]
+        futures = [self.executor.submit(_evaluate_batch, dataset,
+                                        items[i:i + self.batch_size], cutoff)
+                   for i in range(0, len(items), self.batch_size)]
+
+        images = {}
+        accumulator = MetricAccumulator()
+        for future in futures:
+            batch_results, batch_accumulator = future.result()
+            images.update(batch_results)
+            accumulator.merge(MetricAccumulator.from_dict(batch_accumulator))
+
+        response = {'dataset': dataset, 'cutoff': cutoff, 'images': images}
+        response.update(accumulator.to_dict())
+        response['micro'] = accumulator.result(average='micro')
+        response['macro'] = accumulator.result(average='macro')
+        return response
+
+
+class _EvaluationHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, default=_json_default).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/datasets':
+            self._send_json(self.server.datasets())
+        else:
+            self._send_json({'error': 'Not found: {}'.format(self.path)}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/evaluate':
+            self._send_json({'error': 'Not found: {}'.format(self.path)}, status=404)
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(body)
+                predictions = request['predictions']
+            else:
+                # npz of label arrays, the parameters are in the query string
+                request = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                with np.load(io.BytesIO(body)) as data:
+                    predictions = {k: data[k] for k in data.files}
+            response = self.server.evaluate(request['dataset'], predictions,
+                                            cutoff=float(request.get('cutoff', 0.55)))
+        except (KeyError, ValueError, OSError) as e:
+            # malformed requests, unknown images or unreadable predictions
+            self._send_json({'error': '{}: {}'.format(type(e).__name__, e)}, status=400)
+            return
+        except Exception as e:  # pylint: disable=broad-except
+            models_logger.exception('Failed to evaluate {}'.format(self.path))
+            self._send_json({'error': '{}: {}'.format(type(e).__name__, e)}, status=500)
+            return
+        self._send_json(response)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        models_logger.info('%s - %s', self.address_string(), format % args)
+
+
+def evaluate(url, dataset, predictions, cutoff=0.55, timeout=None):
+    """Evaluate predictions with a running evaluation server.
+
+    Args:
+        url (str): address of the server, e.g. 'http://127.0.0.1:8765'.
+        dataset (str): name of a resident dataset.
+        predictions (dict): maps image keys to either mask paths, readable
+            by the server, or label arrays.
+        cutoff (float): ``cutoff1`` of ``ObjectMetrics``.
+        timeout (float): timeout of the request in seconds.
+
+    Returns:
+        dict: the response of the server, see ``EvaluationServer.evaluate``.
+
+    Raises:
+        ValueError: If paths and arrays are mixed
+        urllib.error.HTTPError: If the server rejects the request
+    """
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+
+    is_path = [isinstance(v, str) for v in predictions.values()]
+    if all(is_path):
+        body = json.dumps({'dataset': dataset, 'cutoff': cutoff,
+                           'predictions': predictions}).encode('utf-8')
+        request = Request(url.rstrip('/') + '/evaluate', data=body,
+                          headers={'Content-Type': 'application/json'})
+    elif not any(is_path):
+        buffer = io.BytesIO()
+        np.savez(buffer, **predictions)
+        query = urlencode({'dataset': dataset, 'cutoff': cutoff})
+        request = Request(url.rstrip('/') + '/evaluate?' + query, data=buffer.getvalue(),
+                          headers={'Content-Type': 'application/x-npz'})
+    else:
+        raise ValueError('Predictions must be either all paths or all arrays')
+
+    with urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def _warm_up():
+    """Evaluate a GT mask against itself, so the lazily imported modules are
+    loaded before the workers are forked."""
+    for masks in _DATASETS.values():
+        for mask in masks.values():
+            ObjectMetrics(mask, mask).to_dict()
+            return
+
+
+def main(args):
+    for dataset in args.datasets:
+        name, _, gt_root = dataset.partition('=')
+        if not gt_root:
+            raise ValueError('Invalid dataset {}, expected NAME=PATH'.format(dataset))
+        _DATASETS[name] = load_dataset(gt_root)
+    _warm_up()
+
+    server = EvaluationServer((args.host, args.port), num_workers=args.num_workers,
+                              batch_size=args.batch_size)
+    print('Serving {} on http://{}:{}'.format(server.datasets(), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate predictions against resident GT datasets.')
+    parser.add_argument('--dataset', action='append', dest='datasets', required=True,
+                        help='GT dataset as NAME=PATH, may be repeated.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on, local only by default.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on.')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Number of worker processes, defaults to the number of CPUs.')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='Number of images evaluated per worker task.')
+    main(parser.parse_args())
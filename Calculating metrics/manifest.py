@@ -0,0 +1,231 @@
+"""Indexed manifest of the image files of GT and DT datasets.
+
+A ``DatasetManifest`` records the files of every scanned directory together
+with the directory mtime and the size and mtime of each file. Directories
+whose mtime did not change since the last scan are not listed again, so with a
+persisted manifest later runs only rescan the directories that changed.
+
+GT and DT files are paired through hash lookups of normalized keys: the path
+of a file relative to its dataset root, with 'img' replaced by 'mask' for DT
+files, i.e. ``dt/a/x_img.tif`` is paired with ``gt/a/x_mask.tif``.
+
+Pairs can be split into shards for multi-node runs. The shard of a pair only
+depends on the CRC32 of its GT key, so every node assigns the same images to
+the same shard, independent of the method, threshold or file system order.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+import zlib
+
+models_logger = logging.getLogger(__name__)
+
+IMAGE_EXTS = ('.tif', '.png', '.jpg')
+
+MANIFEST_VERSION = 1
+
+
+def pair_key(relpath, is_dt):
+    """Normalized key of a GT or DT file path relative to its dataset root."""
+    return relpath.replace('img', 'mask') if is_dt else relpath
+
+
+def shard_of(key, count):
+    """Deterministic shard in [0, count) of a work unit key."""
+    return zlib.crc32(key.replace(os.sep, '/').encode('utf-8')) % count
+
+
+def parse_shard(shard):
+    """Parse a shard 'i/N' into (i, N), i being 0-based.
+
+    Raises:
+        ValueError: If shard is not of the form 'i/N' with 0 <= i < N
+    """
+    try:
+        index, count = (int(v) for v in shard.split('/'))
+    except ValueError:
+        raise ValueError('Invalid shard {}, expected i/N'.format(shard))
+    if not 0 <= index < count:
+        raise ValueError('Invalid shard {}, expected 0 <= i < N'.format(shard))
+    return index, count
+
+
+class DatasetManifest(object):  # pylint: disable=useless-object-inheritance
+    """Scan, pair and describe the image files of GT and DT datasets.
+
+    Args:
+        path (str): JSON file to persist the manifest to. If it exists, the
+            manifest is loaded from it. Defaults to an in-memory manifest.
+        exts (tuple): extensions of the image files.
+    """
+
+    def __init__(self, path=None, exts=IMAGE_EXTS):
+        self.path = path
+        self.exts = tuple(exts)
+
+        # directory -> {'mtime': ..., 'files': {name: [size, mtime]}, 'subdirs': [...]}
+        self._dirs = {}
+        # file -> [size, mtime, shape]
+        self._shapes = {}
+        # roots already scanned by this instance, their files and pairs
+        self._files = {}
+        self._pairs = {}
+        self._changed = False
+
+        if path is not None and os.path.exists(path):
+            self._load(path)
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except ValueError:
+            models_logger.warning('Ignoring invalid manifest {}'.format(path))
+            return
+        if data.get('version') != MANIFEST_VERSION:
+            return
+        self._dirs = data.get('dirs', {})
+        self._shapes = data.get('shapes', {})
+
+    def save(self, path=None):
+        """Write the manifest as JSON, if anything changed since loading.
+
+        Returns:
+            str: path of the manifest, None for an in-memory manifest.
+        """
+        path = path or self.path
+        if path is None or not self._changed:
+            return path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        data = {'version': MANIFEST_VERSION, 'dirs': self._dirs, 'shapes': self._shapes}
+        # write to a temporary file first, so readers never see partial
+        # manifests, one per process as shards may share the output path
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+        self._changed = False
+        return path
+
+    def _scan_dir(self, directory):
+        """List a single directory, or reuse its entry if it did not change."""
+        mtime = os.stat(directory).st_mtime_ns
+        entry = self._dirs.get(directory)
+        if entry is not None and entry['mtime'] == mtime:
+            return entry
+
+        files, subdirs = {}, []
+        with os.scandir(directory) as entries:
+            for e in entries:
+                if '.ipynb_checkpoints' in e.name:
+                    continue
+                if e.is_dir():
+                    subdirs.append(e.name)
+                else:
+                    stat = e.stat()
+                    files[e.name] = [stat.st_size, stat.st_mtime_ns]
+        entry = {'mtime': mtime, 'files': files, 'subdirs': sorted(subdirs)}
+        self._dirs[directory] = entry
+        self._changed = True
+        return entry
+
+    def scan(self, root):
+        """Image files below ``root``, rescanning only changed directories.
+
+        Args:
+            root (str): dataset directory.
+
+        Returns:
+            list: sorted paths of the image files relative to ``root``.
+        """
+        root = os.path.abspath(root)
+        if root in self._files:
+            return self._files[root]
+
+        files, visited, stack = [], set(), [root]
+        while stack:
+            directory = stack.pop()
+            visited.add(directory)
+            entry = self._scan_dir(directory)
+            relative = os.path.relpath(directory, root)
+            prefix = '' if relative == os.curdir else relative + os.sep
+            files.extend(prefix + name for name in entry['files'] if name.endswith(self.exts))
+            stack.extend(os.path.join(directory, d) for d in entry['subdirs'])
+
+        # forget directories below root that no longer exist
+        prefix = root + os.sep
+        stale = [d for d in self._dirs if d.startswith(prefix) and d not in visited]
+        for d in stale:
+            del self._dirs[d]
+        self._changed |= bool(stale)
+
+        self._files[root] = sorted(files)
+        return self._files[root]
+
+    def pair(self, gt_root, dt_root, shard=None):
+        """Pair every DT file with its GT file.
+
+        Args:
+            gt_root (str): GT dataset directory.
+            dt_root (str): DT dataset directory.
+            shard (tuple): optional (index, count), to keep only the pairs
+                of one of count shards.
+
+        Returns:
+            list: (GT path, DT path) tuples, in the order of the DT files.
+                DT files without a GT file are skipped with a warning.
+        """
+        gt_root, dt_root = os.path.abspath(gt_root), os.path.abspath(dt_root)
+        if shard is not None:
+            index, count = shard
+            prefix_length = len(gt_root) + len(os.sep)
+            return [(gt, dt) for gt, dt in self.pair(gt_root, dt_root)
+                    if shard_of(gt[prefix_length:], count) == index]
+        if (gt_root, dt_root) in self._pairs:
+            return self._pairs[(gt_root, dt_root)]
+
+        gt_files = {pair_key(f, is_dt=False): f for f in self.scan(gt_root)}
+        gt_prefix, dt_prefix = gt_root + os.sep, dt_root + os.sep
+        pairs, missing = [], 0
+        for f in self.scan(dt_root):
+            gt_file = gt_files.get(pair_key(f, is_dt=True))
+            if gt_file is None:
+                missing += 1
+                continue
+            pairs.append((gt_prefix + gt_file, dt_prefix + f))
+        if missing:
+            models_logger.warning('{} files of {} have no GT in {}'.format(
+                missing, dt_root, gt_root))
+
+        self._pairs[(gt_root, dt_root)] = pairs
+        return pairs
+
+    def shape(self, path):
+        """Shape of the first page of an image, read from the file header
+        only once for each size and mtime of the file.
+
+        The file itself is stat'ed on every call: overwriting a file in
+        place does not change the mtime of its directory, so the records of
+        an unchanged directory entry may be stale.
+        """
+        import tifffile
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+        cached = self._shapes.get(path)
+        if cached is not None and cached[:2] == [size, mtime]:
+            return tuple(cached[2])
+
+        with tifffile.TiffFile(path) as tif:
+            shape = tuple(tif.pages[0].shape)
+        self._shapes[path] = [size, mtime, list(shape)]
+        self._changed = True
+        return shape
@@ -0,0 +1,34 @@
+"""Tests for the dataset manifest"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import tifffile
+
+from manifest import DatasetManifest
+
+
+def test_shape_of_file_overwritten_in_place(tmpdir):
+    dt_path = os.path.join(str(tmpdir), 'dt')
+    os.makedirs(dt_path)
+    image_path = os.path.join(dt_path, 'a_img.tif')
+    manifest_path = os.path.join(str(tmpdir), 'manifest.json')
+
+    tifffile.imwrite(image_path, np.zeros((32, 32), dtype='uint8'))
+    manifest = DatasetManifest(manifest_path)
+    assert manifest.scan(dt_path) == ['a_img.tif']
+    assert manifest.shape(image_path) == (32, 32)
+    manifest.save()
+
+    # overwriting the file does not change the mtime of its directory
+    dir_mtime = os.stat(dt_path).st_mtime_ns
+    tifffile.imwrite(image_path, np.zeros((64, 48), dtype='uint8'))
+    os.utime(dt_path, ns=(dir_mtime, dir_mtime))
+
+    manifest = DatasetManifest(manifest_path)
+    assert manifest.scan(dt_path) == ['a_img.tif']
+    assert manifest.shape(image_path) == (64, 48)
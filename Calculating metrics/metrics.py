@@ -49,27 +49,98 @@ import os
 import warnings
 
 import numpy as np
-import pandas as pd
-import networkx as nx
 
-from scipy.optimize import linear_sum_assignment
-from scipy.stats import hmean
-from skimage.measure import regionprops
-from skimage.segmentation import relabel_sequential
-from sklearn.metrics import confusion_matrix
-from tqdm import tqdm
+from scipy import sparse
 
-from utils import erode_edges
-
-import pyximport
-pyximport.install()
-from compute_overlap import compute_overlap  # pylint: disable=E0401
+# pandas, networkx, sklearn, skimage and the rest of scipy are imported
+# where they are used, so importing this module stays fast
+from compute_overlap import compute_overlap
 from compute_overlap import compute_overlap_3D
 del absolute_import
 del division
 del print_function
 
 
+# stages of ObjectMetrics and the stages each of them depends on
+OBJECT_STAGES = {
+    'iou': (),
+    'modified_iou': ('iou',),
+    'assignment': ('modified_iou',),
+    'seg': ('assignment',),
+    'classification': ('assignment',),
+    'graph': ('assignment',),
+    'pixel': (),
+}
+
+# metrics of ObjectMetrics.to_dict and the stages they depend on
+OBJECT_METRICS = {
+    'n_pred': (),
+    'n_true': (),
+    'correct_detections': ('classification',),
+    'missed_detections': ('classification',),
+    'gained_detections': ('classification',),
+    'missed_det_from_merge': ('classification',),
+    'gained_det_from_split': ('classification',),
+    'true_det_in_catastrophe': ('classification',),
+    'pred_det_in_catastrophe': ('classification',),
+    'merge': ('classification',),
+    'split': ('classification',),
+    'catastrophe': ('classification',),
+    'precision': ('classification',),
+    'recall': ('classification',),
+    'f1': ('classification',),
+    'seg': ('seg',),
+    'jaccard': ('pixel',),
+    'dice': ('pixel',),
+    'PQ': ('classification',),
+}
+
+
+def stage_plan(metrics):
+    """Stages of ``ObjectMetrics`` needed to compute some metrics.
+
+    Args:
+        metrics (iterable): names of metrics of ``OBJECT_METRICS``.
+
+    Returns:
+        list: the stages of ``OBJECT_STAGES``, in the order to run them.
+
+    Raises:
+        ValueError: Unknown metrics
+    """
+    metrics = list(metrics)
+    unknown = [m for m in metrics if m not in OBJECT_METRICS]
+    if unknown:
+        raise ValueError('Unknown metrics: {}. Choose from {}'.format(
+            unknown, list(OBJECT_METRICS)))
+
+    needed = set()
+    stack = [s for m in metrics for s in OBJECT_METRICS[m]]
+    while stack:
+        stage = stack.pop()
+        if stage not in needed:
+            needed.add(stage)
+            stack.extend(OBJECT_STAGES[stage])
+    # OBJECT_STAGES lists every stage after its dependencies
+    return [s for s in OBJECT_STAGES if s in needed]
+
+
+# error categories of ObjectMetrics.error_map, indexed by their value
+ERROR_CATEGORIES = ('background', 'missed', 'splits', 'merges',
+                    'gained', 'catastrophes', 'correct')
+
+# RGB color of each error category, a lookup table for the error map values
+ERROR_COLORS = np.array([
+    [0, 0, 0],  # background: black
+    [255, 192, 203],  # missed: pink
+    [0, 0, 255],  # splits: blue
+    [0, 128, 0],  # merges: green
+    [210, 180, 140],  # gained: tan
+    [255, 0, 0],  # catastrophes: red
+    [128, 128, 128],  # correct: grey
+], dtype='uint8')
+
+
 def _cast_to_tuple(x):
     try:
         tup_x = tuple(x)
@@ -78,6 +149,17 @@ def _cast_to_tuple(x):
     return tup_x
 
 
+def _hmean(a, b):
+    """Harmonic mean of two non-negative values, as ``scipy.stats.hmean``
+    but without importing ``scipy.stats``."""
+    values = np.array([a, b], dtype='float64')
+    if np.isnan(values).any():
+        return np.float64(np.nan)
+    if not values.all():
+        return np.float64(0)
+    return 1.0 / np.mean(1.0 / values)
+
+
 class Detection(object):  # pylint: disable=useless-object-inheritance
     """Object to hold relevant information about a given detection."""
 
@@ -231,6 +313,30 @@ class PixelMetrics(BaseMetrics):
         self._intersection = np.count_nonzero(np.logical_and(self.y_true, self.y_pred))
         self._union = np.count_nonzero(np.logical_or(self.y_true, self.y_pred))
 
+    @classmethod
+    def from_counts(cls, y_true_sum, y_pred_sum, intersection):
+        """Build pixel statistics from precomputed foreground counts.
+
+        Avoids materializing binary copies of large (e.g. 3D) label arrays
+        when the counts are already known.
+
+        Args:
+            y_true_sum (int): Number of foreground pixels in y_true
+            y_pred_sum (int): Number of foreground pixels in y_pred
+            intersection (int): Number of pixels foreground in both
+
+        Returns:
+            PixelMetrics: statistics without the underlying arrays.
+        """
+        pixel_metrics = cls.__new__(cls)
+        pixel_metrics.y_true = None
+        pixel_metrics.y_pred = None
+        pixel_metrics._y_true_sum = int(y_true_sum)
+        pixel_metrics._y_pred_sum = int(y_pred_sum)
+        pixel_metrics._intersection = int(intersection)
+        pixel_metrics._union = int(y_true_sum + y_pred_sum - intersection)
+        return pixel_metrics
+
     @classmethod
     def get_confusion_matrix(cls, y_true, y_pred, axis=-1):
         """Calculate confusion matrix for pixel classification data.
@@ -246,6 +352,8 @@ class PixelMetrics(BaseMetrics):
         """
         # Argmax collapses on feature dimension to assign class to each pixel
         # Flatten is required for confusion matrix
+        from sklearn.metrics import confusion_matrix
+
         y_true = y_true.argmax(axis=axis).flatten()
         y_pred = y_pred.argmax(axis=axis).flatten()
         x_ = confusion_matrix(y_true, y_pred)
@@ -277,7 +385,7 @@ class PixelMetrics(BaseMetrics):
         if np.isnan(_recall) and _precision == 0:
             return np.nan
 
-        f_measure = hmean([_recall, _precision])
+        f_measure = _hmean(_recall, _precision)
         # f_measure = (2 * _precision * _recall) / (_precision + _recall)
         return f_measure
 
@@ -319,15 +427,349 @@ def get_box_labels(arr):
         tuple(list(np.array), list(int)): A tuple of bounding boxes and
             the corresponding integer labels.
     """
-    props = regionprops(np.squeeze(arr.astype('int')), cache=False)
+    from scipy import ndimage
+
+    # find_objects slices use the (min, ..., max + 1) bbox format of regionprops
+    objects = ndimage.find_objects(np.squeeze(arr.astype('int')))
     boxes, labels = [], []
-    for prop in props:
-        boxes.append(np.array(prop.bbox))
-        labels.append(int(prop.label))
+    for i, obj in enumerate(objects):
+        if obj is None:
+            continue
+        boxes.append(np.array([s.start for s in obj] + [s.stop for s in obj]))
+        labels.append(i + 1)
     boxes = np.array(boxes).astype('double')
     return boxes, labels
 
 
+def _add_label_counts(areas, slab):
+    """Add the per-label pixel counts of ``slab`` to ``areas``, growing it
+    if ``slab`` contains labels beyond its current length."""
+    counts = np.bincount(slab.ravel().astype(np.intp, copy=False))
+    if counts.shape[0] > areas.shape[0]:
+        areas = np.pad(areas, (0, counts.shape[0] - areas.shape[0]))
+    areas[:counts.shape[0]] += counts
+    return areas
+
+
+def _update_label_boxes(boxes, slab, offset):
+    """Grow the per-label bounding boxes in ``boxes`` with the objects in
+    ``slab``, which starts at ``offset`` along the first axis."""
+    from scipy import ndimage
+
+    ndim = slab.ndim
+    objects = ndimage.find_objects(slab)
+    present = [i for i, obj in enumerate(objects) if obj is not None]
+    if not present:
+        return boxes
+
+    starts = np.array([[s.start for s in objects[i]] for i in present])
+    stops = np.array([[s.stop for s in objects[i]] for i in present])
+    starts[:, 0] += offset
+    stops[:, 0] += offset
+
+    labels = np.array(present) + 1
+    if labels[-1] >= boxes.shape[0]:
+        extra = labels[-1] + 1 - boxes.shape[0]
+        new_boxes = np.empty((extra, 2 * ndim), dtype=boxes.dtype)
+        new_boxes[:, :ndim] = np.iinfo(boxes.dtype).max
+        new_boxes[:, ndim:] = -1
+        boxes = np.concatenate([boxes, new_boxes])
+
+    boxes[labels, :ndim] = np.minimum(boxes[labels, :ndim], starts)
+    boxes[labels, ndim:] = np.maximum(boxes[labels, ndim:], stops)
+    return boxes
+
+
+def get_label_overlaps(y_true, y_pred, slab_size=8, return_boxes=True):
+    """Get the pairwise overlaps, areas and bounding boxes of all objects.
+
+    The arrays are streamed along their first axis in slabs of ``slab_size``
+    planes, so only one slab of each array is resident at a time. Memory-mapped
+    volumes can therefore be evaluated without any full-volume temporaries.
+
+    Args:
+        y_true (numpy.array): integer label array of true objects, labels
+            must be non-negative and smaller than 2**32.
+        y_pred (numpy.array): integer label array of predicted objects,
+            same shape as ``y_true``.
+        slab_size (int): number of planes along the first axis per slab.
+        return_boxes (bool): whether to also compute bounding boxes.
+
+    Returns:
+        dict: Overlap details. ``true_labels``, ``pred_labels`` and
+            ``intersections`` hold one entry per overlapping pair of objects.
+            ``true_areas`` and ``pred_areas`` are indexed by label (entry 0 is
+            background). If ``return_boxes``, ``true_boxes`` and ``pred_boxes``
+            are indexed by label and use the ``regionprops`` bbox format;
+            rows of absent labels are undefined.
+
+    Raises:
+        ValueError: If y_true and y_pred are not the same shape
+    """
+    if y_pred.shape != y_true.shape:
+        raise ValueError('Input shapes must match. Shape of prediction '
+                         'is: {}.  Shape of y_true is: {}'.format(
+                             y_pred.shape, y_true.shape))
+
+    ndim = y_true.ndim
+    empty_boxes = np.zeros((1, 2 * ndim), dtype='int64')
+    true_boxes, pred_boxes = empty_boxes, empty_boxes.copy()
+    true_areas = np.zeros(1, dtype='int64')
+    pred_areas = np.zeros(1, dtype='int64')
+    pair_keys, pair_counts = [], []
+
+    for start in range(0, y_true.shape[0], slab_size):
+        true_slab = np.asarray(y_true[start:start + slab_size])
+        pred_slab = np.asarray(y_pred[start:start + slab_size])
+
+        true_areas = _add_label_counts(true_areas, true_slab)
+        pred_areas = _add_label_counts(pred_areas, pred_slab)
+
+        if return_boxes:
+            true_boxes = _update_label_boxes(true_boxes, true_slab, start)
+            pred_boxes = _update_label_boxes(pred_boxes, pred_slab, start)
+
+        # encode each overlapping (true, pred) pixel as a single 64-bit key
+        is_both = np.logical_and(true_slab != 0, pred_slab != 0)
+        keys = np.left_shift(true_slab[is_both].astype('uint64'), np.uint64(32))
+        keys |= pred_slab[is_both].astype('uint64')
+        keys, counts = np.unique(keys, return_counts=True)
+        pair_keys.append(keys)
+        pair_counts.append(counts)
+
+    keys, inverse = np.unique(np.concatenate(pair_keys), return_inverse=True)
+    intersections = np.bincount(inverse.ravel(), weights=np.concatenate(pair_counts),
+                                minlength=keys.shape[0]).astype('int64')
+
+    overlaps = {}
+    overlaps['true_labels'] = np.right_shift(keys, np.uint64(32)).astype('int64')
+    overlaps['pred_labels'] = np.bitwise_and(keys, np.uint64(0xFFFFFFFF)).astype('int64')
+    overlaps['intersections'] = intersections
+    overlaps['true_areas'] = true_areas
+    overlaps['pred_areas'] = pred_areas
+    if return_boxes:
+        overlaps['true_boxes'] = true_boxes
+        overlaps['pred_boxes'] = pred_boxes
+    return overlaps
+
+
+def _sparse_indices_above(matrix, index, threshold):
+    """Indices of the stored values of one row of a CSR matrix (or column
+    of a CSC matrix) that are at least ``threshold``."""
+    start, stop = matrix.indptr[index], matrix.indptr[index + 1]
+    return matrix.indices[start:stop][matrix.data[start:stop] >= threshold]
+
+
+def _connected_components(n_nodes, first, second):
+    """Connected components of an undirected graph given by its edges.
+
+    Every node repeatedly takes the smallest label of its neighbors, with
+    pointer jumping, so the number of iterations grows with the logarithm of
+    the component diameter. Object overlap graphs have small components, so
+    this avoids the fixed cost of building sparse matrices for
+    ``scipy.sparse.csgraph.connected_components``.
+
+    Args:
+        n_nodes (int): number of nodes.
+        first (np.array): first node of each edge.
+        second (np.array): second node of each edge.
+
+    Returns:
+        tuple(int, np.array): number of components and the component of
+            each node.
+    """
+    labels = np.arange(n_nodes)
+    while True:
+        smallest = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, smallest)
+        np.minimum.at(updated, second, smallest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    components, labels = np.unique(labels, return_inverse=True)
+    return components.shape[0], labels
+
+
+def _get_cost_matrix(iou, cutoff1):
+    """Assembles cost matrix using the iou matrix and cutoff1
+
+    The previously calculated iou matrix is cast into the top left and
+    transposed for the bottom right corner. The diagonals of the two
+    remaining corners are populated according to cutoff1. The lower the
+    value of cutoff1 the more likely it is for the linear sum assignment
+    to pick unmatched assignments for objects.
+
+    Args:
+        iou (np.array): dense (modified) IoU matrix of the objects to assign.
+        cutoff1 (float): cost of leaving an object unassigned.
+    """
+    n_true, n_pred = iou.shape
+    n_obj = n_true + n_pred
+    matrix = np.ones((n_obj, n_obj))
+
+    # Assign 1 - iou to top left and bottom right
+    cost = 1 - iou
+    matrix[:n_true, :n_pred] = cost
+    matrix[n_obj - n_pred:, n_obj - n_true:] = cost.T
+
+    # Calculate diagonal corners
+    bl = (cutoff1 * np.eye(n_pred)
+          + np.ones((n_pred, n_pred))
+          - np.eye(n_pred))
+    tr = (cutoff1 * np.eye(n_true)
+          + np.ones((n_true, n_true))
+          - np.eye(n_true))
+
+    # Assign diagonals to cm
+    matrix[n_obj - n_pred:, :n_pred] = bl
+    matrix[:n_true, n_obj - n_true:] = tr
+    return matrix
+
+
+def _assign_objects(iou_modified, cutoff1):
+    """Runs linear sum assignment on the cost matrix, identifies true
+    positives.
+
+    Objects that do not overlap any object of the other frame can only
+    remain unassigned, so the assignment decomposes over the connected
+    components of the overlap graph. Each component is solved on its own
+    small cost matrix and components of a single true and predicted
+    object are solved directly, instead of assigning one dense
+    (n_true + n_pred) square matrix.
+
+    Args:
+        iou_modified (scipy.sparse.spmatrix): (n_true, n_pred) modified IoU.
+        cutoff1 (float): cost of leaving an object unassigned.
+
+    Returns:
+        tuple(np.array, np.array): indices of the matched true and
+            predicted objects.
+    """
+    n_true, n_pred = iou_modified.shape
+    iou = iou_modified.tocoo()
+    n_components, components = _connected_components(
+        n_true + n_pred, iou.row, iou.col + n_true)
+    true_components = components[:n_true]
+    pred_components = components[n_true:]
+
+    true_counts = np.bincount(true_components, minlength=n_components)
+    pred_counts = np.bincount(pred_components, minlength=n_components)
+
+    # a single pair is matched if that is cheaper than leaving both unassigned
+    edge_components = true_components[iou.row]
+    is_pair = np.logical_and(true_counts[edge_components] == 1,
+                             pred_counts[edge_components] == 1)
+    is_match = is_pair & (1 - iou.data <= cutoff1)
+    true_matches = [iou.row[is_match]]
+    pred_matches = [iou.col[is_match]]
+
+    # solve the remaining components with their own cost matrix
+    true_order = np.argsort(true_components, kind='stable')
+    pred_order = np.argsort(pred_components, kind='stable')
+    true_starts = np.concatenate([[0], np.cumsum(true_counts)])
+    pred_starts = np.concatenate([[0], np.cumsum(pred_counts)])
+
+    # position of each object within its component, and the IoU entries
+    # grouped by component, to fill the dense matrices without indexing
+    # the sparse matrix
+    true_rank = np.empty(n_true, dtype='int64')
+    true_rank[true_order] = np.arange(n_true) - true_starts[true_components[true_order]]
+    pred_rank = np.empty(n_pred, dtype='int64')
+    pred_rank[pred_order] = np.arange(n_pred) - pred_starts[pred_components[pred_order]]
+    edge_order = np.argsort(edge_components, kind='stable')
+    edge_starts = np.searchsorted(edge_components[edge_order], np.arange(n_components + 1))
+
+    for c in np.nonzero((true_counts + pred_counts > 2) & (true_counts > 0)
+                        & (pred_counts > 0))[0]:
+        true_idx = true_order[true_starts[c]:true_starts[c + 1]]
+        pred_idx = pred_order[pred_starts[c]:pred_starts[c + 1]]
+        edges = edge_order[edge_starts[c]:edge_starts[c + 1]]
+        component_iou = np.zeros((true_idx.size, pred_idx.size))
+        component_iou[true_rank[iou.row[edges]], pred_rank[iou.col[edges]]] = iou.data[edges]
+        cost_matrix = _get_cost_matrix(component_iou, cutoff1)
+
+        # only ambiguous components need the solver, import it lazily
+        from scipy.optimize import linear_sum_assignment
+        rows, cols = linear_sum_assignment(cost_matrix)
+        is_match = np.logical_and(rows < true_idx.size, cols < pred_idx.size)
+        true_matches.append(true_idx[rows[is_match]])
+        pred_matches.append(pred_idx[cols[is_match]])
+
+    true_matches = np.concatenate(true_matches).astype('int')
+    pred_matches = np.concatenate(pred_matches).astype('int')
+    order = np.argsort(true_matches, kind='stable')
+    return true_matches[order], pred_matches[order]
+
+
+def _classify_objects(iou, iou_modified, true_matches, pred_matches, cutoff2):
+    """Classify the objects left after the linear assignment.
+
+    The array counterpart of ``ObjectMetrics._array_to_graph`` and
+    ``ObjectMetrics._classify_graph``: unassigned objects with a modified IoU
+    of at least cutoff2 are linked into components. The objects of
+    components of at most two objects are missed or gained, larger
+    components are splits, merges or catastrophes. Catastrophes are linked
+    detections, so they are counted as correct detections as well.
+
+    Args:
+        iou (scipy.sparse.spmatrix): (n_true, n_pred) IoU.
+        iou_modified (scipy.sparse.spmatrix): (n_true, n_pred) modified IoU.
+        true_matches (np.array): indices of the assigned true objects.
+        pred_matches (np.array): indices of the assigned predicted objects.
+        cutoff2 (float): minimum modified IoU of linked unassigned objects.
+
+    Returns:
+        dict: the detection counts of ``ObjectMetrics`` and the IoU of each
+            correct detection as ``correct_iou``, for catastrophes the best
+            IoU of their objects.
+    """
+    n_true, n_pred = iou.shape
+    iou, iou_modified = iou.tocoo(), iou_modified.tocoo()
+
+    is_missed = np.ones(n_true, dtype='bool')
+    is_missed[true_matches] = False
+    is_gained = np.ones(n_pred, dtype='bool')
+    is_gained[pred_matches] = False
+
+    rows, cols = iou_modified.row, iou_modified.col
+    is_edge = is_missed[rows] & is_gained[cols] & (iou_modified.data >= cutoff2)
+    n_components, components = _connected_components(
+        n_true + n_pred, rows[is_edge], cols[is_edge] + n_true)
+    true_counts = np.bincount(components[:n_true][is_missed], minlength=n_components)
+    pred_counts = np.bincount(components[n_true:][is_gained], minlength=n_components)
+
+    is_single = true_counts + pred_counts <= 2
+    is_split = ~is_single & (true_counts == 1)
+    is_merge = ~is_single & (pred_counts == 1)
+    is_catastrophe = (true_counts > 1) & (pred_counts > 1)
+
+    keys = iou.row.astype('int64') * n_pred + iou.col
+    order = np.argsort(keys, kind='stable')
+    match_iou = iou.data[order[np.searchsorted(keys[order], true_matches * n_pred + pred_matches)]]
+
+    pair_components = components[iou.row]
+    is_inside = (is_missed[iou.row] & is_gained[iou.col] & is_catastrophe[pair_components]
+                 & (pair_components == components[iou.col + n_true]))
+    catastrophe_iou = np.zeros(n_components)
+    np.maximum.at(catastrophe_iou, pair_components[is_inside], iou.data[is_inside])
+
+    return {
+        'correct_detections': int(true_matches.size + np.count_nonzero(is_catastrophe)),
+        'missed_detections': int(true_counts[is_single].sum()),
+        'gained_detections': int(pred_counts[is_single].sum()),
+        'missed_det_from_merge': int((true_counts[is_merge] - 1).sum()),
+        'gained_det_from_split': int((pred_counts[is_split] - 1).sum()),
+        'true_det_in_catastrophe': int(true_counts[is_catastrophe].sum()),
+        'pred_det_in_catastrophe': int(pred_counts[is_catastrophe].sum()),
+        'merge': int(np.count_nonzero(is_merge)),
+        'split': int(np.count_nonzero(is_split)),
+        'catastrophe': int(np.count_nonzero(is_catastrophe)),
+        'correct_iou': np.concatenate([match_iou, catastrophe_iou[is_catastrophe]]),
+    }
+
+
 class ObjectMetrics(BaseMetrics):
     """Classifies object prediction errors as TP, FP, FN, merge or split
 
@@ -357,11 +799,16 @@ class ObjectMetrics(BaseMetrics):
             never misclassified as misses/gains.
         is_3d(:obj:'bool', optional): Flag that determines whether or not the input data
             should be treated as 3-dimensional.
+        metrics (:obj:`iterable`, optional): Metrics of ``OBJECT_METRICS`` to
+            compute, defaults to all. Only the stages these metrics depend
+            on are run, other stages run when their results are first used,
+            e.g. the Detection graph for ``error_map`` or ``get_props_table``.
 
     Raises:
         ValueError: If y_true and y_pred are not the same shape
         ValueError: If data_type is 2D, if input shape does not have ndim 2 or 3
         ValueError: If data_type is 3D, if input shape does not have ndim 3
+        ValueError: Unknown metrics
     """
     def __init__(self,
                  y_true,
@@ -369,7 +816,8 @@ class ObjectMetrics(BaseMetrics):
                  cutoff1=0.4,
                  cutoff2=0.1,
                  force_event_links=False,
-                 is_3d=False):
+                 is_3d=False,
+                 metrics=None):
 
         # If 2D, dimensions can be 3 or 4 (with or without channel dimension)
         if not is_3d and y_true.ndim not in {2, 3}:
@@ -390,28 +838,20 @@ class ObjectMetrics(BaseMetrics):
 
         self.compute_overlap = compute_overlap_3D if is_3d else compute_overlap
 
-        self.n_true = len(np.unique(self.y_true[np.nonzero(self.y_true)]))
-        self.n_pred = len(np.unique(self.y_pred[np.nonzero(self.y_pred)]))
-
-        # keep track of every pair of objects through the detections dict
-        # using tuple(true_index, pred_index): Detection as a key/vaue pair
-        self._detections = set()
-
-        # store the keys of relevant Detections in a set for easy fetching
-        # types of detections
-        self._splits = set()
-        self._gained = set()
-        self._missed = set()
-        # types of errors
-        self._merges = set()
-        self._catastrophes = set()
-        self._correct = set()
-
-        # IoU: used to determine relative overlap of y_pred and y_true
-        self.iou = np.zeros((self.n_true, self.n_pred))
+        if is_3d:
+            # a single streaming pass over z-slabs provides every volumetric
+            # overlap and area, avoiding per-pair full-volume comparisons
+            self._overlaps = get_label_overlaps(
+                self.y_true, self.y_pred, return_boxes=False)
+            self.n_true = int(np.count_nonzero(self._overlaps['true_areas'][1:]))
+            self.n_pred = int(np.count_nonzero(self._overlaps['pred_areas'][1:]))
+        else:
+            self._overlaps = None
+            self.n_true = len(np.unique(self.y_true[np.nonzero(self.y_true)]))
+            self.n_pred = len(np.unique(self.y_pred[np.nonzero(self.y_pred)]))
 
-        # used to determine seg score
-        self.seg_thresh = np.zeros((self.n_true, self.n_pred))
+        # lazily built lookup of 3D pair intersections for _get_containment
+        self._pair_intersections = None
 
         # Check if either frame is empty before proceeding
         if self.n_true == 0:
@@ -420,52 +860,148 @@ class ObjectMetrics(BaseMetrics):
         if self.n_pred == 0:
             logging.info('Prediction frame is empty')
 
-        self._calc_iou()  # set self.iou and update self.seg_thresh
+        # run the stages the requested metrics depend on, any other stage
+        # runs when its results are first used
+        self.force_event_links = force_event_links
+        metrics = tuple(OBJECT_METRICS if metrics is None else metrics)
+        plan = stage_plan(metrics)
+        self.metrics = tuple(m for m in OBJECT_METRICS if m in metrics)
+        self._stages = set()
+        for stage in plan:
+            self._require(stage)
+
+    def _require(self, stage):
+        """Run a stage of ``OBJECT_STAGES`` and its dependencies, once."""
+        if stage in self._stages:
+            return
+        for dependency in OBJECT_STAGES[stage]:
+            self._require(dependency)
+        getattr(self, '_run_{}'.format(stage))()
+        self._stages.add(stage)
+
+    def _run_iou(self):
+        # IoU: used to determine relative overlap of y_pred and y_true.
+        # Only overlapping objects have a nonzero IoU, so it is kept sparse
+        self._iou = sparse.csr_matrix((self.n_true, self.n_pred))
 
-        self.iou_modified = self._get_modified_iou(force_event_links)
+        # used to determine seg score
+        self._seg_thresh = sparse.csr_matrix((self.n_true, self.n_pred))
 
-        matrix = self._linear_assignment()
+        if self.is_3d:
+            self._calc_iou_3D()  # set self.iou and update self.seg_thresh
+        else:
+            self._calc_iou()  # set self.iou and update self.seg_thresh
 
-        # Identify direct matches as true positives
-        correct_index = np.nonzero(matrix[:self.n_true, :self.n_pred])
+    def _run_modified_iou(self):
+        self._iou_modified = self._get_modified_iou(self.force_event_links)
 
-        for i, j in zip(correct_index[0], correct_index[1]):
-            self._add_detection(true_index=int(i), pred_index=int(j))
+    def _run_assignment(self):
+        self._true_matches, self._pred_matches = self._linear_assignment()
 
-        # Calc seg score for true positives if requested
-        iou_mask = np.where(self.seg_thresh == 0, self.iou, np.nan)
+    def _run_seg(self):
+        # Calc seg score for true positives, only counting the matches
+        # that cover more than half of the true object
+        true_matches, pred_matches = self._true_matches, self._pred_matches
+        iou_mask = np.full(true_matches.shape, np.nan)
+        if true_matches.size:
+            is_seg = np.asarray(self.seg_thresh[true_matches, pred_matches]).ravel()
+            iou_values = np.asarray(self.iou[true_matches, pred_matches]).ravel()
+            iou_mask[is_seg != 0] = iou_values[is_seg != 0]
 
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', category=RuntimeWarning)
-            # correct_index may be empty, suppress mean of empty slice warning
-            self.seg_score = np.nanmean(iou_mask[correct_index])
+            # there may be no matches, suppress mean of empty slice warning
+            self._seg_score = np.nanmean(iou_mask)
+        # additive parts of the seg score, e.g. for MetricAccumulator
+        self._seg_sum = float(np.nansum(iou_mask))
+        self._seg_count = int(np.count_nonzero(~np.isnan(iou_mask)))
+
+    def _run_classification(self):
+        self._classification = _classify_objects(
+            self.iou, self.iou_modified, self._true_matches, self._pred_matches,
+            self.cutoff2)
+
+    def _run_graph(self):
+        # keep track of every pair of objects through the detections dict
+        # using tuple(true_index, pred_index): Detection as a key/vaue pair
+        self._detection_sets = {k: set() for k in (
+            'detections', 'splits', 'gained', 'missed', 'merges', 'catastrophes', 'correct')}
+
+        # Identify direct matches as true positives
+        for i, j in zip(self._true_matches, self._pred_matches):
+            self._add_detection(true_index=int(i), pred_index=int(j))
 
         # Classify other errors using a graph
-        G = self._array_to_graph(matrix)
+        G = self._array_to_graph(self._true_matches, self._pred_matches)
         self._classify_graph(G)
 
+    def _run_pixel(self):
         # Calculate pixel-level stats
-        self.pixel_stats = PixelMetrics(y_true, y_pred)
+        if self.is_3d:
+            self._pixel_stats = PixelMetrics.from_counts(
+                y_true_sum=self._overlaps['true_areas'][1:].sum(),
+                y_pred_sum=self._overlaps['pred_areas'][1:].sum(),
+                intersection=self._overlaps['intersections'].sum())
+        else:
+            self._pixel_stats = PixelMetrics(self.y_true, self.y_pred)
+
+    def _stage_result(stage, name):  # pylint: disable=no-self-argument
+        """Property of a result of a stage, running the stage on first use."""
+        def getter(self):
+            self._require(stage)
+            return getattr(self, name)
+        return property(getter)
+
+    iou = _stage_result('iou', '_iou')
+    seg_thresh = _stage_result('iou', '_seg_thresh')
+    iou_modified = _stage_result('modified_iou', '_iou_modified')
+    seg_score = _stage_result('seg', '_seg_score')
+    pixel_stats = _stage_result('pixel', '_pixel_stats')
+
+    def _detection_set(name):  # pylint: disable=no-self-argument
+        """Property of a set of Detections, classifying them on first use."""
+        def getter(self):
+            self._require('graph')
+            return self._detection_sets[name]
+        return property(getter)
+
+    # store the keys of relevant Detections in a set for easy fetching
+    _detections = _detection_set('detections')
+    # types of detections
+    _splits = _detection_set('splits')
+    _gained = _detection_set('gained')
+    _missed = _detection_set('missed')
+    # types of errors
+    _merges = _detection_set('merges')
+    _catastrophes = _detection_set('catastrophes')
+    _correct = _detection_set('correct')
+
+    del _stage_result, _detection_set
+
+    def _classified(self, name):
+        self._require('classification')
+        return self._classification[name]
 
     def _add_detection(self, true_index=None, pred_index=None):
         detection = Detection(true_index=true_index, pred_index=pred_index)
+        sets = self._detection_sets
 
-        self._detections.add(detection)
+        sets['detections'].add(detection)
 
         # keep track of all error types
         # TODO: better way to do this?
         if detection.is_correct:
-            self._correct.add(detection)
+            sets['correct'].add(detection)
         if detection.is_gained:
-            self._gained.add(detection)
+            sets['gained'].add(detection)
         if detection.is_missed:
-            self._missed.add(detection)
+            sets['missed'].add(detection)
         if detection.is_split:
-            self._splits.add(detection)
+            sets['splits'].add(detection)
         if detection.is_merge:
-            self._merges.add(detection)
+            sets['merges'].add(detection)
         if detection.is_catastrophe:
-            self._catastrophes.add(detection)
+            sets['catastrophes'].add(detection)
 
     def _calc_iou(self):
         """Calculates IoU matrix for each pairwise comparison between true and
@@ -486,6 +1022,8 @@ class ObjectMetrics(BaseMetrics):
         # (ind_ corresponds to box number - starting at 0)
         ind_true, ind_pred = np.nonzero(overlaps)
 
+        true_labels, pred_labels, ious, is_seg = [], [], [], []
+
         # TODO: this accounts for ~50+% of the time spent on calc_iou
         for index in range(ind_true.shape[0]):
             iou_y_true_idx = y_true_labels[ind_true[index]]
@@ -495,15 +1033,80 @@ class ObjectMetrics(BaseMetrics):
             is_pred = self.y_pred == iou_y_pred_idx
 
             intersection = np.count_nonzero(np.logical_and(is_true, is_pred))
+            if not intersection:
+                continue  # bounding boxes overlap, but the objects do not
             union = np.count_nonzero(np.logical_or(is_true, is_pred))
 
-            iou = intersection / union
+            true_labels.append(iou_y_true_idx)
+            pred_labels.append(iou_y_pred_idx)
+            ious.append(intersection / union)
+            is_seg.append(intersection > 0.5 * np.count_nonzero(is_true))
+
+        self._set_iou(np.array(true_labels, dtype='int'),
+                      np.array(pred_labels, dtype='int'),
+                      np.array(ious), np.array(is_seg, dtype='bool'))
 
-            # Subtract 1 from index to account for skipping 0
-            self.iou[iou_y_true_idx - 1, iou_y_pred_idx - 1] = iou
+    def _calc_iou_3D(self):
+        """Calculates the IoU matrix from the streamed volumetric overlaps.
 
-            if intersection > 0.5 * np.count_nonzero(self.y_true == index):
-                self.seg_thresh[iou_y_true_idx - 1, iou_y_pred_idx - 1] = 1
+        Every overlapping pair and object volume was counted in one pass by
+        ``get_label_overlaps``, so no masks are compared here. Records a 1 in
+        ``seg_thresh`` for each pair of objects where $|Tbigcap P| > 0.5 * |T|$
+        """
+        true_labels = self._overlaps['true_labels']
+        pred_labels = self._overlaps['pred_labels']
+        intersections = self._overlaps['intersections']
+        true_areas = self._overlaps['true_areas']
+        pred_areas = self._overlaps['pred_areas']
+
+        union = true_areas[true_labels] + pred_areas[pred_labels] - intersections
+
+        self._set_iou(true_labels.astype('int'), pred_labels.astype('int'),
+                      intersections / union,
+                      intersections > 0.5 * true_areas[true_labels])
+
+    def _set_iou(self, true_labels, pred_labels, iou, is_seg):
+        """Store the IoU and SEG threshold of each overlapping pair of
+        objects as sparse ``(n_true, n_pred)`` matrices.
+
+        Args:
+            true_labels (np.array): label of the true object of each pair
+            pred_labels (np.array): label of the predicted object of each pair
+            iou (np.array): IoU of each pair
+            is_seg (np.array): whether each pair has $|Tbigcap P| > 0.5 * |T|$
+        """
+        # Subtract 1 from index to account for skipping 0
+        index = (true_labels - 1, pred_labels - 1)
+        shape = (self.n_true, self.n_pred)
+
+        self._iou = sparse.csr_matrix((iou, index), shape=shape)
+        self._iou.sort_indices()
+        self._seg_thresh = sparse.csr_matrix((is_seg.astype('float'), index), shape=shape)
+
+    def _get_containment(self, true_idx, pred_idx):
+        """Fraction of the true cell contained within the predicted cell,
+        and vice versa, for 0-based object indices."""
+        true_label, pred_label = true_idx + 1, pred_idx + 1
+
+        if self.is_3d:
+            if self._pair_intersections is None:
+                self._pair_intersections = dict(zip(
+                    zip(self._overlaps['true_labels'].tolist(),
+                        self._overlaps['pred_labels'].tolist()),
+                    self._overlaps['intersections'].tolist()))
+            intersection = self._pair_intersections.get((true_label, pred_label), 0)
+            true_in_pred = intersection / self._overlaps['true_areas'][true_label]
+            pred_in_true = intersection / self._overlaps['pred_areas'][pred_label]
+            return true_in_pred, pred_in_true
+
+        true_mask = self.y_true == true_label
+        pred_mask = self.y_pred == pred_label
+
+        true_in_pred = np.count_nonzero(
+            self.y_true[pred_mask] == true_label) / np.sum(true_mask)
+        pred_in_true = np.count_nonzero(
+            self.y_pred[true_mask] == pred_label) / np.sum(pred_mask)
+        return true_in_pred, pred_in_true
 
     def _get_modified_iou(self, force_event_links):
         """Modifies the IoU matrix to boost the value for small cells.
@@ -514,29 +1117,22 @@ class ObjectMetrics(BaseMetrics):
                 a small object.
 
         Returns:
-            np.array: The modified IoU matrix.
+            scipy.sparse.csr_matrix: The modified IoU matrix.
         """
         # identify cells that have matches in IOU but may be too small
-        true_labels, pred_labels = np.nonzero(
-            np.logical_and(self.iou > 0, self.iou < 1 - self.cutoff1)
-        )
+        iou = self.iou.tocoo()
+        candidates = np.nonzero(iou.data < 1 - self.cutoff1)[0]
 
-        iou_modified = self.iou.copy()
+        iou_modified = self.iou.tolil(copy=True)
+        iou_by_pred = self.iou.tocsc()
 
-        for idx in range(len(true_labels)):
-            # add 1 to get back to original label id
-            true_idx, pred_idx = true_labels[idx], pred_labels[idx]
-            true_label, pred_label = true_idx + 1, pred_idx + 1
-            true_mask = self.y_true == true_label
-            pred_mask = self.y_pred == pred_label
+        for idx in candidates:
+            true_idx, pred_idx = iou.row[idx], iou.col[idx]
 
             # fraction of true cell that is contained within pred cell, vice versa
-            true_in_pred = np.count_nonzero(
-                self.y_true[pred_mask] == true_label) / np.sum(true_mask)
-            pred_in_true = np.count_nonzero(
-                self.y_pred[true_mask] == pred_label) / np.sum(pred_mask)
+            true_in_pred, pred_in_true = self._get_containment(true_idx, pred_idx)
 
-            iou_val = self.iou[true_idx, pred_idx]
+            iou_val = iou.data[idx]
             max_val = np.max([true_in_pred, pred_in_true])
 
             # if this cell has a small IOU due to its small size,
@@ -549,64 +1145,32 @@ class ObjectMetrics(BaseMetrics):
                 # that swallowed up the small cell so that it doesn't directly
                 # match a different cell
                 if force_event_links and true_in_pred > 0.5:
-                    fix_idx = np.nonzero(self.iou[:, pred_idx] >= 1 - self.cutoff1)
+                    fix_idx = _sparse_indices_above(iou_by_pred, pred_idx, 1 - self.cutoff1)
                     iou_modified[fix_idx, pred_idx] = 1 - self.cutoff1 - 0.01
 
                 if force_event_links and pred_in_true > 0.5:
-                    fix_idx = np.nonzero(self.iou[true_idx, :] >= 1 - self.cutoff1)
+                    fix_idx = _sparse_indices_above(self.iou, true_idx, 1 - self.cutoff1)
                     iou_modified[true_idx, fix_idx] = 1 - self.cutoff1 - 0.01
 
-        return iou_modified
+        return iou_modified.tocsr()
 
-    def _get_cost_matrix(self):
-        """Assembles cost matrix using the iou matrix and cutoff1
-
-        The previously calculated iou matrix is cast into the top left and
-        transposed for the bottom right corner. The diagonals of the two
-        remaining corners are populated according to cutoff1. The lower the
-        value of cutoff1 the more likely it is for the linear sum assignment
-        to pick unmatched assignments for objects.
-        """
-        n_obj = self.n_true + self.n_pred
-        matrix = np.ones((n_obj, n_obj))
-
-        # Assign 1 - iou to top left and bottom right
-        cost = 1 - self.iou_modified
-        matrix[:self.n_true, :self.n_pred] = cost
-        matrix[n_obj - self.n_pred:, n_obj - self.n_true:] = cost.T
-
-        # Calculate diagonal corners
-        bl = (self.cutoff1 * np.eye(self.n_pred)
-              + np.ones((self.n_pred, self.n_pred))
-              - np.eye(self.n_pred))
-        tr = (self.cutoff1 * np.eye(self.n_true)
-              + np.ones((self.n_true, self.n_true))
-              - np.eye(self.n_true))
-
-        # Assign diagonals to cm
-        matrix[n_obj - self.n_pred:, :self.n_pred] = bl
-        matrix[:self.n_true, n_obj - self.n_true:] = tr
-        return matrix
+    def _get_cost_matrix(self, iou):
+        """Assembles cost matrix using the iou matrix and cutoff1, see
+        ``_get_cost_matrix``."""
+        return _get_cost_matrix(iou, self.cutoff1)
 
     def _linear_assignment(self):
-        """Runs linear sun assignment on cost matrix, identifies true
-        positives and unassigned true and predicted cells.
+        """Runs linear sum assignment on the cost matrix, identifies true
+        positives.
 
-        True positives correspond to assignments in the top left or bottom
-        right corner. There are two possible unassigned positions: true cell
-        unassigned in bottom left or predicted cell unassigned in top right.
+        Returns:
+            tuple(np.array, np.array): indices of the matched true and
+                predicted objects.
         """
-        cost_matrix = self._get_cost_matrix()
-
-        results = linear_sum_assignment(cost_matrix)
+        return _assign_objects(self.iou_modified, self.cutoff1)
 
-        # Map results onto cost matrix
-        assignment_matrix = np.zeros_like(cost_matrix)
-        assignment_matrix[results] = 1
-        return assignment_matrix
-
-    def _array_to_graph(self, matrix):
-        """Transform matrix for unassigned cells into a graph object
+    def _array_to_graph(self, true_matches, pred_matches):
+        """Transform unassigned cells into a graph object
 
         In order to cast the iou matrix into a graph form, we treat each
         unassigned cell as a node. The iou values for each pair of cells is
@@ -614,30 +1178,30 @@ class ObjectMetrics(BaseMetrics):
         dropped because they indicate no overlap between cells.
 
         Args:
-            matrix (np.array): Assignment matrix.
+            true_matches (np.array): Indices of assigned true objects.
+            pred_matches (np.array): Indices of assigned predicted objects.
         """
-        # Collect unassigned objects
-        x, y = matrix.shape
-        gained, _ = np.nonzero(matrix[x - self.n_pred:, :self.n_pred])
-        missed, _ = np.nonzero(matrix[:self.n_true, y - self.n_true:])
+        import networkx as nx
 
-        # Use meshgrid to get true and predicted object index for each val
-        tt, pp = np.meshgrid(missed, gained, indexing='ij')
+        # Collect unassigned objects
+        is_missed = np.ones(self.n_true, dtype='bool')
+        is_missed[true_matches] = False
+        is_gained = np.ones(self.n_pred, dtype='bool')
+        is_gained[pred_matches] = False
 
-        true_nodes = tt.flatten()
-        pred_nodes = pp.flatten()
+        # edges between overlapping unassigned objects only
+        iou = self.iou_modified.tocoo()
+        is_edge = np.logical_and(is_missed[iou.row], is_gained[iou.col])
+        is_edge &= iou.data >= self.cutoff2
 
         # construct list of edges for networkx
         G = nx.Graph()
-
-        for t, p in zip(true_nodes, pred_nodes):
-            # edges between overlapping objects only
-            if self.iou_modified[t, p] >= self.cutoff2:
-                G.add_edge('true_{}'.format(t), 'pred_{}'.format(p))
+        G.add_edges_from(('true_{}'.format(t), 'pred_{}'.format(p))
+                         for t, p in zip(iou.row[is_edge], iou.col[is_edge]))
 
         # Add nodes to ensure all cells are included
-        G.add_nodes_from(('true_{}'.format(n) for n in missed))
-        G.add_nodes_from(('pred_{}'.format(n) for n in gained))
+        G.add_nodes_from(('true_{}'.format(n) for n in np.nonzero(is_missed)[0]))
+        G.add_nodes_from(('pred_{}'.format(n) for n in np.nonzero(is_gained)[0]))
 
         return G
 
@@ -653,6 +1217,8 @@ class ObjectMetrics(BaseMetrics):
         error. If the top level node is a predicted cell, this indicates a merge
         event. If the top level node is a true cell, this indicates a split event.
         """
+        import networkx as nx
+
         # Find subgraphs, e.g. merge/split
         for g in (G.subgraph(c) for c in nx.connected_components(G)):
             # Get the highest degree node
@@ -681,13 +1247,28 @@ class ObjectMetrics(BaseMetrics):
                 pred_index=tuple(pred_indices) if pred_indices else None,
             )
 
-    def _get_props(self, detection_type):
+    def _get_label_image(self, detection_type):
+        """Mask out all objects that are not part of ``detection_type``.
+
+        A label-to-category lookup table is applied to the label image, so
+        the image is only scanned once regardless of the number of objects.
+        """
         prediction_types = {
             'gained',
         }
         is_pred_type = detection_type in prediction_types
         arr = self.y_pred if is_pred_type else self.y_true
-        label_image = np.zeros_like(arr)
+        indices = self._get_detection_labels(detection_type, is_pred_type)
+        indices = indices.astype(arr.dtype)
+
+        max_label = int(arr.max()) if arr.size else 0
+        lut = np.zeros(max(max_label, int(indices.max(initial=0))) + 1, dtype=arr.dtype)
+        lut[indices] = indices
+        return lut[arr]
+
+    def _get_detection_labels(self, detection_type, is_pred_type):
+        """Labels of the true or predicted objects of all detections of a
+        type, e.g. 'missed' or 'splits'."""
         attrname = '_{}'.format(detection_type)
 
         try:
@@ -696,35 +1277,61 @@ class ObjectMetrics(BaseMetrics):
             raise ValueError('Invalid detection_type: {}'.format(
                 detection_type))
 
+        indices = []
         for det in detections:
             idx = det.pred_index if is_pred_type else det.true_index
-            idx = idx if isinstance(idx, tuple) else (idx,)
-            for i in idx:
-                label_image[arr == i] = i
+            if detection_type == 'correct':
+                # direct matches from the linear assignment hold 0-based
+                # indices, catastrophes are also linked and hold tuples
+                if not isinstance(idx, tuple):
+                    indices.append(idx + 1)
+                continue
+            indices.extend(idx if isinstance(idx, tuple) else (idx,))
+        return np.array(indices, dtype='int')
+
+    def _get_props(self, detection_type):
+        from skimage.measure import regionprops
 
-        return regionprops(label_image)
+        return regionprops(self._get_label_image(detection_type))
+
+    def get_props_table(self, detection_type, properties=('label', 'area', 'centroid', 'bbox')):
+        """Get the region properties of all objects of a detection type.
+
+        Args:
+            detection_type (str): one of 'splits', 'merges', 'missed',
+                'gained', 'correct' or 'catastrophes'.
+            properties (tuple): region properties to compute, see
+                ``skimage.measure.regionprops_table``.
+
+        Returns:
+            dict: maps each property to an array with one value per object.
+
+        Raises:
+            ValueError: Invalid detection_type
+        """
+        from skimage.measure import regionprops_table
+
+        return regionprops_table(self._get_label_image(detection_type),
+                                 properties=properties)
 
     def __repr__(self):
         """Format the calculated statistics as a ``pd.DataFrame``."""
         return json.dumps(self.to_dict())
     
+    def _pq_counts(self, iou_threshold=0.5):
+        """Number of true positives with an IoU of at least iou_threshold and
+        the sum of their IoU. The IoU of a catastrophe is the best IoU of its
+        objects."""
+        correct_iou = self._classified('correct_iou')
+        is_tp = correct_iou >= iou_threshold
+        return int(np.count_nonzero(is_tp)), float(correct_iou[is_tp].sum())
+
     def compute_pq(self, iou_threshold=0.5):
         """
         根据计算好的 IoU 矩阵计算 Panoptic Quality (PQ) 以及
         Segmentation Quality (SQ) 和 Recognition Quality (RQ)。
         """
-        tp_sum_iou = 0.0
-        tp = 0
-
-        for detection in self._correct:
-            true_idx = detection.true_index[0] if isinstance(detection.true_index, tuple) else detection.true_index
-            pred_idx = detection.pred_index[0] if isinstance(detection.pred_index, tuple) else detection.pred_index
-
-            iou_value = self.iou[true_idx - 1, pred_idx - 1]
-
-            if iou_value >= iou_threshold:
-                tp += 1
-                tp_sum_iou += iou_value
+        tp, tp_sum_iou = self._pq_counts(iou_threshold=iou_threshold)
         sq = tp_sum_iou / tp if tp > 0 else 0.0
         #tp = self.correct_detections
         #fp = self.n_pred - tp
@@ -736,79 +1343,58 @@ class ObjectMetrics(BaseMetrics):
         return pq,sq,rq
     
     def to_dict(self):
-        """Return a dictionary representation of the calclulated metrics."""
-        pq, sq, rq = self.compute_pq(iou_threshold=0.5)
-        return {
-            'n_pred': self.n_pred,
-            'n_true': self.n_true,
-            'correct_detections': self.correct_detections,
-            'missed_detections': self.missed_detections,
-            'gained_detections': self.gained_detections,
-            'missed_det_from_merge': self.missed_det_from_merge,
-            'gained_det_from_split': self.gained_det_from_split,
-            'true_det_in_catastrophe': self.true_det_in_catastrophe,
-            'pred_det_in_catastrophe': self.pred_det_in_catastrophe,
-            'merge': self.merges,
-            'split': self.splits,
-            'catastrophe': self.catastrophes,
-            'precision': self.precision,
-            'recall': self.recall,
-            'f1': self.f1,
-            'seg': self.seg_score,
-            'jaccard': self.jaccard,
-            'dice': self.dice,
-            'PQ':pq,
-        }
+        """Return a dictionary representation of the calclulated metrics,
+        only of the metrics the object was created for."""
+        # metrics of OBJECT_METRICS named differently than their attribute
+        attributes = {'merge': 'merges', 'split': 'splits',
+                      'catastrophe': 'catastrophes', 'seg': 'seg_score'}
+        result = {}
+        for metric in self.metrics:
+            if metric == 'PQ':
+                result[metric] = self.compute_pq(iou_threshold=0.5)[0]
+            else:
+                result[metric] = getattr(self, attributes.get(metric, metric))
+        return result
 
     @property
     def correct_detections(self):
-        return len(self._correct)
+        return self._classified('correct_detections')
 
     @property
     def missed_detections(self):
-        return len(self._missed)
+        return self._classified('missed_detections')
 
     @property
     def gained_detections(self):
-        return len(self._gained)
+        return self._classified('gained_detections')
 
     @property
     def splits(self):
-        return len(self._splits)
+        return self._classified('split')
 
     @property
     def merges(self):
-        return len(self._merges)
+        return self._classified('merge')
 
     @property
     def catastrophes(self):
-        return len(self._catastrophes)
+        return self._classified('catastrophe')
 
     @property
     def gained_det_from_split(self):
-        gained_dets = 0
-        for det in self._splits:
-            true_idx = _cast_to_tuple(det.true_index)
-            pred_idx = _cast_to_tuple(det.pred_index)
-            gained_dets += len(true_idx) + len(pred_idx) - 2
-        return gained_dets
+        return self._classified('gained_det_from_split')
 
     @property
     def missed_det_from_merge(self):
-        missed_dets = 0
-        for det in self._merges:
-            true_idx = _cast_to_tuple(det.true_index)
-            pred_idx = _cast_to_tuple(det.pred_index)
-            missed_dets += len(true_idx) + len(pred_idx) - 2
-        return missed_dets
+        return self._classified('missed_det_from_merge')
 
     @property
     def true_det_in_catastrophe(self):
-        return sum([len(d.true_index) for d in self._catastrophes])
+        return self._classified('true_det_in_catastrophe')
 
     @property
     def pred_det_in_catastrophe(self):
-        return sum([len(d.pred_index) for d in self._catastrophes])
+        return self._classified('pred_det_in_catastrophe')
 
     @property
     def split_props(self):
@@ -844,7 +1430,7 @@ class ObjectMetrics(BaseMetrics):
 
     @property
     def f1(self):
-        return hmean([self.recall, self.precision])
+        return _hmean(self.recall, self.precision)
 
     @property
     def jaccard(self):
@@ -854,53 +1440,402 @@ class ObjectMetrics(BaseMetrics):
     def dice(self):
         return self.pixel_stats.dice
 
-    def plot_errors(self):
-        """Plots the errors identified from linear assignment code.
+    def error_map(self, erosion_width=1):
+        """Label every object with the value of its error category.
+
+        Missed objects are drawn from ``y_true``, all other categories from
+        ``y_pred``. The categories are assigned through label-to-category
+        lookup tables, so the frame is only scanned once per mask.
 
-        This must be run with sequentially relabeled data.
+        Args:
+            erosion_width (int): pixel width to erode the edges of objects so
+                that adjacent objects remain distinguishable, 0 to disable.
 
-        TODO: this is not working!
+        Returns:
+            numpy.array: uint8 array with the same shape as ``y_true`` that
+                indexes ``ERROR_CATEGORIES`` and ``ERROR_COLORS``.
         """
+        from utils import erode_edges
+
+        y_true = erode_edges(self.y_true, erosion_width)
+        y_pred = erode_edges(self.y_pred, erosion_width)
 
-        import matplotlib as mpl
-        import matplotlib.pyplot as plt
+        true_lut = np.zeros(int(self.y_true.max(initial=0)) + 1, dtype='uint8')
+        missed = self._get_detection_labels('missed', is_pred_type=False)
+        true_lut[missed] = ERROR_CATEGORIES.index('missed')
 
-        # erode edges for easier visualization of adjacent cells
-        y_true = erode_edges(self.y_true.copy(), 1)
-        y_pred = erode_edges(self.y_pred.copy(), 1)
+        # all other categories are tracked with predicted labels
+        pred_lut = np.zeros(int(self.y_pred.max(initial=0)) + 1, dtype='uint8')
+        for category in ERROR_CATEGORIES[2:]:
+            labels = self._get_detection_labels(category, is_pred_type=True)
+            pred_lut[labels] = ERROR_CATEGORIES.index(category)
 
-        # semantic labels for each error
-        categories = ['Background', 'missed', 'splits', 'merges',
-                      'gained', 'catastrophes', 'correct']
+        errors = pred_lut[y_pred]
+        is_unset = errors == 0
+        errors[is_unset] = true_lut[y_true[is_unset]]
+        return errors
 
-        # Background is set to zero
-        plotting_tif = np.zeros_like(y_true)
+    def plot_errors(self, erosion_width=1):
+        """Plots the errors identified from linear assignment code.
 
-        # missed detections are tracked with true labels
-        misses = [d.true_index for d in self._missed]
-        plotting_tif[np.isin(y_true, misses)] = 1
+        This must be run with sequentially relabeled data. The figure is
+        created without pyplot, so no global figure state is kept.
 
-        # skip background and misses, already done
-        for i, category in enumerate(categories[2:]):
-            # the rest are all on y_pred
-            labels = list(getattr(self, '_{}'.format(category)))
-            plotting_tif[np.isin(y_pred, labels)] = i + 2
+        Args:
+            erosion_width (int): pixel width to erode the edges of objects.
 
-        plotting_colors = ['Black', 'Pink', 'Blue', 'Green',
-                           'tan', 'Red', 'Grey']
+        Returns:
+            matplotlib.figure.Figure: the error map with a colorbar of the
+                error categories.
+        """
+        from matplotlib.colors import ListedColormap
+        from matplotlib.figure import Figure
 
-        cmap = mpl.colors.ListedColormap(plotting_colors)
+        errors = np.squeeze(self.error_map(erosion_width))
+        cmap = ListedColormap(ERROR_COLORS / 255.)
 
-        fig, ax = plt.subplots(nrows=1, ncols=1)
-        mat = ax.imshow(plotting_tif, cmap=cmap,
-                        vmin=np.min(plotting_tif) - .5,
-                        vmax=np.max(plotting_tif) + .5)
+        fig = Figure()
+        ax = fig.subplots(nrows=1, ncols=1)
+        mat = ax.imshow(errors, cmap=cmap, interpolation='nearest',
+                        vmin=-.5, vmax=len(ERROR_CATEGORIES) - .5)
 
         # tell the colorbar to tick at integers
-        ticks = np.arange(len(categories))
+        ticks = np.arange(len(ERROR_CATEGORIES))
         cbar = fig.colorbar(mat, ticks=ticks)
-        cbar.ax.set_yticklabels(categories)
+        cbar.ax.set_yticklabels(ERROR_CATEGORIES)
         fig.tight_layout()
+        return fig
+
+
+def _relabel_sequential(arr):
+    """Relabel ``arr`` to the labels ``1..N`` unless it already is sequential.
+
+    Sequential labels are detected with a single max/bincount pass and
+    returned without a copy. Otherwise the labels are relabeled through a
+    hash table, so sparse huge ids do not allocate lookup tables sized by
+    the largest label.
+
+    Args:
+        arr (numpy.array): integer label array, 0 being the background.
+
+    Returns:
+        tuple(numpy.array, bool): the sequentially labeled array and whether
+            it had to be relabeled.
+    """
+    max_label = int(arr.max()) if arr.size else 0
+    if max_label < arr.size:
+        counts = np.bincount(arr.ravel(), minlength=max_label + 1)
+        if counts[1:].all():
+            return arr, False
+
+    import pandas as pd
+
+    # factorize sorts the labels, so 0 remains the background
+    codes, labels = pd.factorize(arr.ravel(), sort=True)
+    if labels[0] != 0:
+        codes += 1
+    relabeled = codes.astype(arr.dtype, copy=False).reshape(arr.shape)
+    return relabeled, True
+
+
+class MetricAccumulator(object):  # pylint: disable=useless-object-inheritance
+    """Additive object and pixel counts of any number of frames.
+
+    Only counts and sums are stored, so the memory is constant in the number
+    of frames. Accumulators of different workers or shards can be merged and
+    serialized to a dict. Micro averages are computed from the summed counts,
+    macro averages are means of the per-frame values, skipping NaN values
+    like ``pandas.DataFrame.mean``.
+
+    Args:
+        pq_iou_threshold (float): minimum IoU of a true positive for the PQ.
+    """
+
+    COUNTS = ('n_true', 'n_pred', 'correct_detections', 'missed_detections',
+              'gained_detections', 'missed_det_from_merge', 'gained_det_from_split',
+              'true_det_in_catastrophe', 'pred_det_in_catastrophe',
+              'merge', 'split', 'catastrophe',
+              'pq_tp', 'pq_iou_sum', 'seg_sum', 'seg_count',
+              'y_true_sum', 'y_pred_sum', 'intersection', 'union')
+
+    RATES = ('precision', 'recall', 'f1', 'seg', 'jaccard', 'dice', 'PQ')
+
+    def __init__(self, pq_iou_threshold=0.5):
+        self.pq_iou_threshold = pq_iou_threshold
+        self.n_frames = 0
+        self.counts = dict.fromkeys(self.COUNTS, 0)
+        # sums and numbers of the non-NaN per-frame values, for macro averages
+        self.rate_sums = dict.fromkeys(self.RATES, 0.0)
+        self.rate_counts = dict.fromkeys(self.RATES, 0)
+
+    @staticmethod
+    def _rates(counts):
+        """Precision, recall, F1, seg, Jaccard, Dice and PQ of the counts,
+        with the same conventions as ``ObjectMetrics``."""
+        correct = counts['correct_detections']
+        recall = correct / counts['n_true'] if counts['n_true'] else 0
+        precision = correct / counts['n_pred'] if counts['n_pred'] else 0
+        f1 = _hmean(recall, precision)
+
+        seg = counts['seg_sum'] / counts['seg_count'] if counts['seg_count'] else np.nan
+        union = counts['union']
+        jaccard = counts['intersection'] / union if union else np.nan
+        y_sum = counts['y_true_sum'] + counts['y_pred_sum']
+        dice = 2.0 * counts['intersection'] / y_sum if y_sum else 1.0
+
+        tp = counts['pq_tp']
+        sq = counts['pq_iou_sum'] / tp if tp > 0 else 0.0
+        denominator = tp + 0.5 * counts['gained_detections'] + 0.5 * counts['missed_detections']
+        rq = tp / denominator if denominator > 0 else 0.0
+
+        return {
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'seg': seg,
+            'jaccard': jaccard,
+            'dice': dice,
+            'PQ': sq * rq,
+        }
+
+    def update(self, object_metrics):
+        """Add the counts of a single frame.
+
+        Args:
+            object_metrics (ObjectMetrics): statistics of the frame.
+        """
+        o = object_metrics
+        # the frame may have been evaluated for only some of the metrics
+        o._require('seg')
+        pq_tp, pq_iou_sum = o._pq_counts(iou_threshold=self.pq_iou_threshold)
+        pixel_stats = o.pixel_stats
+        frame = {
+            'n_true': o.n_true,
+            'n_pred': o.n_pred,
+            'correct_detections': o.correct_detections,
+            'missed_detections': o.missed_detections,
+            'gained_detections': o.gained_detections,
+            'missed_det_from_merge': o.missed_det_from_merge,
+            'gained_det_from_split': o.gained_det_from_split,
+            'true_det_in_catastrophe': o.true_det_in_catastrophe,
+            'pred_det_in_catastrophe': o.pred_det_in_catastrophe,
+            'merge': o.merges,
+            'split': o.splits,
+            'catastrophe': o.catastrophes,
+            'pq_tp': pq_tp,
+            'pq_iou_sum': float(pq_iou_sum),
+            'seg_sum': o._seg_sum,
+            'seg_count': o._seg_count,
+            'y_true_sum': pixel_stats._y_true_sum,
+            'y_pred_sum': pixel_stats._y_pred_sum,
+            'intersection': pixel_stats._intersection,
+            'union': pixel_stats._union,
+        }
+        for k in self.COUNTS:
+            self.counts[k] += frame[k]
+        for k, v in self._rates(frame).items():
+            if not np.isnan(v):
+                self.rate_sums[k] += float(v)
+                self.rate_counts[k] += 1
+        self.n_frames += 1
+
+    def merge(self, other):
+        """Add the counts of another accumulator, e.g. of another worker.
+
+        Raises:
+            ValueError: If the accumulators use different PQ thresholds
+        """
+        if other.pq_iou_threshold != self.pq_iou_threshold:
+            raise ValueError('Cannot merge accumulators with PQ thresholds '
+                             '{} and {}'.format(self.pq_iou_threshold,
+                                                other.pq_iou_threshold))
+        self.n_frames += other.n_frames
+        for k in self.COUNTS:
+            self.counts[k] += other.counts[k]
+        for k in self.RATES:
+            self.rate_sums[k] += other.rate_sums[k]
+            self.rate_counts[k] += other.rate_counts[k]
+        return self
+
+    def result(self, average='micro'):
+        """Dataset level precision, recall, F1, seg, Jaccard, Dice and PQ.
+
+        Args:
+            average (str): 'micro' to compute the metrics of the summed
+                counts, 'macro' to average the metrics of the frames.
+
+        Returns:
+            dict: the averaged metrics.
+
+        Raises:
+            ValueError: Invalid average
+        """
+        if average == 'micro':
+            return self._rates(self.counts)
+        if average == 'macro':
+            return {k: self.rate_sums[k] / self.rate_counts[k] if self.rate_counts[k] else np.nan
+                    for k in self.RATES}
+        raise ValueError('Invalid average: {}'.format(average))
+
+    def to_dict(self):
+        """Serialize the accumulator to a JSON compatible dict."""
+        return {
+            'pq_iou_threshold': self.pq_iou_threshold,
+            'n_frames': self.n_frames,
+            'counts': {k: v.item() if isinstance(v, np.generic) else v
+                       for k, v in self.counts.items()},
+            'rate_sums': dict(self.rate_sums),
+            'rate_counts': dict(self.rate_counts),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restore an accumulator serialized with ``to_dict``."""
+        accumulator = cls(pq_iou_threshold=data['pq_iou_threshold'])
+        accumulator.n_frames = data['n_frames']
+        accumulator.counts.update(data['counts'])
+        accumulator.rate_sums.update(data['rate_sums'])
+        accumulator.rate_counts.update(data['rate_counts'])
+        return accumulator
+
+
+def _frame_overlaps(y_true, y_pred):
+    """Overlaps of the objects of a single frame, as sequential 0-based
+    object indices like those of ``ObjectMetrics``.
+
+    If the number of label pairs is small relative to the number of pixels,
+    all overlaps and areas are counted with a single ``bincount`` of the
+    joint labels, without relabeling the frames first.
+
+    Returns:
+        tuple: number of true and predicted objects, and for each pair of
+            overlapping objects, sorted by (true, pred), their indices, the
+            intersection and the areas of both objects.
+    """
+    n_true_labels = int(y_true.max()) + 1 if y_true.size else 1
+    n_pred_labels = int(y_pred.max()) + 1 if y_pred.size else 1
+
+    if n_true_labels * n_pred_labels > 4 * y_true.size:
+        y_true, _ = _relabel_sequential(y_true)
+        y_pred, _ = _relabel_sequential(y_pred)
+        overlaps = get_label_overlaps(y_true, y_pred, slab_size=y_true.shape[0],
+                                      return_boxes=False)
+        true_areas, pred_areas = overlaps['true_areas'], overlaps['pred_areas']
+        rows, cols = overlaps['true_labels'] - 1, overlaps['pred_labels'] - 1
+        return (true_areas.shape[0] - 1, pred_areas.shape[0] - 1, rows, cols,
+                overlaps['intersections'], true_areas[rows + 1], pred_areas[cols + 1])
+
+    joint = np.bincount(
+        (y_true.astype(np.intp) * n_pred_labels + y_pred).ravel(),
+        minlength=n_true_labels * n_pred_labels).reshape(n_true_labels, n_pred_labels)
+    true_areas, pred_areas = joint.sum(axis=1), joint.sum(axis=0)
+
+    # absent labels are skipped, as if the frames were relabeled sequentially
+    true_labels = np.flatnonzero(true_areas[1:]) + 1
+    pred_labels = np.flatnonzero(pred_areas[1:]) + 1
+    joint = joint[true_labels][:, pred_labels]
+    rows, cols = np.nonzero(joint)
+    return (true_labels.shape[0], pred_labels.shape[0], rows, cols, joint[rows, cols],
+            true_areas[true_labels][rows], pred_areas[pred_labels][cols])
+
+
+def object_counts(y_true, y_pred, cutoff1=0.4, cutoff2=0.1, pq_iou_threshold=0.5):
+    """Object counts, precision, recall, F1 and PQ of a batch of frames.
+
+    A lightweight alternative to ``Metrics.calc_object_stats`` for frequent
+    evaluations, e.g. of validation batches in a training loop. The counts
+    equal those of ``ObjectMetrics`` with ``force_event_links=False``, but
+    only the stages they depend on are run: the overlaps of all objects are
+    counted with a single ``bincount`` per frame, the modified IoU is derived
+    from these counts and the objects left after the assignment are grouped
+    with array operations instead of ``networkx``. No ``Detection`` objects,
+    pixel metrics, SEG scores, DataFrames or progress bars are created.
+
+    Overhead budget: every frame has a fixed cost of at most 0.3 ms, the
+    rest grows with the number of pixels and of ambiguous overlaps. A
+    256x256 frame with 50 cells takes about 1 ms, 15x less than
+    ``ObjectMetrics``, and a 512x512 frame with 200 cells about 3.5 ms,
+    50x less. Labels do not need to be sequential, only non-negative.
+
+    Args:
+        y_true (numpy.array): Labeled ground truth, (batch, x, y) or
+            (batch, x, y, 1).
+        y_pred (numpy.array): Labeled prediction, same shape as y_true.
+        cutoff1 (float): Threshold for overlap in cost matrix, see
+            ``ObjectMetrics``.
+        cutoff2 (float): Threshold for overlap in unassigned cells, see
+            ``ObjectMetrics``.
+        pq_iou_threshold (float): minimum IoU of a true positive for the PQ.
+
+    Returns:
+        dict: one array of length batch for each of the counts 'n_true',
+            'n_pred', 'correct_detections', 'missed_detections',
+            'gained_detections', 'pq_tp' and 'pq_iou_sum', and of the rates
+            'precision', 'recall', 'f1' and 'PQ'.
+
+    Raises:
+        ValueError: If y_true and y_pred are not the same shape
+        ValueError: If the inputs are not (batch, x, y) or (batch, x, y, 1)
+    """
+    if y_pred.shape != y_true.shape:
+        raise ValueError('Input shapes need to match. Shape of prediction '
+                         'is: {}.  Shape of y_true is: {}'.format(
+                             y_pred.shape, y_true.shape))
+    if y_true.ndim == 4 and y_true.shape[-1] == 1:
+        y_true, y_pred = y_true[..., 0], y_pred[..., 0]
+    if y_true.ndim != 3:
+        raise ValueError('Expected dimensions for y_true are 3 or 4. '
+                         'Accepts: (batch, x, y), or (batch, x, y, 1) '
+                         'Got shape: {}'.format(y_true.shape))
+
+    n_frames = y_true.shape[0]
+    counts = {k: np.zeros(n_frames, dtype='int64') for k in (
+        'n_true', 'n_pred', 'correct_detections', 'missed_detections',
+        'gained_detections', 'pq_tp')}
+    counts['pq_iou_sum'] = np.zeros(n_frames)
+
+    for i in range(n_frames):
+        n_true, n_pred, rows, cols, intersections, true_area, pred_area = \
+            _frame_overlaps(y_true[i], y_pred[i])
+
+        # sparse IoU and modified IoU, see ObjectMetrics._get_modified_iou
+        iou = intersections / (true_area + pred_area - intersections)
+        containment = np.maximum(intersections / true_area, intersections / pred_area)
+        is_small = (iou < 1 - cutoff1) & (iou <= cutoff1) & (containment > 0.5)
+        iou_modified = np.where(is_small, cutoff2, iou)
+
+        shape = (n_true, n_pred)
+        iou_modified = sparse.coo_matrix((iou_modified, (rows, cols)), shape=shape)
+        true_matches, pred_matches = _assign_objects(iou_modified, cutoff1)
+        classification = _classify_objects(
+            sparse.coo_matrix((iou, (rows, cols)), shape=shape), iou_modified,
+            true_matches, pred_matches, cutoff2)
+
+        correct_iou = classification['correct_iou']
+        is_pq_tp = correct_iou >= pq_iou_threshold
+        counts['n_true'][i] = n_true
+        counts['n_pred'][i] = n_pred
+        for k in ('correct_detections', 'missed_detections', 'gained_detections'):
+            counts[k][i] = classification[k]
+        counts['pq_tp'][i] = np.count_nonzero(is_pq_tp)
+        counts['pq_iou_sum'][i] = correct_iou[is_pq_tp].sum()
+
+    # rates with the same conventions as ObjectMetrics
+    correct = counts['correct_detections']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recall = np.where(counts['n_true'] > 0, correct / counts['n_true'], 0.0)
+        precision = np.where(counts['n_pred'] > 0, correct / counts['n_pred'], 0.0)
+        f1 = np.where(recall * precision > 0,
+                      2 * recall * precision / (recall + precision), 0.0)
+
+        tp = counts['pq_tp']
+        sq = np.where(tp > 0, counts['pq_iou_sum'] / tp, 0.0)
+        denominator = (tp + 0.5 * counts['gained_detections']
+                       + 0.5 * counts['missed_detections'])
+        rq = np.where(denominator > 0, tp / denominator, 0.0)
+
+    counts.update(precision=precision, recall=recall, f1=f1, PQ=sq * rq)
+    return counts
 
 
 class Metrics(object):
@@ -975,27 +1910,16 @@ class Metrics(object):
             list: List of dictionaries
         """
 
-        # Initialize output dictionary
-        L = []
-
         # Write out average statistics
-        for k, v in df.mean().items():
-            L.append(dict(
-                name=k,
-                value=v,
-                feature='average',
-                stat_type=stat_type,
-            ))
-
-        # Save individual stats to list
-        for i, row in df.iterrows():
-            for k, v in row.items():
-                L.append(dict(
-                    name=k,
-                    value=v,
-                    feature=i,
-                    stat_type=stat_type,
-                ))
+        L = [dict(name=k, value=v, feature='average', stat_type=stat_type)
+             for k, v in df.mean().items()]
+
+        # Save individual stats to list, row by row, without iterating rows
+        names = np.tile(df.columns.to_numpy(), len(df.index)).tolist()
+        features = np.repeat(df.index.to_numpy(), len(df.columns)).tolist()
+        values = df.to_numpy().ravel().tolist()
+        L.extend(dict(name=k, value=v, feature=i, stat_type=stat_type)
+                 for k, v, i in zip(names, values, features))
 
         return L
 
@@ -1016,6 +1940,8 @@ class Metrics(object):
         Raises:
             ValueError: If y_true and y_pred are not the same shape
         """
+        import pandas as pd
+
         n_features = y_pred.shape[axis]
 
         pixel_metrics = []
@@ -1064,7 +1990,8 @@ class Metrics(object):
         """
         return PixelMetrics.get_confusion_matrix(y_true, y_pred, axis=axis)
 
-    def calc_object_stats(self, y_true, y_pred, progbar=True):
+    def calc_object_stats(self, y_true, y_pred, progbar=True, accumulator=None, metrics=None,
+                          as_dataframe=True):
         """Calculate object statistics and save to output
 
         Loops over each frame in the zeroth dimension, which should pass in
@@ -1075,9 +2002,16 @@ class Metrics(object):
             y_true (numpy.array): Labeled ground truth annotations
             y_pred (numpy.array): Labeled prediction mask
             progbar (bool): Whether to show the progress tqdm progress bar
+            accumulator (MetricAccumulator): optional accumulator that is
+                updated with the counts of every frame.
+            metrics (iterable): optional metrics of ``OBJECT_METRICS`` to
+                compute for every frame, defaults to all.
+            as_dataframe (bool): Whether to return a ``pd.DataFrame``, or the
+                list of dictionaries without importing pandas.
 
         Returns:
-            list: list of dictionaries with each stat being a key.
+            pd.DataFrame: one row of statistics per frame, or a list of
+                dictionaries with each stat being a key.
 
         Raises:
             ValueError: If y_true and y_pred are not the same shape
@@ -1105,21 +2039,18 @@ class Metrics(object):
                                  'Required format is: (batch, z, x, y) '
                                  'Got ndim: {}'.format(y_true.ndim))
 
+        from tqdm import tqdm
+
         all_object_metrics = []  # store all calculated metrics
         is_batch_relabeled = False  # used to warn if batches were relabeled
 
         for i in tqdm(range(y_true.shape[0]), disable=not progbar):
             # check if labels aren't sequential, raise warning on first occurence if so
-            true_batch, pred_batch = y_true[i], y_pred[i]
-            true_batch_relabel, _, _ = relabel_sequential(true_batch)
-            pred_batch_relabel, _, _ = relabel_sequential(pred_batch)
+            true_batch_relabel, true_relabeled = _relabel_sequential(y_true[i])
+            pred_batch_relabel, pred_relabeled = _relabel_sequential(y_pred[i])
 
-            # check if segmentations were relabeled
-            if not is_batch_relabeled:  # only one True is required
-                is_batch_relabeled = not (
-                    np.array_equal(true_batch, true_batch_relabel)
-                    and np.array_equal(pred_batch, pred_batch_relabel)
-                )
+            # only one True is required
+            is_batch_relabeled |= true_relabeled or pred_relabeled
 
             o = ObjectMetrics(
                 true_batch_relabel,
@@ -1127,9 +2058,13 @@ class Metrics(object):
                 cutoff1=self.cutoff1,
                 cutoff2=self.cutoff2,
                 force_event_links=self.force_event_links,
-                is_3d=self.is_3d)
+                is_3d=self.is_3d,
+                metrics=metrics)
 
-            all_object_metrics.append(o)
+            # keep only the statistics, not the label arrays and matrices
+            all_object_metrics.append(o.to_dict())
+            if accumulator is not None:
+                accumulator.update(o)
 
         if is_batch_relabeled:
             warnings.warn(
@@ -1137,10 +2072,13 @@ class Metrics(object):
                 'cell ids in original data. Relabel your data prior to running the '
                 'metrics package if you wish to maintain cell ids. ')
 
+        if not as_dataframe:
+            return all_object_metrics
+
+        import pandas as pd
+
         # print the object report
-        object_metrics = pd.DataFrame.from_records([
-            o.to_dict() for o in all_object_metrics
-        ])
+        object_metrics = pd.DataFrame.from_records(all_object_metrics)
         # self.print_object_report(object_metrics)
         return object_metrics
 
@@ -1328,75 +2266,241 @@ def split_stack(arr, batch, n_split1, axis1, n_split2, axis2):
         >>> out.shape
         (100, 10, 10, 1)
     """
+    arr, axis1, axis2 = _prepare_split_stack(arr, batch, n_split1, axis1, n_split2, axis2)
+
+    # split both axes into (sections, section size), later axis first so
+    # the position of the earlier axis stays valid
+    shape = list(arr.shape)
+    for axis, n_split in sorted([(axis1, n_split1), (axis2, n_split2)], reverse=True):
+        shape[axis:axis + 1] = [n_split, shape[axis] // n_split]
+
+    # position of the section axes after the reshape
+    section1 = axis1 + int(axis2 < axis1)
+    section2 = axis2 + int(axis1 < axis2)
+
+    # frames are ordered by second section, first section and then batch,
+    # the final reshape is the only copy
+    sections = np.moveaxis(arr.reshape(shape), [section2, section1], [0, 1])
+    return sections.reshape((-1,) + sections.shape[3:])
+
+
+def iter_split_stack(arr, batch, n_split1, axis1, n_split2, axis2):
+    """Lazily crop an array in the width and height dimensions.
+
+    Yields the same frames, in the same order, as ``split_stack`` as views
+    into ``arr``, so no copy of the stack is made.
+
+    Args:
+        arr (numpy.array): Array to be split with at least 2 dimensions
+        batch (bool): True if the zeroth dimension of arr is a batch or
+            frame dimension
+        n_split1 (int): Number of sections to produce from the first split axis
+            Must be able to divide arr.shape[axis1] evenly by n_split1
+        axis1 (int): Axis on which to perform first split
+        n_split2 (int): Number of sections to produce from the second split axis
+            Must be able to divide arr.shape[axis2] evenly by n_split2
+        axis2 (int): Axis on which to perform first split
+
+    Yields:
+        numpy.array: view of each frame after dual splitting
+
+    Raises:
+        ValueError: arr.shape[axis] must be evenly divisible by n_split
+            for both the first and second split
+    """
+    arr, axis1, axis2 = _prepare_split_stack(arr, batch, n_split1, axis1, n_split2, axis2)
+    size1 = arr.shape[axis1] // n_split1
+    size2 = arr.shape[axis2] // n_split2
+
+    for i2 in range(n_split2):
+        for i1 in range(n_split1):
+            index = [slice(None)] * arr.ndim
+            index[axis1] = slice(i1 * size1, (i1 + 1) * size1)
+            index[axis2] = slice(i2 * size2, (i2 + 1) * size2)
+            sections = arr[tuple(index)]
+            for frame in sections:
+                yield frame
+
+
+def _prepare_split_stack(arr, batch, n_split1, axis1, n_split2, axis2):
+    """Validate the splits and add a batch dimension if necessary.
+
+    Returns:
+        tuple: the array with a batch dimension and both positive split axes.
+    """
     # Check that n_split will divide equally
     if ((arr.shape[axis1] % n_split1) != 0) | ((arr.shape[axis2] % n_split2) != 0):
         raise ValueError(
             'arr.shape[axis] must be evenly divisible by n_split'
             'for both the first and second split')
 
-    split1 = np.split(arr, n_split1, axis=axis1)
+    axis1, axis2 = axis1 % arr.ndim, axis2 % arr.ndim
 
-    # If batch dimension doesn't exist, create and adjust axis2
+    # If batch dimension doesn't exist, create and adjust the axes
     if batch is False:
-        split1con = np.stack(split1)
+        arr = arr[np.newaxis]
+        axis1 += 1
         axis2 += 1
-    else:
-        split1con = np.concatenate(split1, axis=0)
 
-    split2 = np.split(split1con, n_split2, axis=axis2)
-    split2con = np.concatenate(split2, axis=0)
+    return arr, axis1, axis2
 
-    return split2con
 
+def _get_frame_ious(gt_frame, res_frame):
+    """IoU of every overlapping pair of objects in a single frame.
 
-def match_nodes(y_true, y_pred):
+    Returns:
+        tuple(numpy.array, numpy.array, numpy.array): the true label,
+            predicted label and IoU of each overlapping pair.
+    """
+    # a single slab, frames are small enough to count at once
+    overlaps = get_label_overlaps(gt_frame, res_frame,
+                                  slab_size=max(gt_frame.shape[0], 1),
+                                  return_boxes=False)
+    true_labels = overlaps['true_labels']
+    pred_labels = overlaps['pred_labels']
+    intersections = overlaps['intersections']
+    union = (overlaps['true_areas'][true_labels]
+             + overlaps['pred_areas'][pred_labels] - intersections)
+    return true_labels, pred_labels, intersections / union
+
+
+def match_nodes(y_true, y_pred, sparse_output=False, num_workers=None):
     """Loads all data that matches each pattern and compares the graphs.
 
+    The IoU of all overlapping objects of a frame are counted in one pass
+    with ``get_label_overlaps``. Frames are processed in parallel threads.
+
     Args:
         y_true (numpy.array): ground truth array with all cells labeled uniquely.
         y_pred (numpy.array): data array to match to unique.
+        sparse_output (bool): whether to return the overlapping pairs of each
+            frame instead of a dense array. Recommended for long movies with
+            many cells, where the dense array does not fit into memory.
+        num_workers (int): maximum number of threads, defaults to the number
+            of CPUs.
 
     Returns:
-        numpy.array: IoU of ground truth cells and predicted cells.
+        numpy.array: IoU of ground truth cells and predicted cells, of shape
+            (frames, max true label + 1, max pred label + 1). If
+            ``sparse_output``, a list with one tuple of (true labels,
+            pred labels, IoU) arrays per frame, holding each overlapping pair.
     """
+    from concurrent.futures import ThreadPoolExecutor
+
     num_frames = y_true.shape[0]
+
+    if num_workers == 1 or num_frames < 2:
+        frame_ious = list(map(_get_frame_ious, y_true, y_pred))
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            frame_ious = list(executor.map(_get_frame_ious, y_true, y_pred))
+
+    if sparse_output:
+        return frame_ious
+
     # TODO: does max make the shape bigger than necessary?
     iou = np.zeros((num_frames, np.max(y_true) + 1, np.max(y_pred) + 1))
+    for frame, (true_labels, pred_labels, ious) in enumerate(frame_ious):
+        iou[frame, true_labels, pred_labels] = ious
 
-    # Compute IOUs only when neccesary
-    # If bboxs for true and pred do not overlap with each other, the assignment
-    # is immediate. Otherwise use pixelwise IOU to determine which cell is which
+    return iou
 
-    # Regionprops expects one frame at a time
-    for frame in range(num_frames):
-        gt_frame = y_true[frame]
-        res_frame = y_pred[frame]
 
-        gt_props = regionprops(np.squeeze(gt_frame.astype('int')))
-        gt_boxes = [np.array(gt_prop.bbox) for gt_prop in gt_props]
-        gt_boxes = np.array(gt_boxes).astype('double')
-        gt_box_labels = [int(gt_prop.label) for gt_prop in gt_props]
+def _render_error_overlay(y_true, y_pred, path, image, alpha, erosion_width, kwargs):
+    """Write the color-coded error map of a single frame to ``path``."""
+    import cv2
+
+    y_true, _ = _relabel_sequential(y_true)
+    y_pred, _ = _relabel_sequential(y_pred)
+    errors = ObjectMetrics(y_true, y_pred, **kwargs).error_map(erosion_width)
+    overlay = ERROR_COLORS[errors]
+
+    if image is not None:
+        # blend the errors over the raw image, scaled to 8 bit grayscale
+        image = image.astype('float32') - image.min()
+        image = np.repeat(image[..., np.newaxis] * (255 / max(image.max(), 1e-7)), 3, axis=-1)
+        blended = alpha * overlay + (1 - alpha) * image
+        overlay = np.where(errors[..., np.newaxis] > 0, blended, image).astype('uint8')
+
+    # openCV expects BGR images
+    if not cv2.imwrite(path, overlay[..., ::-1]):
+        raise IOError('Could not write error overlay to {}'.format(path))
+    return path
+
+
+def render_error_overlays(y_true,
+                          y_pred,
+                          output_dir,
+                          names=None,
+                          images=None,
+                          file_format='png',
+                          erosion_width=1,
+                          alpha=0.5,
+                          num_workers=None,
+                          **kwargs):
+    """Color every frame by error category and write it as an image.
+
+    Each frame is evaluated with ``ObjectMetrics`` in a worker process and
+    its ``error_map`` is colored through the ``ERROR_COLORS`` lookup table,
+    so there are neither per-object loops nor any pyplot figure state.
 
-        res_props = regionprops(np.squeeze(res_frame.astype('int')))
-        res_boxes = [np.array(res_prop.bbox) for res_prop in res_props]
-        res_boxes = np.array(res_boxes).astype('double')
-        res_box_labels = [int(res_prop.label) for res_prop in res_props]
+    Args:
+        y_true (numpy.array): Labeled ground truth annotations,
+            (batch, x, y) or (batch, x, y, 1).
+        y_pred (numpy.array): Labeled prediction masks, same shape as y_true.
+        output_dir (str): directory to write the overlays to.
+        names (list): file name of each frame, defaults to the frame index.
+        images (numpy.array): optional raw images with the same shape as
+            y_true, the errors are blended over them.
+        file_format (str): one of 'png', 'tif' and 'tiff'.
+        erosion_width (int): pixel width to erode the edges of objects.
+        alpha (float): opacity of the errors when blended over ``images``.
+        num_workers (int): maximum number of worker processes,
+            defaults to the number of CPUs.
+        **kwargs: passed to ``ObjectMetrics``, e.g. ``cutoff1``.
 
-        # has the form [gt_bbox, res_bbox]
-        overlaps = compute_overlap(gt_boxes, res_boxes)
+    Returns:
+        list: paths of the written overlays.
 
-        # Find the bboxes that have overlap at all
-        # (ind_ corresponds to box number - starting at 0)
-        ind_gt, ind_res = np.nonzero(overlaps)
-
-        # frame_ious = np.zeros(overlaps.shape)
-        for index in range(ind_gt.shape[0]):
-            iou_gt_idx = gt_box_labels[ind_gt[index]]
-            iou_res_idx = res_box_labels[ind_res[index]]
-            intersection = np.logical_and(
-                gt_frame == iou_gt_idx, res_frame == iou_res_idx)
-            union = np.logical_or(
-                gt_frame == iou_gt_idx, res_frame == iou_res_idx)
-            iou[frame, iou_gt_idx, iou_res_idx] = intersection.sum() / union.sum()
+    Raises:
+        ValueError: If y_true and y_pred are not the same shape
+        ValueError: If the frames are not 2D
+        ValueError: If file_format is not supported
+    """
+    from concurrent.futures import ProcessPoolExecutor
 
-    return iou
+    if y_pred.shape != y_true.shape:
+        raise ValueError('Input shapes need to match. Shape of prediction '
+                         'is: {}.  Shape of y_true is: {}'.format(
+                             y_pred.shape, y_true.shape))
+
+    if y_true.ndim == 4 and y_true.shape[-1] == 1:
+        y_true, y_pred = y_true[..., 0], y_pred[..., 0]
+        images = images[..., 0] if images is not None else None
+
+    if y_true.ndim != 3:
+        raise ValueError('Expected dimensions for y_true are 3 or 4. '
+                         'Accepts: (batch, x, y), or (batch, x, y, 1) '
+                         'Got shape: {}'.format(y_true.shape))
+
+    if file_format not in {'png', 'tif', 'tiff'}:
+        raise ValueError('Invalid file_format: {}'.format(file_format))
+
+    if names is None:
+        names = ['{:05d}'.format(i) for i in range(y_true.shape[0])]
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    paths = [os.path.join(output_dir, '{}.{}'.format(
+        os.path.splitext(os.path.basename(name))[0], file_format)) for name in names]
+    frames = [images[i] if images is not None else None for i in range(y_true.shape[0])]
+
+    args = (list(y_true), list(y_pred), paths, frames,
+            [alpha] * len(paths), [erosion_width] * len(paths), [kwargs] * len(paths))
+
+    if num_workers == 1:
+        return list(map(_render_error_overlay, *args))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(_render_error_overlay, *args))
@@ -0,0 +1,167 @@
+"""Columnar store of per-image evaluation results.
+
+Every call to ``ResultStore.append`` writes one immutable part file to the
+store directory, so results of several methods, thresholds, datasets and runs
+accumulate without rewriting earlier results. Parts are written as Parquet if
+``pyarrow`` is installed, otherwise as uncompressed numpy columns (``.npz``).
+Excel and JSON are only produced as optional exports.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import uuid
+
+import numpy as np
+
+KEY_COLUMNS = ('run', 'dataset', 'method', 'threshold', 'image')
+
+
+def _has_parquet():
+    try:
+        import pyarrow  # pylint: disable=unused-import
+    except ImportError:
+        return False
+    return True
+
+
+def _write_npz(df, path):
+    columns = {}
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if values.dtype == object:
+            values = values.astype('str')
+        columns[column] = values
+    # write to a temporary file first, so readers never see partial parts
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(path + '.tmp', path)
+
+
+def _read_npz(path, columns=None):
+    import pandas as pd
+
+    with np.load(path) as data:
+        names = data.files if columns is None else [c for c in columns if c in data.files]
+        return pd.DataFrame({name: data[name] for name in names})
+
+
+class ResultStore(object):  # pylint: disable=useless-object-inheritance
+    """Append-only columnar store of per-image evaluation results.
+
+    Each row holds the metrics of one image, together with the key columns
+    ``run``, ``dataset``, ``method``, ``threshold`` and ``image``.
+
+    Args:
+        path (str): directory of the store, created if necessary.
+        run (str): identifier of the current run, defaults to the start time.
+        file_format (str): 'parquet' or 'npz', defaults to Parquet if
+            ``pyarrow`` is installed.
+
+    Raises:
+        ValueError: file_format is not supported
+    """
+
+    def __init__(self, path, run=None, file_format=None):
+        if file_format is None:
+            file_format = 'parquet' if _has_parquet() else 'npz'
+        if file_format not in {'parquet', 'npz'}:
+            raise ValueError('Invalid file_format: {}'.format(file_format))
+
+        self.path = path
+        self.file_format = file_format
+        self.run = run or time.strftime('%Y%m%d_%H%M%S', time.localtime())
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def append(self, df, method, threshold=None, dataset=None, name=None):
+        """Append the per-image results of one method as a new part.
+
+        Args:
+            df (pandas.DataFrame): metrics of each image, indexed by image name.
+            method (str): name of the evaluated method.
+            threshold (float): IoU threshold of the evaluation.
+            dataset (str): name of the evaluated dataset.
+            name (str): optional name of the part within the run. A part
+                with the same run and name is replaced, e.g. when a shard is
+                evaluated again. Defaults to a new unique name.
+
+        Returns:
+            str: path of the written part.
+        """
+        part = df.reset_index(drop=True)
+        part.insert(0, 'image', [str(i) for i in df.index])
+        part.insert(0, 'threshold', np.nan if threshold is None else float(threshold))
+        part.insert(0, 'method', str(method))
+        part.insert(0, 'dataset', '' if dataset is None else str(dataset))
+        part.insert(0, 'run', self.run)
+
+        if name is None:
+            name = uuid.uuid4().hex[:8]
+        path = os.path.join(self.path, 'part-{}-{}.{}'.format(self.run, name, self.file_format))
+        if self.file_format == 'parquet':
+            # write to a temporary file first, so readers never see partial parts
+            part.to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+        else:
+            _write_npz(part, path)
+        return path
+
+    def parts(self):
+        """Paths of all parts of the store, in the order they were written."""
+        names = [n for n in os.listdir(self.path)
+                 if n.startswith('part-') and n.endswith(('.parquet', '.npz'))]
+        paths = [os.path.join(self.path, n) for n in names]
+        return sorted(paths, key=os.path.getmtime)
+
+    def read(self, columns=None, **filters):
+        """Read the results, optionally only some columns and matching rows.
+
+        Args:
+            columns (list): metric columns to read, the key columns are
+                always included. Defaults to all columns.
+            **filters: key column values to keep, e.g. ``method='cellpose'``
+                or ``run=store.run``.
+
+        Returns:
+            pandas.DataFrame: one row per image and evaluation.
+        """
+        import pandas as pd
+
+        if columns is not None:
+            columns = list(KEY_COLUMNS) + [c for c in columns if c not in KEY_COLUMNS]
+
+        frames = []
+        for path in self.parts():
+            if path.endswith('.parquet'):
+                frame = pd.read_parquet(path, columns=columns)
+            else:
+                frame = _read_npz(path, columns=columns)
+            frames.append(frame)
+
+        if not frames:
+            return pd.DataFrame(columns=columns or list(KEY_COLUMNS))
+
+        results = pd.concat(frames, ignore_index=True)
+        for key, value in filters.items():
+            if value is None:
+                continue
+            if key == 'threshold':
+                results = results[np.isclose(results[key], value)]
+            else:
+                results = results[results[key] == value]
+        return results.reset_index(drop=True)
+
+    def to_excel(self, path, **filters):
+        """Export the (filtered) results to an Excel file."""
+        self.read(**filters).to_excel(path, index=False)
+        return path
+
+    def to_json(self, path, **filters):
+        """Export the (filtered) results to a JSON file of records."""
+        self.read(**filters).to_json(path, orient='records', indent=2)
+        return path
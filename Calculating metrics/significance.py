@@ -0,0 +1,153 @@
+"""Paired significance tests between segmentation methods.
+
+Methods are compared on the images they were both evaluated on. For every
+pair of methods and every metric, the per-image differences are tested with
+
+* a paired bootstrap, giving a confidence interval of the mean difference
+* a paired sign-flip permutation test, giving a two-sided p-value for the
+  null hypothesis that the mean difference is 0
+
+The differences of all pairs and metrics are stacked into a single
+(images, comparisons) matrix, so every block of resamples is evaluated as one
+matrix product: bootstrap resamples as counts of how often each image is
+drawn, permutations as random signs of each image. Missing values (NaN) are
+excluded per comparison through weights.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import warnings
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_METRICS = ('precision', 'recall', 'f1', 'dice', 'PQ')
+
+# number of resample x image entries per block, bounds the size of the
+# temporary resample matrices
+CHUNK_SIZE = 1 << 24
+
+
+def _blocks(n_resamples, n_images):
+    step = max(1, CHUNK_SIZE // max(n_images, 1))
+    for start in range(0, n_resamples, step):
+        yield min(step, n_resamples - start)
+
+
+def _bootstrap_means(diffs, valid, n_resamples, rng):
+    """Mean difference of every comparison in each bootstrap resample.
+
+    Returns:
+        numpy.array: (n_resamples, comparisons) resampled means.
+    """
+    n_images = diffs.shape[0]
+    means = []
+    for size in _blocks(n_resamples, n_images):
+        # how often each image is drawn in each resample
+        index = rng.integers(0, n_images, size=(size, n_images))
+        index += np.arange(size)[:, np.newaxis] * n_images
+        counts = np.bincount(index.ravel(), minlength=size * n_images)
+        counts = counts.reshape(size, n_images).astype('float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means.append((counts @ diffs) / (counts @ valid))
+    return np.concatenate(means)
+
+
+def _permutation_pvalues(diffs, n_valid, observed, n_resamples, rng):
+    """Two-sided sign-flip permutation p-value of every comparison."""
+    n_images = diffs.shape[0]
+    exceed = np.zeros(diffs.shape[1])
+    # tolerance for ties between the observed and permuted statistics
+    threshold = np.abs(observed) * (1 - 1e-12)
+    for size in _blocks(n_resamples, n_images):
+        signs = rng.integers(0, 2, size=(size, n_images)) * 2 - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            permuted = (signs.astype('float64') @ diffs) / n_valid
+        exceed += np.count_nonzero(np.abs(permuted) >= threshold, axis=0)
+    return (exceed + 1) / (n_resamples + 1)
+
+
+def compare_methods(results,
+                    metrics=DEFAULT_METRICS,
+                    n_resamples=10000,
+                    confidence=0.95,
+                    seed=None):
+    """Paired bootstrap and permutation tests between all pairs of methods.
+
+    Args:
+        results (pandas.DataFrame): per-image results with a ``method`` and
+            an ``image`` column and one column per metric, e.g. the output of
+            ``ResultStore.read``.
+        metrics (tuple): metric columns to compare, missing ones are skipped.
+        n_resamples (int): number of bootstrap resamples and permutations.
+        confidence (float): level of the bootstrap confidence interval.
+        seed (int): seed of the random resampling.
+
+    Returns:
+        pandas.DataFrame: one row per metric and pair of methods, with the
+            number of paired images, the means of both methods, the mean
+            difference (method_a - method_b), its bootstrap confidence
+            interval and the permutation p-value.
+
+    Raises:
+        ValueError: If confidence is not between 0 and 1
+    """
+    if not 0 < confidence < 1:
+        raise ValueError('confidence must be between 0 and 1. '
+                         'Got: {}'.format(confidence))
+
+    columns = ['metric', 'method_a', 'method_b', 'n_images', 'mean_a', 'mean_b',
+               'mean_diff', 'ci_low', 'ci_high', 'p_value']
+    metrics = [m for m in metrics if m in results.columns]
+    methods = list(pd.unique(results['method']))
+    pairs = list(itertools.combinations(range(len(methods)), 2))
+    if not metrics or not pairs:
+        return pd.DataFrame(columns=columns)
+
+    # (images, methods) table of each metric, on the same images
+    tables = [results.pivot_table(index='image', columns='method', values=m,
+                                  aggfunc='mean', dropna=False).reindex(columns=methods)
+              for m in metrics]
+    index = tables[0].index
+    for t in tables[1:]:
+        index = index.union(t.index)
+    values = np.stack([t.reindex(index).to_numpy(dtype='float64') for t in tables])
+
+    # (images, metrics * pairs) values of both methods of each comparison
+    first, second = (np.array(i) for i in zip(*pairs))
+    values_a = values[:, :, first].transpose(1, 0, 2).reshape(len(index), -1)
+    values_b = values[:, :, second].transpose(1, 0, 2).reshape(len(index), -1)
+
+    # paired differences, images missing either value are excluded
+    valid = ~np.isnan(values_a) & ~np.isnan(values_b)
+    diffs = np.where(valid, values_a - values_b, 0)
+    valid = valid.astype('float64')
+
+    n_valid = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = diffs.sum(axis=0) / n_valid
+        mean_a = np.where(valid, values_a, 0).sum(axis=0) / n_valid
+        mean_b = np.where(valid, values_b, 0).sum(axis=0) / n_valid
+
+    rng = np.random.default_rng(seed)
+    boot = _bootstrap_means(diffs, valid, n_resamples, rng)
+    alpha = 1 - confidence
+    with warnings.catch_warnings():
+        # comparisons without paired images have no interval
+        warnings.simplefilter('ignore', RuntimeWarning)
+        ci_low, ci_high = np.nanquantile(boot, [alpha / 2, 1 - alpha / 2], axis=0)
+    p_value = _permutation_pvalues(diffs, n_valid, observed, n_resamples, rng)
+
+    names = [(metric, methods[a], methods[b]) for metric in metrics for a, b in pairs]
+    comparison = pd.DataFrame(names, columns=columns[:3])
+    comparison['n_images'] = n_valid.astype('int')
+    comparison['mean_a'] = mean_a
+    comparison['mean_b'] = mean_b
+    comparison['mean_diff'] = observed
+    comparison['ci_low'] = ci_low
+    comparison['ci_high'] = ci_high
+    comparison['p_value'] = np.where(n_valid > 0, p_value, np.nan)
+    return comparison
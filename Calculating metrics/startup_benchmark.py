@@ -0,0 +1,92 @@
+"""Benchmark the startup time of the metrics modules and the CLI.
+
+Every measurement runs in a fresh interpreter, so module caches of earlier
+runs do not hide import costs. Two things are measured:
+
+* the import time of ``utils``, ``metrics`` and ``cell_eval_multi``
+* the wall time of evaluating a single small GT/DT pair with
+  ``CellSegEval``, from interpreter start to the result
+
+Example:
+    python startup_benchmark.py --repeats 9 --max-seconds 0.5
+
+The script exits with status 1 if the median time of the single pair
+evaluation exceeds ``--max-seconds``, 0.5 s by default, e.g. to guard it in
+CI. Pass ``--max-seconds 0`` to only report the times.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+work_path = os.path.dirname(os.path.abspath(__file__))
+
+EVALUATE_PAIR = """
+from cell_eval_multi import CellSegEval
+CellSegEval('benchmark').evaluation(gt_path={gt!r}, dt_path={dt!r})
+"""
+
+
+def _run(code, repeats):
+    """Median wall time of running ``code`` in a fresh interpreter."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [work_path, env.get('PYTHONPATH')]))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def _write_pair(path, size=64):
+    """Write one small pair of labeled GT and DT masks to ``path``."""
+    import tifffile
+
+    mask = np.zeros((size, size), dtype='uint8')
+    mask[8:24, 8:24] = 1
+    mask[32:56, 30:50] = 2
+    gt_path = os.path.join(path, 'gt')
+    dt_path = os.path.join(path, 'dt')
+    os.makedirs(gt_path)
+    os.makedirs(dt_path)
+    tifffile.imwrite(os.path.join(gt_path, 'pair_mask.tif'), mask)
+    tifffile.imwrite(os.path.join(dt_path, 'pair_img.tif'), np.roll(mask, 2, axis=1))
+    return gt_path, dt_path
+
+
+def main(args):
+    results = {'python': _run('pass', args.repeats)}
+    for module in ('utils', 'metrics', 'cell_eval_multi'):
+        results['import ' + module] = _run('import ' + module, args.repeats)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        gt_path, dt_path = _write_pair(tmp)
+        results['evaluate one pair'] = _run(
+            EVALUATE_PAIR.format(gt=gt_path, dt=dt_path), args.repeats)
+
+    for name, seconds in results.items():
+        print('{:<24}{:8.3f} s'.format(name, seconds))
+
+    if args.max_seconds and results['evaluate one pair'] > args.max_seconds:
+        print('Evaluating one pair took longer than {} s'.format(args.max_seconds))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='Number of runs of each measurement, the median is reported.')
+    parser.add_argument('--max-seconds', type=float, default=0.5,
+                        help='Fail if evaluating one pair takes longer than this, 0 to disable.')
+    sys.exit(main(parser.parse_args()))
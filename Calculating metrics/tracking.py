@@ -0,0 +1,290 @@
+"""Tracking metrics for time-lapse label movies.
+
+Ground truth and predicted tracks follow the deepcell convention: an object
+keeps its label across frames and divisions are described by a lineage
+dictionary, which maps each label to a dict with at least its ``frames``
+and its ``parent`` label (or None).
+
+Objects are matched in every frame with ``metrics.match_nodes``. The links
+between consecutive frames are then compared to find link, division,
+appearance and disappearance errors. Frames are processed as a stream, only
+the labels and matches of the previous frame are kept, so movies of any
+length are evaluated in a single linear pass.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from tqdm import tqdm
+
+from metrics import match_nodes
+
+
+def _encode(src, dst):
+    """Encode (source, destination) label pairs as single 64-bit keys."""
+    return np.left_shift(src.astype('uint64'), np.uint64(32)) | dst.astype('uint64')
+
+
+def _lookup(keys, values, query):
+    """Map ``query`` through the sorted ``keys`` to ``values``, 0 if absent."""
+    result = np.zeros(query.shape, dtype=values.dtype)
+    if not keys.size:
+        return result
+    index = np.minimum(np.searchsorted(keys, query), keys.size - 1)
+    found = keys[index] == query
+    result[found] = values[index[found]]
+    return result
+
+
+def _division_edges(lineage):
+    """Index the (parent, daughter) edges of a lineage by the first frame of
+    the daughter.
+
+    Args:
+        lineage (dict): deepcell lineage, maps each label to a dict with its
+            ``frames`` and ``parent``.
+
+    Returns:
+        dict: maps each frame to a (2, N) array of parent and daughter labels.
+    """
+    edges = {}
+    for label, track in (lineage or {}).items():
+        parent = track.get('parent')
+        if parent is None or not track.get('frames'):
+            continue
+        first_frame = int(min(track['frames']))
+        edges.setdefault(first_frame, []).append((int(parent), int(label)))
+    return {frame: np.array(pairs, dtype='int64').T for frame, pairs in edges.items()}
+
+
+class _TrackFrame(object):  # pylint: disable=useless-object-inheritance
+    """Labels of both movies in a single frame and the matches between them.
+
+    ``true_matches`` is sorted and ``pred_matches`` holds the predicted label
+    matched to each of them.
+    """
+
+    def __init__(self, true_labels, pred_labels, true_matches, pred_matches):
+        self.true_labels = true_labels
+        self.pred_labels = pred_labels
+        self.true_matches = true_matches
+        self.pred_matches = pred_matches
+
+
+def _get_edges(prev_labels, cur_labels, divisions):
+    """Links from the previous to the current frame of one movie.
+
+    Objects that keep their label are linked to themselves, dividing parents
+    are linked to their daughters that appear in the current frame.
+
+    Returns:
+        tuple(numpy.array, numpy.array, numpy.array): source labels,
+            destination labels and whether each link is a division.
+    """
+    src = np.intersect1d(prev_labels, cur_labels, assume_unique=True)
+    dst = src
+    is_division = np.zeros(src.shape, dtype='bool')
+
+    if divisions is not None:
+        parents, daughters = divisions
+        valid = np.isin(parents, prev_labels) & np.isin(daughters, cur_labels)
+        valid &= ~np.isin(daughters, prev_labels)
+        src = np.concatenate([src, parents[valid]])
+        dst = np.concatenate([dst, daughters[valid]])
+        is_division = np.concatenate([is_division, np.ones(valid.sum(), dtype='bool')])
+
+    return src, dst, is_division
+
+
+class TrackingMetrics(object):  # pylint: disable=useless-object-inheritance
+    """Compare predicted tracks to ground truth tracks, frame by frame.
+
+    Objects are matched in every frame if their IoU is at least
+    ``iou_threshold``. A true link between consecutive frames is correct if
+    both objects are matched and the predicted tracks link the matching
+    objects. Divisions are correct if all daughter links of the parent are
+    correctly predicted as divisions. Appearance and disappearance errors
+    count matched objects whose tracks start or end in only one of the
+    movies.
+
+    Args:
+        lineage_true (dict): deepcell lineage of the ground truth, without
+            a lineage no divisions are evaluated.
+        lineage_pred (dict): deepcell lineage of the prediction.
+        iou_threshold (float): minimum IoU to match two objects, values
+            above 0.5 guarantee unique matches, lower values are made
+            unique by greedily keeping the best match of each object.
+    """
+
+    def __init__(self, lineage_true=None, lineage_pred=None, iou_threshold=0.5):
+        self.iou_threshold = iou_threshold
+        self._divisions_true = _division_edges(lineage_true)
+        self._divisions_pred = _division_edges(lineage_pred)
+
+        self.n_frames = 0
+        self.counts = dict.fromkeys((
+            'n_true', 'n_pred', 'matched',
+            'true_links', 'pred_links', 'correct_links',
+            'true_divisions', 'pred_divisions', 'correct_divisions',
+            'missed_appearances', 'false_appearances',
+            'missed_disappearances', 'false_disappearances'), 0)
+
+        # state of the previous frame, the only frame kept in memory
+        self._prev = None
+
+    def _match(self, y_true, y_pred):
+        """One-to-one matches of the objects of a single frame."""
+        true_labels, pred_labels, ious = match_nodes(
+            y_true[np.newaxis], y_pred[np.newaxis], sparse_output=True)[0]
+
+        is_candidate = ious >= self.iou_threshold
+        true_labels = true_labels[is_candidate]
+        pred_labels = pred_labels[is_candidate]
+
+        if self.iou_threshold <= 0.5:
+            # greedily keep the best match of each object
+            order = np.argsort(-ious[is_candidate], kind='stable')
+            used_true, used_pred, keep = set(), set(), []
+            for i in order:
+                t, p = true_labels[i], pred_labels[i]
+                if t not in used_true and p not in used_pred:
+                    used_true.add(t)
+                    used_pred.add(p)
+                    keep.append(i)
+            keep = np.sort(np.array(keep, dtype='int'))
+            true_labels, pred_labels = true_labels[keep], pred_labels[keep]
+
+        order = np.argsort(true_labels)
+        return true_labels[order], pred_labels[order]
+
+    def add_frame(self, y_true, y_pred):
+        """Match the objects of the next frame and compare its links to
+        the previous frame.
+
+        Args:
+            y_true (numpy.array): labeled ground truth frame
+            y_pred (numpy.array): labeled predicted frame, same shape
+
+        Raises:
+            ValueError: If y_true and y_pred are not the same shape
+        """
+        if y_pred.shape != y_true.shape:
+            raise ValueError('Input shapes need to match. Shape of prediction '
+                             'is: {}.  Shape of y_true is: {}'.format(
+                                 y_pred.shape, y_true.shape))
+
+        true_matches, pred_matches = self._match(y_true, y_pred)
+        cur = _TrackFrame(
+            true_labels=np.unique(y_true[y_true != 0]).astype('int64'),
+            pred_labels=np.unique(y_pred[y_pred != 0]).astype('int64'),
+            true_matches=true_matches,
+            pred_matches=pred_matches)
+
+        self.counts['n_true'] += cur.true_labels.size
+        self.counts['n_pred'] += cur.pred_labels.size
+        self.counts['matched'] += true_matches.size
+
+        if self._prev is not None:
+            self._compare_links(self._prev, cur)
+        self._prev = cur
+        self.n_frames += 1
+
+    def _compare_links(self, prev, cur):
+        """Compare the true and predicted links between two frames."""
+        frame = self.n_frames
+
+        true_src, true_dst, true_div = _get_edges(
+            prev.true_labels, cur.true_labels, self._divisions_true.get(frame))
+        pred_src, pred_dst, pred_div = _get_edges(
+            prev.pred_labels, cur.pred_labels, self._divisions_pred.get(frame))
+
+        # map the true links onto the predicted objects, 0 if unmatched
+        mapped_src = _lookup(prev.true_matches, prev.pred_matches, true_src)
+        mapped_dst = _lookup(cur.true_matches, cur.pred_matches, true_dst)
+        is_mapped = np.logical_and(mapped_src != 0, mapped_dst != 0)
+
+        mapped_keys = _encode(mapped_src, mapped_dst)
+        pred_keys = _encode(pred_src, pred_dst)
+        is_correct = is_mapped & np.isin(mapped_keys, pred_keys)
+        is_division_found = is_mapped & np.isin(mapped_keys, pred_keys[pred_div])
+
+        self.counts['true_links'] += true_src.size
+        self.counts['pred_links'] += pred_src.size
+        self.counts['correct_links'] += int(is_correct.sum())
+
+        # a division is correct if every daughter link is a predicted division
+        parents, inverse = np.unique(true_src[true_div], return_inverse=True)
+        missing = np.bincount(inverse.ravel(), weights=~is_division_found[true_div],
+                              minlength=parents.size)
+        self.counts['true_divisions'] += parents.size
+        self.counts['pred_divisions'] += np.unique(pred_src[pred_div]).size
+        self.counts['correct_divisions'] += int(np.count_nonzero(missing == 0))
+
+        # appearances: matched objects without incoming links
+        true_appears = ~np.isin(cur.true_matches, true_dst)
+        pred_appears = ~np.isin(cur.pred_matches, pred_dst)
+        self.counts['missed_appearances'] += int(np.count_nonzero(true_appears & ~pred_appears))
+        self.counts['false_appearances'] += int(np.count_nonzero(pred_appears & ~true_appears))
+
+        # disappearances: matched objects of the previous frame without outgoing links
+        true_ends = ~np.isin(prev.true_matches, true_src)
+        pred_ends = ~np.isin(prev.pred_matches, pred_src)
+        self.counts['missed_disappearances'] += int(np.count_nonzero(true_ends & ~pred_ends))
+        self.counts['false_disappearances'] += int(np.count_nonzero(pred_ends & ~true_ends))
+
+    def to_dict(self):
+        """Return the error counts and the derived tracking scores."""
+        counts = dict(self.counts)
+        correct_links = counts['correct_links']
+        correct_divisions = counts['correct_divisions']
+
+        counts['n_frames'] = self.n_frames
+        counts['missed_links'] = counts['true_links'] - correct_links
+        counts['false_links'] = counts['pred_links'] - correct_links
+        counts['missed_divisions'] = counts['true_divisions'] - correct_divisions
+        counts['false_divisions'] = counts['pred_divisions'] - correct_divisions
+
+        counts['link_recall'] = _safe_divide(correct_links, counts['true_links'])
+        counts['link_precision'] = _safe_divide(correct_links, counts['pred_links'])
+        counts['link_f1'] = _safe_divide(2 * correct_links,
+                                         counts['true_links'] + counts['pred_links'])
+        counts['division_recall'] = _safe_divide(correct_divisions, counts['true_divisions'])
+        counts['division_precision'] = _safe_divide(correct_divisions, counts['pred_divisions'])
+        return counts
+
+
+def _safe_divide(numerator, denominator):
+    return numerator / denominator if denominator else 0
+
+
+def evaluate_tracking(y_true,
+                      y_pred,
+                      lineage_true=None,
+                      lineage_pred=None,
+                      iou_threshold=0.5,
+                      progbar=True):
+    """Evaluate predicted tracks against the ground truth tracks.
+
+    Frames are read one at a time, so ``y_true`` and ``y_pred`` may be
+    memory-mapped arrays or generators of frames.
+
+    Args:
+        y_true (iterable): labeled ground truth frames, e.g. an array of shape
+            (frames, x, y) or a generator yielding (x, y) frames.
+        y_pred (iterable): labeled predicted frames, matching y_true.
+        lineage_true (dict): deepcell lineage of the ground truth.
+        lineage_pred (dict): deepcell lineage of the prediction.
+        iou_threshold (float): minimum IoU to match two objects.
+        progbar (bool): Whether to show the progress tqdm progress bar
+
+    Returns:
+        dict: tracking error counts and scores, see ``TrackingMetrics``.
+    """
+    tracking = TrackingMetrics(lineage_true=lineage_true,
+                               lineage_pred=lineage_pred,
+                               iou_threshold=iou_threshold)
+    for true_frame, pred_frame in tqdm(zip(y_true, y_pred), disable=not progbar):
+        tracking.add_frame(np.asarray(true_frame), np.asarray(pred_frame))
+    return tracking.to_dict()
@@ -28,14 +28,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import numpy as np
-import cv2
-from scipy.signal import windows
+import concurrent.futures
+import functools
 
-from skimage import transform
-from skimage.measure import regionprops
-from skimage.morphology import remove_small_holes
-from skimage.segmentation import find_boundaries
+import numpy as np
 
 
 def erode_edges(mask, erosion_width):
@@ -56,20 +52,69 @@ def erode_edges(mask, erosion_width):
         raise ValueError('erode_edges expects arrays of ndim 2 or 3.'
                          'Got ndim: {}'.format(mask.ndim))
     if erosion_width:
+        from scipy import ndimage
+        from skimage.segmentation import find_boundaries
+
+        # Repeatedly removing the inner boundaries peels one pixel (along the
+        # axes) per iteration, so a pixel survives exactly if its taxicab
+        # distance to the background or the initial boundaries is at least
+        # erosion_width. Computing the distance once keeps the cost
+        # independent of the erosion width.
+        edges = np.logical_or(mask == 0, find_boundaries(mask, mode='inner'))
+        if not edges.any():
+            return np.copy(mask)
+        distance = ndimage.distance_transform_cdt(~edges, metric='taxicab')
         new_mask = np.copy(mask)
-        for _ in range(erosion_width):
-            boundaries = find_boundaries(new_mask, mode='inner')
-            new_mask[boundaries > 0] = 0
+        new_mask[distance < erosion_width] = 0
         return new_mask
 
     return mask
 
 
-def resize(data, shape, data_format='channels_last', labeled_image=False):
+# openCV only supports a limited number of channels per resize call
+_CV2_MAX_CHANNELS = 128
+
+
+def _resize_nearest(images, shape):
+    """Exact nearest neighbor resize of a (batch, x, y, channel) array.
+
+    Uses the same source pixel as openCV's ``INTER_NEAREST`` but works by
+    indexing, so any dtype (e.g. uint32 or int64 labels) is supported and
+    the whole batch is resized at once.
+    """
+    indices = []
+    for size_in, size_out in zip(images.shape[1:3], shape):
+        # same scale factor as openCV, which inverts the output / input ratio
+        scale = 1. / (size_out / size_in)
+        index = np.floor(np.arange(size_out) * scale).astype(np.intp)
+        indices.append(np.minimum(index, size_in - 1))
+    return images[:, indices[0]][:, :, indices[1]]
+
+
+def _resize_linear(image, shape):
+    """Bilinear resize of a single (x, y, channel) float32 image with openCV."""
+    import cv2
+
+    dsize = tuple(shape)[::-1]  # cv2 expects swapped axes.
+    channels = []
+    for i in range(0, image.shape[-1], _CV2_MAX_CHANNELS):
+        resized = cv2.resize(image[..., i:i + _CV2_MAX_CHANNELS], dsize,
+                             interpolation=cv2.INTER_LINEAR)
+        channels.append(resized.reshape(tuple(shape) + (-1,)))
+    return np.concatenate(channels, axis=-1)
+
+
+def resize(data, shape, data_format='channels_last', labeled_image=False,
+           num_workers=None):
     """Resize the data to the given shape.
-    Uses openCV to resize the data if the data is a single channel, as it
-    is very fast. However, openCV does not support multi-channel resizing,
-    so if the data has multiple channels, use skimage.
+    Image data is resized with openCV bilinear interpolation, as it is very
+    fast, including multi-channel data. Batches are resized in parallel
+    threads, as openCV releases the GIL. Labeled data uses an exact nearest
+    neighbor lookup that supports any integer dtype (e.g. uint32 instance
+    labels) and resizes the whole batch at once. It picks the same source
+    pixels as openCV for any number of channels, so multi-channel labels no
+    longer match skimage's ``order=0`` resize, and multi-channel images are
+    not anti-aliased.
 
     Args:
         data (np.array): data to be reshaped. Must have a channel dimension
@@ -79,6 +124,8 @@ def resize(data, shape, data_format='channels_last', labeled_image=False):
             one of 'channels_first' and 'channels_last'.
         labeled_image (bool): flag to determine how interpolation and floats are handled based
          on whether the data represents raw images or annotations
+        num_workers (int): maximum number of threads used for a batch of
+            images, defaults to the number of CPUs.
 
     Raises:
         ValueError: ndim of data not 3 or 4
@@ -98,58 +145,41 @@ def resize(data, shape, data_format='channels_last', labeled_image=False):
                          'Input shape has {} dimensions.'.format(len(shape)))
 
     original_dtype = data.dtype
+    shape = tuple(int(s) for s in shape)
 
-    # cv2 resize is faster but does not support multi-channel data
-    # If the data is multi-channel, use skimage.transform.resize
-    channel_axis = 0 if data_format == 'channels_first' else -1
-    batch_axis = -1 if data_format == 'channels_first' else 0
-
-    # Use skimage for multichannel data
-    if data.shape[channel_axis] > 1:
-        # Adjust output shape to account for channel axis
-        if data_format == 'channels_first':
-            shape = tuple([data.shape[channel_axis]] + list(shape))
-        else:
-            shape = tuple(list(shape) + [data.shape[channel_axis]])
-
-        # linear interpolation (order 1) for image data, nearest neighbor (order 0) for labels
-        # anti_aliasing introduces spurious labels, include only for image data
-        order = 0 if labeled_image else 1
-        anti_aliasing = not labeled_image
-
-        _resize = lambda d: transform.resize(d, shape, mode='constant', preserve_range=True,
-                                             order=order, anti_aliasing=anti_aliasing)
-    # single channel image, resize with cv2
+    # bring the data into the (batch, x, y, channel) layout
+    is_batch = len(data.shape) == 4
+    if data_format == 'channels_first':
+        # channels are first, a batch dimension is last
+        images = np.moveaxis(data, [0, -1], [-1, 0]) if is_batch else np.moveaxis(data, 0, -1)
     else:
-        shape = tuple(shape)[::-1]  # cv2 expects swapped axes.
+        images = data
+    if not is_batch:
+        images = images[np.newaxis]
 
-        # linear interpolation for image data, nearest neighbor for labels
+    # nearest neighbor for labels, linear interpolation for image data
+    if labeled_image:
+        resized = _resize_nearest(images, shape)
+    else:
         # CV2 doesn't support ints for linear interpolation, set to float for image data
-        if labeled_image:
-            interpolation = cv2.INTER_NEAREST
+        images = images.astype('float32')
+        _resize = functools.partial(_resize_linear, shape=shape)
+        if images.shape[0] > 1 and num_workers != 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                resized = np.stack(list(executor.map(_resize, images)))
         else:
-            interpolation = cv2.INTER_LINEAR
-            data = data.astype('float32')
-
-        _resize = lambda d: np.expand_dims(cv2.resize(np.squeeze(d), shape,
-                                                      interpolation=interpolation),
-                                           axis=channel_axis)
-
-    # Check for batch dimension to loop over
-    if len(data.shape) == 4:
-        batch = []
-        for i in range(data.shape[batch_axis]):
-            d = data[i] if batch_axis == 0 else data[..., i]
-            batch.append(_resize(d))
-        resized = np.stack(batch, axis=batch_axis)
-    else:
-        resized = _resize(data)
+            resized = np.stack([_resize(image) for image in images])
+
+    if not is_batch:
+        resized = resized[0]
+    if data_format == 'channels_first':
+        resized = np.moveaxis(resized, [0, -1], [-1, 0]) if is_batch else np.moveaxis(resized, -1, 0)
 
     return resized.astype(original_dtype)
 
 
 def tile_image(image, model_input_shape=(512, 512),
-               stride_ratio=0.75, pad_mode='constant'):
+               stride_ratio=0.75, pad_mode='constant', lazy=False):
     """
     Tile large image into many overlapping tiles of size "model_input_shape".
 
@@ -158,10 +188,13 @@ def tile_image(image, model_input_shape=(512, 512),
         model_input_shape (tuple): The input size of the model.
         stride_ratio (float): The stride expressed as a fraction of the tile size.
         pad_mode (str): Padding mode passed to ``np.pad``.
+        lazy (bool): If True, neither pad nor copy the image and return a
+            ``LazyTiles`` accessor instead of an array of tiles.
 
     Returns:
         tuple: (numpy.array, dict): A tuple consisting of an array of tiled
-            images and a dictionary of tiling details (for use in un-tiling).
+            images (or ``LazyTiles``) and a dictionary of tiling details
+            (for use in un-tiling).
 
     Raises:
         ValueError: image is not rank 4.
@@ -184,7 +217,6 @@ def tile_image(image, model_input_shape=(512, 512),
     new_batch_size = image.shape[0] * rep_number_x * rep_number_y
 
     tiles_shape = (new_batch_size, tile_size_x, tile_size_y, image.shape[3])
-    tiles = np.zeros(tiles_shape, dtype=image.dtype)
 
     # Calculate overlap of last tile
     overlap_x = (tile_size_x + stride_x * (rep_number_x - 1)) - image_size_x
@@ -195,7 +227,10 @@ def tile_image(image, model_input_shape=(512, 512),
     pad_y = (int(np.ceil(overlap_y / 2)), int(np.floor(overlap_y / 2)))
     pad_null = (0, 0)
     padding = (pad_null, pad_x, pad_y, pad_null)
-    image = np.pad(image, padding, pad_mode)
+    padded_shape = tuple(s + sum(p) for s, p in zip(image.shape, padding))
+    if not lazy:
+        tiles = np.zeros(tiles_shape, dtype=image.dtype)
+        padded = np.pad(image, padding, pad_mode)
 
     counter = 0
     batches = []
@@ -206,7 +241,7 @@ def tile_image(image, model_input_shape=(512, 512),
     overlaps_x = []
     overlaps_y = []
 
-    for b in range(image.shape[0]):
+    for b in range(padded_shape[0]):
         for i in range(rep_number_x):
             for j in range(rep_number_y):
                 x_axis = 1
@@ -216,18 +251,18 @@ def tile_image(image, model_input_shape=(512, 512),
                 if i != rep_number_x - 1:  # not the last one
                     x_start, x_end = i * stride_x, i * stride_x + tile_size_x
                 else:
-                    x_start, x_end = image.shape[x_axis] - tile_size_x, image.shape[x_axis]
+                    x_start, x_end = padded_shape[x_axis] - tile_size_x, padded_shape[x_axis]
 
                 if j != rep_number_y - 1:  # not the last one
                     y_start, y_end = j * stride_y, j * stride_y + tile_size_y
                 else:
-                    y_start, y_end = image.shape[y_axis] - tile_size_y, image.shape[y_axis]
+                    y_start, y_end = padded_shape[y_axis] - tile_size_y, padded_shape[y_axis]
 
                 # Compute the overlaps for each tile
                 if i == 0:
                     overlap_x = (0, tile_size_x - stride_x)
                 elif i == rep_number_x - 2:
-                    overlap_x = (tile_size_x - stride_x, tile_size_x - image.shape[x_axis] + x_end)
+                    overlap_x = (tile_size_x - stride_x, tile_size_x - padded_shape[x_axis] + x_end)
                 elif i == rep_number_x - 1:
                     overlap_x = ((i - 1) * stride_x + tile_size_x - x_start, 0)
                 else:
@@ -236,13 +271,14 @@ def tile_image(image, model_input_shape=(512, 512),
                 if j == 0:
                     overlap_y = (0, tile_size_y - stride_y)
                 elif j == rep_number_y - 2:
-                    overlap_y = (tile_size_y - stride_y, tile_size_y - image.shape[y_axis] + y_end)
+                    overlap_y = (tile_size_y - stride_y, tile_size_y - padded_shape[y_axis] + y_end)
                 elif j == rep_number_y - 1:
                     overlap_y = ((j - 1) * stride_y + tile_size_y - y_start, 0)
                 else:
                     overlap_y = (tile_size_y - stride_y, tile_size_y - stride_y)
 
-                tiles[counter] = image[b, x_start:x_end, y_start:y_end, :]
+                if not lazy:
+                    tiles[counter] = padded[b, x_start:x_end, y_start:y_end, :]
                 batches.append(b)
                 x_starts.append(x_start)
                 x_ends.append(x_end)
@@ -265,20 +301,130 @@ def tile_image(image, model_input_shape=(512, 512),
     tiles_info['tile_size_x'] = tile_size_x
     tiles_info['tile_size_y'] = tile_size_y
     tiles_info['stride_ratio'] = stride_ratio
-    tiles_info['image_shape'] = image.shape
+    tiles_info['image_shape'] = padded_shape
     tiles_info['dtype'] = image.dtype
     tiles_info['pad_x'] = pad_x
     tiles_info['pad_y'] = pad_y
 
+    if lazy:
+        tiles = LazyTiles(image, tiles_info, pad_mode=pad_mode)
+
     return tiles, tiles_info
 
 
+class LazyTiles(object):  # pylint: disable=useless-object-inheritance
+    """Read-only sequence of tiles cut on demand from an unpadded image.
+
+    Holds only the tiling details, so creating it costs O(number of tiles)
+    regardless of the image size. Tiles that lie inside the image are returned
+    as views; edge tiles are padded individually and match the tiles of
+    ``tile_image`` exactly. Indexing with a slice or a list of indices returns
+    a stacked array of tiles.
+
+    Args:
+        image (numpy.array): The unpadded image, rank 4 or rank 5.
+        tiles_info (dict): Details of how the image was tiled
+            (from tile_image or tile_image_3D).
+        pad_mode (str): Padding mode, as passed to ``np.pad``. Only modes that
+            index into the image are supported ('constant' pads with zeros).
+
+    Raises:
+        ValueError: pad_mode is not supported.
+    """
+
+    pad_modes = ('constant', 'edge', 'reflect', 'symmetric', 'wrap')
+
+    def __init__(self, image, tiles_info, pad_mode='constant'):
+        if pad_mode not in self.pad_modes:
+            raise ValueError('LazyTiles supports pad_mode in {}. Got: {}'.format(
+                self.pad_modes, pad_mode))
+
+        self.image = image
+        self.tiles_info = tiles_info
+        self.pad_mode = pad_mode
+
+        self._axes = ('z', 'x', 'y') if 'z_starts' in tiles_info else ('x', 'y')
+        tile_size = tuple(tiles_info['tile_size_{}'.format(a)] for a in self._axes)
+        self.shape = (len(tiles_info['batches']),) + tile_size + (image.shape[-1],)
+        self.dtype = image.dtype
+        self.ndim = len(self.shape)
+
+        # source index along each spatial axis for every padded coordinate,
+        # -1 marks constant padding
+        self._index_maps = []
+        for i, axis in enumerate(self._axes):
+            index = np.arange(image.shape[i + 1])
+            pad = tiles_info['pad_{}'.format(axis)]
+            if pad_mode == 'constant':
+                index = np.pad(index, pad, mode='constant', constant_values=-1)
+            else:
+                index = np.pad(index, pad, mode=pad_mode)
+            self._index_maps.append(index)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get_tile(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('Tile index {} is out of range.'.format(index))
+            return self._get_tile(index)
+
+        if isinstance(index, slice):
+            index = range(len(self))[index]
+        tiles = [self[i] for i in index]
+        if not tiles:
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+        return np.stack(tiles)
+
+    def __array__(self, dtype=None, copy=None):
+        tiles = self[:]
+        return tiles if dtype is None else tiles.astype(dtype)
+
+    def _get_tile(self, index):
+        info = self.tiles_info
+        batch = info['batches'][index]
+
+        sources = []
+        for axis, index_map in zip(self._axes, self._index_maps):
+            start = info['{}_starts'.format(axis)][index]
+            end = info['{}_ends'.format(axis)][index]
+            sources.append(index_map[start:end])
+
+        # tiles entirely within the image are plain views
+        if all(s[0] >= 0 and s[-1] - s[0] == len(s) - 1 for s in sources):
+            region = tuple(slice(s[0], s[-1] + 1) for s in sources)
+            return self.image[(batch,) + region]
+
+        if self.pad_mode != 'constant':
+            return self.image[batch][np.ix_(*sources)]
+
+        tile = np.zeros(self.shape[1:], dtype=self.dtype)
+        tile_region, image_region = [], []
+        for s in sources:
+            valid = np.flatnonzero(s >= 0)
+            if not valid.size:
+                return tile
+            tile_region.append(slice(valid[0], valid[-1] + 1))
+            image_region.append(slice(s[valid[0]], s[valid[-1]] + 1))
+        tile[tuple(tile_region)] = self.image[(batch,) + tuple(image_region)]
+        return tile
+
+
 def spline_window(window_size, overlap_left, overlap_right, power=2):
     """
     Squared spline (power=2) window function:
     https://www.wolframalpha.com/input/?i=y%3Dx**2,+y%3D-(x-2)**2+%2B2,+y%3D(x-4)**2,+from+y+%3D+0+to+2
     """
 
+    from scipy.signal import windows
+
     def _spline_window(w_size):
         intersection = int(w_size / 4)
         wind_outer = (abs(2 * (windows.triang(w_size))) ** power) / 2
@@ -328,73 +474,93 @@ def window_2D(window_size, overlap_x=(32, 32), overlap_y=(32, 32), power=2):
     return window
 
 
-def untile_image(tiles, tiles_info, power=2, **kwargs):
+@functools.lru_cache(maxsize=256)
+def _cached_window(window_size, overlaps, power):
+    """Build the read-only float32 window for one overlap configuration.
+
+    Shared across all untile calls, so each window class is only built once.
+    """
+    if len(window_size) == 2:
+        window = window_2D(window_size, overlap_x=overlaps[0],
+                           overlap_y=overlaps[1], power=power)
+    else:
+        window = window_3D(window_size, overlap_z=overlaps[0], overlap_x=overlaps[1],
+                           overlap_y=overlaps[2], power=power)
+    window = window.astype('float32')
+    window.setflags(write=False)
+    return window
+
+
+def get_window(window_size, overlaps, power=2):
+    """Get the cached spline window for a tile.
+
+    Args:
+        window_size (tuple): The tile size, (x, y) or (z, x, y).
+        overlaps (list): The (left, right) overlap of the tile along each
+            axis of ``window_size``.
+        power (int): The power of the window function
+
+    Returns:
+        numpy.array: read-only float32 window with a trailing channel axis.
+    """
+    window_size = tuple(int(s) for s in window_size)
+    overlaps = tuple(tuple(int(o) for o in overlap) for overlap in overlaps)
+    return _cached_window(window_size, overlaps, power)
+
+
+def blend_tiles(image, tiles, regions, overlaps, window_size, power=2, batch_size=64):
+    """Add window-weighted tiles into a float accumulator in place.
+
+    Tiles are grouped by window class (their overlap configuration) so every
+    window is fetched once and each group is weighted in vectorized batches
+    of ``batch_size`` tiles.
+
+    Args:
+        image (numpy.array): The accumulator, e.g. float32.
+        tiles (numpy.array): The tiles to blend.
+        regions (list): Index of ``image`` covered by each tile.
+        overlaps (list): Per-axis (left, right) overlaps of each tile.
+        window_size (tuple): The tile size, (x, y) or (z, x, y).
+        power (int): The power of the window function
+        batch_size (int): Maximum number of tiles weighted at once.
+    """
+    groups = {}
+    for i, overlap in enumerate(overlaps):
+        groups.setdefault(tuple(overlap), []).append(i)
+
+    for overlap, indices in groups.items():
+        window = get_window(window_size, overlap, power=power)
+        for start in range(0, len(indices), batch_size):
+            batch_indices = indices[start:start + batch_size]
+            weighted = tiles[batch_indices] * window
+            for tile, i in zip(weighted, batch_indices):
+                image[regions[i]] += tile
+
+
+def untile_image(tiles, tiles_info, power=2, labeled_image=False, **kwargs):
     """Untile a set of tiled images back to the original model shape.
 
      Args:
          tiles (numpy.array): The tiled images image to untile.
          tiles_info (dict): Details of how the image was tiled (from tile_image).
          power (int): The power of the window function
+         labeled_image (bool): If True, the tiles are instance labels and are
+             stitched with ``LabelUntiler`` into int32 labels instead of blended.
 
      Returns:
          numpy.array: The untiled image.
      """
-    # Define mininally acceptable tile_size and stride_ratio for spline interpolation
-    min_tile_size = 32
-    min_stride_ratio = 0.5
-
-    stride_ratio = tiles_info['stride_ratio']
-    image_shape = tiles_info['image_shape']
-    batches = tiles_info['batches']
-    x_starts = tiles_info['x_starts']
-    x_ends = tiles_info['x_ends']
-    y_starts = tiles_info['y_starts']
-    y_ends = tiles_info['y_ends']
-    overlaps_x = tiles_info['overlaps_x']
-    overlaps_y = tiles_info['overlaps_y']
-    tile_size_x = tiles_info['tile_size_x']
-    tile_size_y = tiles_info['tile_size_y']
-    stride_ratio = tiles_info['stride_ratio']
-    x_pad = tiles_info['pad_x']
-    y_pad = tiles_info['pad_y']
-
-    image_shape = [image_shape[0], image_shape[1], image_shape[2], tiles.shape[-1]]
-    window_size = (tile_size_x, tile_size_y)
-    image = np.zeros(image_shape, dtype=float)
-
-    window_cache = {}
-    for x, y in zip(overlaps_x, overlaps_y):
-        if (x, y) not in window_cache:
-            w = window_2D(window_size, overlap_x=x, overlap_y=y, power=power)
-            window_cache[(x, y)] = w
-
-    for tile, batch, x_start, x_end, y_start, y_end, overlap_x, overlap_y in zip(
-            tiles, batches, x_starts, x_ends, y_starts, y_ends, overlaps_x, overlaps_y):
+    if labeled_image:
+        untiler = LabelUntiler(tiles_info)
+        untiler.add(tiles)
+        return untiler.finalize()
 
-        # Conditions under which to use spline interpolation
-        # A tile size or stride ratio that is too small gives inconsistent results,
-        # so in these cases we skip interpolation and just return the raw tiles
-        if (min_tile_size <= tile_size_x < image_shape[1] and
-                min_tile_size <= tile_size_y < image_shape[2] and
-                stride_ratio >= min_stride_ratio):
-            window = window_cache[(overlap_x, overlap_y)]
-            image[batch, x_start:x_end, y_start:y_end, :] += tile * window
-        else:
-            image[batch, x_start:x_end, y_start:y_end, :] = tile
-
-    image = image.astype(tiles.dtype)
-
-    x_start = x_pad[0]
-    y_start = y_pad[0]
-    x_end = image_shape[1] - x_pad[1]
-    y_end = image_shape[2] - y_pad[1]
+    untiler = TileUntiler(tiles_info, power=power, dtype=tiles.dtype)
+    untiler.add(tiles)
+    return untiler.finalize()
 
-    image = image[:, x_start:x_end, y_start:y_end, :]
 
-    return image
-
-
-def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
+def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5, lazy=False):
     """
     Tile large image into many overlapping tiles of size "model_input_shape".
 
@@ -402,10 +568,13 @@ def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
         image (numpy.array): The 3D image to tile, must be rank 5.
         model_input_shape (tuple): The input size of the model.
         stride_ratio (float): The stride expressed as a fraction of the tile sizet
+        lazy (bool): If True, neither pad nor copy the image and return a
+            ``LazyTiles`` accessor instead of an array of tiles.
 
     Returns:
         tuple(numpy.array, dict): An tuple consisting of an array of tiled
-            images and a dictionary of tiling details (for use in un-tiling).
+            images (or ``LazyTiles``) and a dictionary of tiling details
+            (for use in un-tiling).
 
     Raises:
         ValueError: image is not rank 5.
@@ -437,7 +606,6 @@ def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
         stride_z = tile_size_z
 
     tiles_shape = (new_batch_size, tile_size_z, tile_size_x, tile_size_y, image.shape[4])
-    tiles = np.zeros(tiles_shape, dtype=image.dtype)
 
     # Calculate overlap of last tile along each axis
     overlap_z = (tile_size_z + stride_z * (rep_number_z - 1)) - image_size_z
@@ -450,7 +618,10 @@ def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
     pad_y = (int(np.ceil(overlap_y / 2)), int(np.floor(overlap_y / 2)))
     pad_null = (0, 0)
     padding = (pad_null, pad_z, pad_x, pad_y, pad_null)
-    image = np.pad(image, padding, 'constant', constant_values=0)
+    padded_shape = tuple(s + sum(p) for s, p in zip(image.shape, padding))
+    if not lazy:
+        tiles = np.zeros(tiles_shape, dtype=image.dtype)
+        padded = np.pad(image, padding, 'constant', constant_values=0)
 
     counter = 0
     batches = []
@@ -467,7 +638,7 @@ def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
     x_axis = 2
     y_axis = 3
 
-    for b in range(image.shape[0]):
+    for b in range(padded_shape[0]):
         for i in range(rep_number_x):
             for j in range(rep_number_y):
                 for k in range(rep_number_z):
@@ -475,24 +646,24 @@ def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
                     if i != rep_number_x - 1:  # not the last one
                         x_start, x_end = i * stride_x, i * stride_x + tile_size_x
                     else:
-                        x_start, x_end = image.shape[x_axis] - tile_size_x, image.shape[x_axis]
+                        x_start, x_end = padded_shape[x_axis] - tile_size_x, padded_shape[x_axis]
 
                     if j != rep_number_y - 1:  # not the last one
                         y_start, y_end = j * stride_y, j * stride_y + tile_size_y
                     else:
-                        y_start, y_end = image.shape[y_axis] - tile_size_y, image.shape[y_axis]
+                        y_start, y_end = padded_shape[y_axis] - tile_size_y, padded_shape[y_axis]
 
                     if k != rep_number_z - 1:  # not the last one
                         z_start, z_end = k * stride_z, k * stride_z + tile_size_z
                     else:
-                        z_start, z_end = image.shape[z_axis] - tile_size_z, image.shape[z_axis]
+                        z_start, z_end = padded_shape[z_axis] - tile_size_z, padded_shape[z_axis]
 
                     # Compute the overlaps for each tile
                     if i == 0:
                         overlap_x = (0, tile_size_x - stride_x)
                     elif i == rep_number_x - 2:
                         overlap_x = (tile_size_x - stride_x,
-                                     tile_size_x - image.shape[x_axis] + x_end)
+                                     tile_size_x - padded_shape[x_axis] + x_end)
                     elif i == rep_number_x - 1:
                         overlap_x = ((i - 1) * stride_x + tile_size_x - x_start, 0)
                     else:
@@ -502,7 +673,7 @@ def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
                         overlap_y = (0, tile_size_y - stride_y)
                     elif j == rep_number_y - 2:
                         overlap_y = (tile_size_y - stride_y,
-                                     tile_size_y - image.shape[y_axis] + y_end)
+                                     tile_size_y - padded_shape[y_axis] + y_end)
                     elif j == rep_number_y - 1:
                         overlap_y = ((j - 1) * stride_y + tile_size_y - y_start, 0)
                     else:
@@ -512,13 +683,15 @@ def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
                         overlap_z = (0, tile_size_z - stride_z)
                     elif k == rep_number_z - 2:
                         overlap_z = (tile_size_z - stride_z,
-                                     tile_size_z - image.shape[z_axis] + z_end)
+                                     tile_size_z - padded_shape[z_axis] + z_end)
                     elif k == rep_number_z - 1:
                         overlap_z = ((k - 1) * stride_z + tile_size_z - z_start, 0)
                     else:
                         overlap_z = (tile_size_z - stride_z, tile_size_z - stride_z)
 
-                    tiles[counter] = image[b, z_start:z_end, x_start:x_end, y_start:y_end, :]
+                    if not lazy:
+                        tiles[counter] = padded[b, z_start:z_end, x_start:x_end,
+                                                y_start:y_end, :]
                     batches.append(b)
                     x_starts.append(x_start)
                     x_ends.append(x_end)
@@ -549,12 +722,15 @@ def tile_image_3D(image, model_input_shape=(10, 256, 256), stride_ratio=0.5):
     tiles_info['tile_size_y'] = tile_size_y
     tiles_info['tile_size_z'] = tile_size_z
     tiles_info['stride_ratio'] = stride_ratio
-    tiles_info['image_shape'] = image.shape
+    tiles_info['image_shape'] = padded_shape
     tiles_info['dtype'] = image.dtype
     tiles_info['pad_x'] = pad_x
     tiles_info['pad_y'] = pad_y
     tiles_info['pad_z'] = pad_z
 
+    if lazy:
+        tiles = LazyTiles(image, tiles_info)
+
     return tiles, tiles_info
 
 
@@ -577,7 +753,7 @@ def window_3D(window_size, overlap_z=(5, 5), overlap_x=(32, 32), overlap_y=(32,
     return window
 
 
-def untile_image_3D(tiles, tiles_info, power=3, force=False, **kwargs):
+def untile_image_3D(tiles, tiles_info, power=3, force=False, labeled_image=False, **kwargs):
     """Untile a set of tiled images back to the original model shape.
 
      Args:
@@ -586,80 +762,328 @@ def untile_image_3D(tiles, tiles_info, power=3, force=False, **kwargs):
          power (int): The power of the window function
          force (bool): If set to True, forces use spline interpolation regardless of
                        tile size or stride_ratio.
+         labeled_image (bool): If True, the tiles are instance labels and are
+             stitched with ``LabelUntiler`` into int32 labels instead of blended.
 
      Returns:
          numpy.array: The untiled image.
      """
-    # Define mininally acceptable tile_size and stride_ratios for spline interpolation
-    min_tile_size = 32
-    min_stride_ratio = 0.5
-
-    if force:
-        min_tile_size = 0
-        min_stride_ratio = 0
-
-    stride_ratio = tiles_info['stride_ratio']
-    image_shape = tiles_info['image_shape']
-    batches = tiles_info['batches']
-
-    x_starts = tiles_info['x_starts']
-    x_ends = tiles_info['x_ends']
-    y_starts = tiles_info['y_starts']
-    y_ends = tiles_info['y_ends']
-    z_starts = tiles_info['z_starts']
-    z_ends = tiles_info['z_ends']
-
-    overlaps_x = tiles_info['overlaps_x']
-    overlaps_y = tiles_info['overlaps_y']
-    overlaps_z = tiles_info['overlaps_z']
-
-    tile_size_x = tiles_info['tile_size_x']
-    tile_size_y = tiles_info['tile_size_y']
-    tile_size_z = tiles_info['tile_size_z']
-    pad_x = tiles_info['pad_x']
-    pad_y = tiles_info['pad_y']
-    pad_z = tiles_info['pad_z']
-
-    image_shape = tuple(list(image_shape[:4]) + [tiles.shape[-1]])
-    window_size = (tile_size_z, tile_size_x, tile_size_y)
-    image = np.zeros(image_shape, dtype=float)
-
-    tile_data_zip = zip(tiles, batches, x_starts, x_ends, y_starts,
-                        y_ends, z_starts, z_ends, overlaps_x, overlaps_y, overlaps_z)
-
-    for (tile, batch, x_start, x_end, y_start, y_end, z_start,
-         z_end, overlap_x, overlap_y, overlap_z) in tile_data_zip:
+    if labeled_image:
+        untiler = LabelUntiler(tiles_info)
+        untiler.add(tiles)
+        return untiler.finalize()
+
+    untiler = TileUntiler(tiles_info, power=power, force=force, dtype=tiles.dtype)
+    untiler.add(tiles)
+    return untiler.finalize()
+
+
+class TileUntiler(object):  # pylint: disable=useless-object-inheritance
+    """Untile an image incrementally from tiles as they are produced.
+
+    Tiles, or batches of tiles, are blended into a preallocated float32
+    accumulator of the padded image in the order given by ``tiles_info``.
+    Only the accumulator and the tiles of the current call are held in
+    memory, and the accumulator can be memory-mapped to disk.
+
+    Args:
+        tiles_info (dict): Details of how the image was tiled
+            (from tile_image or tile_image_3D).
+        power (int): The power of the window function, defaults to 2 for
+            2D and 3 for 3D tiles.
+        force (bool): If set to True, forces use spline interpolation regardless of
+            tile size or stride_ratio.
+        dtype (numpy.dtype): dtype of the untiled image, defaults to the
+            dtype of the first tiles added.
+        filename (str): If given, the accumulator is a ``.npy`` file
+            memory-mapped at this path.
+        out (numpy.array): Preallocated, zeroed float accumulator with the
+            padded image shape and the channels of the tiles.
+
+    Examples:
+        >>> tiles, tiles_info = tile_image(image, lazy=True)
+        >>> untiler = TileUntiler(tiles_info)
+        >>> for i in range(0, len(tiles), 16):
+        ...     untiler.add(predict(tiles[i:i + 16]))
+        >>> image = untiler.finalize()
+    """
+
+    accumulator_dtype = 'float32'
+
+    def __init__(self, tiles_info, power=None, force=False, dtype=None,
+                 filename=None, out=None):
+        self.tiles_info = tiles_info
+        self.is_3d = 'z_starts' in tiles_info
+        self.power = power if power is not None else (3 if self.is_3d else 2)
+        self.dtype = dtype
+        self.filename = filename
+        self.image = out
+
+        axes = ('z', 'x', 'y') if self.is_3d else ('x', 'y')
+        self._axes = axes
+        self.window_size = tuple(tiles_info['tile_size_{}'.format(a)] for a in axes)
+        self.n_tiles = len(tiles_info['batches'])
+        self.n_added = 0
+
+        starts = [tiles_info['{}_starts'.format(a)] for a in axes]
+        ends = [tiles_info['{}_ends'.format(a)] for a in axes]
+        self._regions = [
+            (batch,) + tuple(slice(s, e) for s, e in zip(tile_starts, tile_ends))
+            for batch, tile_starts, tile_ends in zip(
+                tiles_info['batches'], zip(*starts), zip(*ends))
+        ]
+        self._overlaps = list(zip(*[tiles_info['overlaps_{}'.format(a)] for a in axes]))
+
+        # Define mininally acceptable tile_size and stride_ratio for spline interpolation
+        min_tile_size = 0 if force else 32
+        min_stride_ratio = 0 if force else 0.5
 
         # Conditions under which to use spline interpolation
         # A tile size or stride ratio that is too small gives inconsistent results,
         # so in these cases we skip interpolation and just return the raw tiles
-        if (min_tile_size <= tile_size_x < image_shape[2] and
-                min_tile_size <= tile_size_y < image_shape[3] and
-                min_stride_ratio <= stride_ratio):
-
-            window = window_3D(window_size, overlap_z=overlap_z, overlap_x=overlap_x,
-                               overlap_y=overlap_y, power=power)
-            image[batch, z_start:z_end, x_start:x_end, y_start:y_end, :] += tile * window
+        x_axis = axes.index('x') + 1
+        image_shape = tiles_info['image_shape']
+        self.use_window = (
+            min_tile_size <= tiles_info['tile_size_x'] < image_shape[x_axis] and
+            min_tile_size <= tiles_info['tile_size_y'] < image_shape[x_axis + 1] and
+            tiles_info['stride_ratio'] >= min_stride_ratio)
+
+    def _allocate(self, channels):
+        shape = tuple(self.tiles_info['image_shape'][:len(self._axes) + 1]) + (channels,)
+        if self.filename is not None:
+            self.image = np.lib.format.open_memmap(
+                self.filename, mode='w+', dtype=self.accumulator_dtype, shape=shape)
+        else:
+            self.image = np.zeros(shape, dtype=self.accumulator_dtype)
+
+    def add(self, tiles):
+        """Blend the next tile or batch of tiles into the output.
+
+        Args:
+            tiles (numpy.array): A single tile or a batch of tiles, following
+                the tiles already added in the order of ``tiles_info``.
+
+        Raises:
+            ValueError: More tiles are added than were tiled.
+        """
+        tiles = np.asarray(tiles)
+        if tiles.ndim == len(self._axes) + 1:
+            tiles = tiles[np.newaxis]
+
+        start, end = self.n_added, self.n_added + tiles.shape[0]
+        if end > self.n_tiles:
+            raise ValueError('Expected {} tiles, got at least {}.'.format(
+                self.n_tiles, end))
+
+        if self.image is None:
+            self._allocate(tiles.shape[-1])
+        if self.dtype is None:
+            self.dtype = tiles.dtype
+
+        regions = self._regions[start:end]
+        if self.use_window:
+            blend_tiles(self.image, tiles, regions, self._overlaps[start:end],
+                        self.window_size, power=self.power)
         else:
-            image[batch, z_start:z_end, x_start:x_end, y_start:y_end, :] = tile
+            for tile, region in zip(tiles, regions):
+                self.image[region] = tile
+
+        self.n_added = end
+
+    def _crop(self):
+        if self.n_added != self.n_tiles:
+            raise ValueError('Expected {} tiles, only {} were added.'.format(
+                self.n_tiles, self.n_added))
+
+        image_shape = self.tiles_info['image_shape']
+        crop = [slice(None)]
+        for i, axis in enumerate(self._axes):
+            pad = self.tiles_info['pad_{}'.format(axis)]
+            crop.append(slice(pad[0], image_shape[i + 1] - pad[1]))
+        return self.image[tuple(crop)]
 
-    image = image.astype(tiles.dtype)
+    def finalize(self):
+        """Crop the padding from the blended image.
 
-    x_start = pad_x[0]
-    y_start = pad_y[0]
-    z_start = pad_z[0]
-    x_end = image_shape[2] - pad_x[1]
-    y_end = image_shape[3] - pad_y[1]
-    z_end = image_shape[1] - pad_z[1]
+        Returns:
+            numpy.array: The untiled image.
 
-    image = image[:, z_start:z_end, x_start:x_end, y_start:y_end, :]
+        Raises:
+            ValueError: Not all tiles have been added.
+        """
+        return self._crop().astype(self.dtype, copy=False)
 
-    return image
+
+class LabelUntiler(TileUntiler):
+    """Untile instance label tiles into one consistently labeled image.
+
+    Blending label ids is meaningless, so each tile is stitched instead. In
+    the region already written by earlier tiles, every existing label is
+    matched to the tile label covering most of it, if that covers at least
+    ``overlap_threshold`` of the smaller of the two (both restricted to the
+    written region). Matched tile labels take over the existing id, unmatched
+    ones get a new global id, and a tile label matched to several existing
+    labels joins them, which reconciles cells that earlier tiles only saw as
+    disconnected pieces. The tile then fills only still unlabeled pixels.
+
+    Each tile costs work proportional to its own size; joined ids are
+    resolved and made sequential in a single pass in ``finalize``.
+
+    Args:
+        tiles_info (dict): Details of how the image was tiled
+            (from tile_image or tile_image_3D).
+        overlap_threshold (float): Minimum overlap coefficient for a tile
+            label to be matched to an existing label.
+        dtype (numpy.dtype): dtype of the untiled labels, defaults to int32.
+        filename (str): If given, the label image is a ``.npy`` file
+            memory-mapped at this path.
+        out (numpy.array): Preallocated, zeroed int32 label image with the
+            padded image shape and the channels of the tiles.
+    """
+
+    accumulator_dtype = 'int32'
+
+    def __init__(self, tiles_info, overlap_threshold=0.5, dtype=None,
+                 filename=None, out=None):
+        super(LabelUntiler, self).__init__(
+            tiles_info, dtype=dtype, filename=filename, out=out)
+        self.overlap_threshold = overlap_threshold
+        self.n_labels = 0
+        self._parents = {}  # union-find forest of joined ids
+
+    def _find(self, label):
+        root = label
+        while root in self._parents:
+            root = self._parents[root]
+        # compress the path to the root
+        while label != root:
+            parent = self._parents[label]
+            self._parents[label] = root
+            label = parent
+        return root
+
+    def _join(self, label, other):
+        label, other = self._find(label), self._find(other)
+        if label != other:
+            self._parents[max(label, other)] = min(label, other)
+
+    def add(self, tiles):
+        """Stitch the next tile or batch of label tiles into the output.
+
+        Args:
+            tiles (numpy.array): A single tile or a batch of tiles, following
+                the tiles already added in the order of ``tiles_info``.
+
+        Raises:
+            ValueError: More tiles are added than were tiled.
+        """
+        tiles = np.asarray(tiles)
+        if tiles.ndim == len(self._axes) + 1:
+            tiles = tiles[np.newaxis]
+
+        start, end = self.n_added, self.n_added + tiles.shape[0]
+        if end > self.n_tiles:
+            raise ValueError('Expected {} tiles, got at least {}.'.format(
+                self.n_tiles, end))
+
+        if self.image is None:
+            self._allocate(tiles.shape[-1])
+
+        for tile, region in zip(tiles, self._regions[start:end]):
+            for channel in range(tile.shape[-1]):
+                self._stitch(tile[..., channel], region + (channel,))
+
+        self.n_added = end
+
+    def _stitch(self, tile, region):
+        canvas = self.image[region]  # view into the output
+
+        # compact the tile ids to 0..N, so the work does not depend on how
+        # large the ids are
+        present, tile = np.unique(tile, return_inverse=True)
+        tile = tile.reshape(canvas.shape)
+        if present[0] != 0:
+            tile += 1
+        elif present.size == 1:
+            return
+        n_ids = int(tile.max()) + 1
+
+        lut = np.zeros(n_ids, dtype=self.image.dtype)
+        is_matched = np.zeros(n_ids, dtype=bool)
+
+        is_written = canvas != 0
+        is_both = np.logical_and(is_written, tile != 0)
+        if is_both.any():
+            # encode pairs with the existing label first, to group by it
+            keys = np.left_shift(canvas[is_both].astype('uint64'), np.uint64(32))
+            keys |= tile[is_both].astype('uint64')
+            keys, intersections = np.unique(keys, return_counts=True)
+            canvas_ids = np.right_shift(keys, np.uint64(32)).astype('int64')
+            tile_ids = np.bitwise_and(keys, np.uint64(0xFFFFFFFF)).astype(np.intp)
+
+            # areas restricted to the already written region of this tile
+            tile_areas = np.bincount(tile[is_written], minlength=n_ids)
+            written_ids, written_areas = np.unique(canvas[is_written], return_counts=True)
+            canvas_areas = written_areas[np.searchsorted(written_ids, canvas_ids)]
+
+            # the tile label covering most of each existing label
+            order = np.lexsort((-intersections, canvas_ids))
+            is_first = np.ones(order.shape, dtype=bool)
+            is_first[1:] = canvas_ids[order][1:] != canvas_ids[order][:-1]
+            best = order[is_first]
+
+            smaller = np.minimum(tile_areas[tile_ids[best]], canvas_areas[best])
+            best = best[intersections[best] >= self.overlap_threshold * smaller]
+
+            for tile_id, canvas_id in zip(tile_ids[best].tolist(), canvas_ids[best].tolist()):
+                if is_matched[tile_id]:
+                    self._join(lut[tile_id], canvas_id)
+                else:
+                    lut[tile_id] = canvas_id
+                    is_matched[tile_id] = True
+
+        new_ids = np.nonzero(~is_matched[1:])[0] + 1
+        lut[new_ids] = np.arange(self.n_labels + 1, self.n_labels + 1 + new_ids.size)
+        self.n_labels += new_ids.size
+
+        is_free = ~is_written
+        canvas[is_free] = lut[tile[is_free]]
+
+    def finalize(self):
+        """Crop the padding, resolve joined ids and relabel sequentially.
+
+        Returns:
+            numpy.array: The untiled label image.
+
+        Raises:
+            ValueError: Not all tiles have been added.
+        """
+        labels = self._crop()
+        dtype = self.dtype if self.dtype is not None else labels.dtype
+
+        roots = np.arange(self.n_labels + 1)
+        for label in list(self._parents):
+            roots[label] = self._find(label)
+
+        # ids may be unused when a tile label only covered written pixels
+        is_present = np.zeros(self.n_labels + 1, dtype=bool)
+        is_used = np.bincount(labels.ravel(), minlength=self.n_labels + 1) > 0
+        is_present[roots[is_used]] = True
+        is_present[0] = False
+
+        lut = np.cumsum(is_present).astype(dtype)[roots]
+        if np.array_equal(lut, np.arange(self.n_labels + 1)):
+            return labels.astype(dtype, copy=False)
+        return lut[labels]
 
 
 def fill_holes(label_img, size=10, connectivity=1):
     """Fills holes located completely within a given label with pixels of the same value
 
+    The background is labeled once and every background component that does
+    not touch the image border, is only adjacent to a single label and is not
+    larger than ``size`` is filled with that label in a single assignment.
+
     Args:
         label_img (numpy.array): a 2D labeled image
         size (int): maximum size for a hole to be filled in
@@ -669,19 +1093,49 @@ def fill_holes(label_img, size=10, connectivity=1):
         numpy.array: a labeled image with no holes smaller than ``size``
             contained within any label.
     """
-    output_image = np.copy(label_img)
-
-    props = regionprops(np.squeeze(label_img.astype('int')), cache=False)
-    for prop in props:
-        if prop.euler_number < 1:
-
-            patch = output_image[prop.slice]
+    from scipy import ndimage
 
-            filled = remove_small_holes(
-                ar=(patch == prop.label),
-                area_threshold=size,
-                connectivity=connectivity)
-
-            output_image[prop.slice] = np.where(filled, prop.label, patch)
+    output_image = np.copy(label_img)
+    image = np.squeeze(output_image)
+
+    structure = ndimage.generate_binary_structure(image.ndim, connectivity)
+    background = image == 0
+    holes, num_holes = ndimage.label(background, structure=structure)
+    if not num_holes:
+        return output_image
+
+    # collect the labels adjacent to each background component
+    hole_ids, neighbors = [], []
+    center = np.array(structure.shape) // 2
+    for offset in np.argwhere(structure) - center:
+        if not offset.any():
+            continue
+        src = tuple(slice(max(-o, 0), n - max(o, 0)) for o, n in zip(offset, image.shape))
+        dst = tuple(slice(max(o, 0), n - max(-o, 0)) for o, n in zip(offset, image.shape))
+        h, label = holes[src], image[dst]
+        adjacent = (h > 0) & (label > 0)
+        hole_ids.append(h[adjacent])
+        neighbors.append(label[adjacent])
+    hole_ids = np.concatenate(hole_ids)
+    neighbors = np.concatenate(neighbors)
+
+    # a hole is enclosed by a single label if its lowest and highest
+    # neighboring labels are the same
+    lowest = np.full(num_holes + 1, neighbors.max(initial=0), dtype=image.dtype)
+    highest = np.zeros(num_holes + 1, dtype=image.dtype)
+    np.minimum.at(lowest, hole_ids, neighbors)
+    np.maximum.at(highest, hole_ids, neighbors)
+    fill = np.bincount(hole_ids, minlength=num_holes + 1) > 0
+    fill &= lowest == highest
+
+    # holes that touch the border are not enclosed by a label
+    for axis in range(image.ndim):
+        fill[np.take(holes, [0, -1], axis=axis)] = False
+
+    fill &= np.bincount(holes.ravel(), minlength=num_holes + 1) <= size
+    fill[0] = False
+
+    lut = np.where(fill, lowest, 0).astype(image.dtype)
+    image[background] = lut[holes[background]]
 
     return output_image